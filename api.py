@@ -0,0 +1,149 @@
+"""
+In-process interface to Slurmify, for workflow engines and other Python code that generates
+many job scripts. Nothing is printed, the process is never exited, and no files are read or
+written unless needed for the requested job (see below) or explicitly asked for with write().
+
+>>> import api
+>>> script = api.render(dict(input="h2o", program="orca", memory="10GB"))
+>>> scripts = api.render_many([dict(input=name, program="orca", memory="10GB") for name in names])
+
+A job spec is a dict with the same keys as the long command-line options of slurmify.py:
+input, output, identifier, cluster, account, nodes, ntasks, cpus_per_task, memory,
+memory_per_cpu, time, mail, partition, cmd, dev, loc, checkbill, chess, cxyz, ccomp, cgbw,
+cchk, initorb, initchk, resubmit, signal_lead. Omitted keys get the command-line defaults. In addition:
+    program: "orca", "gaussian", or "mrchem". If omitted, the input file is read to determine it
+    extension_inputfile, extension_outputfile: default to the extensions set in slurmify.py
+    produced: ORCA auxiliary files written by earlier jobs, which need not exist yet (see workflow.py)
+
+The input file is also read when ORCA auxiliary files are requested (chess, cxyz, ccomp, cgbw),
+and the existence of requested auxiliary files is checked. File names are relative to the
+current working directory, exactly as for the command line.
+
+Errors are raised as subclasses of utils.SlurmifyError, and problems that do not prevent
+generating the script are issued as utils.SlurmifyWarning with the warnings module.
+"""
+from utils import (job_for_input, scan_input, write_jobfile, SlurmifyError, MissingFileError, InvalidInputError,
+                   SettingsError, SlurmifyWarning)
+
+PROGRAMS = ("orca", "gaussian", "mrchem")
+
+# Settings that are not command-line options
+EXTRA_KEYS = {"program", "cluster", "extension_inputfile", "extension_outputfile", "produced"}
+
+_defaults = None
+
+
+def defaults():
+    """
+    Default settings of a job spec, i.e. the command-line defaults and the detected cluster.
+    Determined once per process.
+    :return: dict of settings
+    """
+    global _defaults
+    if _defaults is None:
+        import slurmify
+
+        settings = slurmify.build_parser().parse_args([]).__dict__
+        for key in slurmify.RUN_OPTIONS:
+            settings.pop(key, None)
+        settings.update(cluster=slurmify.detect_cluster(), extension_inputfile=slurmify.INPUT_EXTENSION,
+                        extension_outputfile=slurmify.OUTPUT_EXTENSION)
+        _defaults = settings
+    return _defaults
+
+
+def settings_for(spec):
+    """
+    Complete a job spec with the defaults
+    :param spec: job spec dict
+    :return: dict of settings as passed to utils.job_for_input
+    """
+    base = defaults()
+    unknown = spec.keys() - base.keys() - EXTRA_KEYS
+    if unknown:
+        raise SettingsError(f"Unknown job spec keys: {', '.join(sorted(unknown))}")
+    if not spec.get("input"):
+        raise SettingsError("The job spec must name the input file ('input')")
+
+    from slurmify import ACCOUNTS
+
+    settings = dict(base, **spec)
+    if settings["cluster"] not in ACCOUNTS:
+        raise SettingsError(f"Unknown cluster: {settings['cluster']}")
+    if settings["account"] is None:
+        settings["account"] = ACCOUNTS[settings["cluster"]]
+    return settings
+
+
+def manifest_for(settings):
+    """
+    Manifest of the input file of a job. The input file is only read if the program is not given,
+    or if auxiliary files referenced by the input are requested.
+    """
+    program = settings.get("program")
+    if program is not None and program not in PROGRAMS:
+        raise SettingsError(f"Unknown program: {program}. Choose from {', '.join(PROGRAMS)}")
+    if program is not None and not (program == "orca" and any(settings[key] for key in ("chess", "cxyz", "ccomp", "cgbw"))):
+        return dict(program=program)
+
+    inputfile = settings["input"] + settings["extension_inputfile"]
+    try:
+        manifest = scan_input(inputfile)
+    except FileNotFoundError:
+        raise MissingFileError(f"Error! The input file ({inputfile}) was not found")
+    if program is not None and manifest["program"] != program:
+        raise InvalidInputError(f"{inputfile} is an input file for {manifest['program']}, not {program}")
+    return manifest
+
+
+def render_lines(spec):
+    """
+    Generate a job script
+    :param spec: job spec dict
+    :return: name of the program, and the job script as a list of lines
+    """
+    settings = settings_for(spec)
+    return job_for_input(settings["input"], settings, manifest=manifest_for(settings))
+
+
+def render(spec):
+    """
+    Generate a job script
+    :param spec: job spec dict
+    :return: the job script
+    """
+    return "\n".join(render_lines(spec)[1]) + "\n"
+
+
+def render_many(specs, skip_errors=False):
+    """
+    Generate job scripts for many job specs
+    :param specs: iterable of job spec dicts
+    :param skip_errors: put the exception in the place of the script if a spec fails,
+                        instead of raising it
+    :return: list of job scripts, in the order of specs
+    """
+    scripts = []
+    for spec in specs:
+        try:
+            scripts.append(render(spec))
+        except SlurmifyError as e:
+            if not skip_errors:
+                raise
+            scripts.append(e)
+    return scripts
+
+
+def write(spec, path=None):
+    """
+    Generate a job script and write it to disk
+    :param spec: job spec dict
+    :param path: path of the job file. Defaults to the input name with the job file extension
+    :return: path of the job file
+    """
+    from slurmify import JOB_EXTENSION
+
+    if path is None:
+        path = spec["input"] + JOB_EXTENSION
+    write_jobfile(path, render_lines(spec)[1])
+    return path
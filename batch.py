@@ -0,0 +1,157 @@
+import os
+import sys
+import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import profiling
+from profiling import phase
+from utils import job_for_input, write_jobfile, SlurmifyError
+from cache import cached_scan, load, store, load_jobs, store_jobs, job_digest, file_hash
+
+
+def collect_inputs(source, extension=".inp"):
+    """
+    Resolve a batch source into a list of input files.
+    :param source: a directory (all files with the input extension are used), a glob pattern,
+                   or a text file listing one input file per line ('#' starts a comment)
+    :param extension: input file extension
+    :return: sorted list of absolute paths to input files, without extension
+    """
+    if os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, "*" + extension))
+    elif os.path.isfile(source) and not source.endswith(extension):
+        base = os.path.dirname(os.path.abspath(source))
+        paths = []
+        with open(source) as f:
+            for line in f:
+                line = line.split("#")[0].strip()
+                if line:
+                    paths.append(os.path.join(base, line))
+    else:
+        paths = glob.glob(source)
+
+    inputs = set()
+    for path in paths:
+        if path.endswith(extension):
+            path = path[:-len(extension)]
+        inputs.add(os.path.abspath(path))
+    return sorted(inputs)
+
+
+def generate_job(inputpath, settings, job_extension=".job", force=False, entry=None, use_hash=False, update=False,
+                 previous=None, collect=False):
+    """
+    Generate the job file for a single input of a batch. The job file is written next to the input
+    file, and the job is generated from within that directory, exactly as for a single-file run.
+    :param inputpath: absolute path to the input file, without extension
+    :param settings: dict of settings passed on to utils.job_for_input
+    :param job_extension: extension of the job file
+    :param force: overwrite existing job files. Existing job files are skipped if False
+    :param entry: classification cache entry of the input file (see cache.cached_scan)
+    :param use_hash: compare content hashes when validating the cache entry
+    :param update: regenerate existing job files, but only if the job or the contents of the input changed
+    :param previous: digest of the job file from the last run (see cache.job_digest), for update
+    :param collect: return the job file instead of writing it, e.g. to write it into a bundle (see sink.py)
+    :return: tuple (inputpath, status, message, record, digest, job), where status is "generated", "skipped", or "failed",
+             record is the updated cache entry, or None if the cache is up to date, digest is
+             the (job file, digest) record of a job generated with update, else None, and job is the
+             job file as a list of lines if collect, else None
+    """
+    directory, inputfile = os.path.split(inputpath)
+    jobname = os.path.join(directory, inputfile + job_extension)
+    if not force and not update and not collect and os.path.isfile(jobname):
+        return inputpath, "skipped", f"{jobname} exists", None, None, None
+
+    cwd = os.getcwd()
+    record = digest = None
+    try:
+        os.chdir(directory)
+        with phase("scan", inputpath):
+            manifest, record = cached_scan(inputfile + settings["extension_inputfile"], entry, use_hash=use_hash)
+        with phase("render", inputpath):
+            program, job = job_for_input(inputfile, settings, manifest=manifest)
+        if update:
+            with phase("hash", inputpath):
+                digest = job_digest(job, [file_hash(inputfile + settings["extension_inputfile"])])
+            if digest == previous and os.path.isfile(jobname):
+                return inputpath, "skipped", f"{jobname} is up to date", record, None, None
+        if not collect:
+            with phase("write", inputpath):
+                write_jobfile(jobname, job)
+    except SlurmifyError as e:
+        return inputpath, "failed", str(e), record, None, None
+    except (OSError, KeyError, ValueError) as e:
+        # e.g. an unreadable input, or one that is not valid UTF-8 (UnicodeDecodeError)
+        return inputpath, "failed", f"{type(e).__name__}: {e}", record, None, None
+    finally:
+        os.chdir(cwd)
+    return (inputpath, "generated", f"Generated {jobname} ({program})", record, digest and (jobname, digest),
+            job if collect else None)
+
+
+def run_batch(inputs, settings, job_extension=".job", force=False, nprocs=1, silent=False, cache=None, use_hash=False,
+              update=None, bundle=None):
+    """
+    Generate job files for many inputs in one process, optionally fanned out over a process pool.
+    Failures are reported per input instead of aborting the whole batch.
+    :param inputs: list of absolute paths to input files, without extension
+    :param settings: dict of settings passed on to utils.job_for_input
+    :param job_extension: extension of the job files
+    :param force: overwrite existing job files
+    :param nprocs: number of worker processes. Run serially in this process if 1
+    :param silent: only report failures and the final summary
+    :param cache: path to the classification cache. Every input is scanned if None
+    :param use_hash: compare content hashes when validating cache entries
+    :param update: path to the cache holding the job digests. If given, existing job files are regenerated
+                   (and resubmitted) only if the job or the contents of the input changed since the last run
+    :param bundle: sink.Bundle to write the job files into, instead of one file per input. The workers
+                   send the job files back to this process, which writes them
+    :return: dict mapping status to the list of inputs with that status. The generated job files are listed under "jobs"
+    """
+    results = {"generated": [], "skipped": [], "failed": []}
+    total = len(inputs)
+    with phase("cache"):
+        entries = load(cache) if cache is not None else {}
+        previous = load_jobs(update) if update is not None else {}
+    records, digests = [], []
+
+    def report(done, inputpath, status, message, record, digest, job):
+        results[status].append(inputpath)
+        if job is not None:
+            with phase("write", inputpath):
+                bundle.write(inputpath + job_extension, job)
+        if record is not None:
+            records.append(record)
+        if digest is not None:
+            digests.append(digest)
+        if status == "failed":
+            print(f"[{done}/{total}] Failed {inputpath}: {message}", file=sys.stderr)
+        elif not silent:
+            print(f"[{done}/{total}] {message}")
+
+    if nprocs > 1 and total > 1:
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            # The workers send their phase timings back with their results
+            futures = [pool.submit(profiling.call, profiling.enabled(), generate_job, inputpath, settings,
+                                   job_extension, force, entries.get(inputpath + settings["extension_inputfile"]),
+                                   use_hash, update is not None, previous.get(inputpath + job_extension), bundle is not None)
+                       for inputpath in inputs]
+            for done, future in enumerate(as_completed(futures), start=1):
+                report(done, *profiling.merge(future.result()))
+    else:
+        for done, inputpath in enumerate(inputs, start=1):
+            report(done, *generate_job(inputpath, settings, job_extension, force,
+                                       entries.get(inputpath + settings["extension_inputfile"]), use_hash,
+                                       update is not None, previous.get(inputpath + job_extension),
+                                       bundle is not None))
+
+    with phase("cache"):
+        if cache is not None:
+            store(cache, records)
+        if update is not None:
+            store_jobs(update, digests)
+    results["jobs"] = [inputpath + job_extension for inputpath in sorted(results["generated"])]
+
+    print(f"Batch done: {len(results['generated'])} generated, {len(results['skipped'])} skipped, "
+          f"{len(results['failed'])} failed")
+    return results
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Fake sbatch and squeue for testing the submission feeder (feed.py) without a cluster. Jobs are
+kept in a JSON file, "run" for a fixed time after they are submitted, and sbatch refuses jobs
+beyond a submit limit like a QOS with MaxSubmitJobs does:
+
+$ export FAKESLURM_STATE=/tmp/fakeslurm.json FAKESLURM_MAX_SUBMIT=50 FAKESLURM_RUNTIME=5
+$ slurmify.py feed run --max_jobs 50 --interval 2 \\
+      --sbatch "python benchmarks/fakeslurm.py sbatch" --squeue "python benchmarks/fakeslurm.py squeue"
+$ python benchmarks/fakeslurm.py stats
+
+'stats' prints the number of jobs submitted, rejected, and submitted more than once (by comment).
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+
+STATE = os.environ.get("FAKESLURM_STATE", "/tmp/fakeslurm.json")
+MAX_SUBMIT = int(os.environ.get("FAKESLURM_MAX_SUBMIT", "50"))
+RUNTIME = float(os.environ.get("FAKESLURM_RUNTIME", "5"))
+
+
+def locked_state(function):
+    """Call function(state) with the state file locked, and save the state it returns"""
+    with open(STATE, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        text = f.read()
+        state = json.loads(text) if text else dict(next=1000, jobs=[], rejected=0)
+        result = function(state)
+        f.seek(0)
+        f.truncate()
+        json.dump(state, f)
+        return result
+
+
+def active(state):
+    now = time.time()
+    return [job for job in state["jobs"] if job["end"] > now]
+
+
+def sbatch(args):
+    from feed import array_tasks
+
+    comment = next((arg.split("=", 1)[1] for arg in args if arg.startswith("--comment=")), "(null)")
+    files = [arg for arg in args if not arg.startswith("-")]
+    if files:
+        with open(files[-1]) as f:
+            script = f.read()
+    else:
+        script = sys.stdin.read()
+    tasks = array_tasks(script)
+
+    def submit(state):
+        if sum(job["tasks"] for job in active(state)) + tasks > MAX_SUBMIT:
+            state["rejected"] += 1
+            return None
+        jobid = state["next"]
+        state["next"] += 1
+        state["jobs"].append(dict(id=jobid, comment=comment, tasks=tasks, end=time.time() + RUNTIME))
+        return jobid
+
+    jobid = locked_state(submit)
+    if jobid is None:
+        print("sbatch: error: Batch job submission failed: Job violates accounting/QOS policy "
+              "(job submit limit, user's size and/or time limits) QOSMaxSubmitJobPerUserLimit", file=sys.stderr)
+        return 1
+    print(jobid)
+    return 0
+
+
+def squeue(args):
+    for job in locked_state(active):
+        for task in range(job["tasks"]):
+            print(f"{job['id']}_{task} {job['comment']}" if job["tasks"] > 1 else f"{job['id']} {job['comment']}")
+    return 0
+
+
+def stats(args):
+    state = locked_state(lambda state: state)
+    comments = [job["comment"] for job in state["jobs"]]
+    print(f"{len(comments)} submitted, {state['rejected']} rejected, "
+          f"{len(comments) - len(set(comments))} submitted more than once")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.exit({"sbatch": sbatch, "squeue": squeue, "stats": stats}[sys.argv[1]](sys.argv[2:]))
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Golden-file check of the generated job scripts. Every case below is rendered and compared with
+benchmarks/golden/<case>.job, ignoring the timestamp header. Run it before and after performance
+work, so that faster generation cannot silently change the scripts.
+
+$ python benchmarks/golden.py            compare, and print a diff of every mismatch
+$ python benchmarks/golden.py --update   rewrite the golden files that changed, after an intended change
+
+The golden files are generated with the 'vars' and 'billing' dictionaries as distributed, so
+the check fails on a checkout where utils.py has been configured for another user.
+"""
+import os
+import sys
+import difflib
+import argparse
+import tempfile
+import functools
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GOLDEN = os.path.join(ROOT, "benchmarks", "golden")
+sys.path.insert(0, ROOT)
+
+ORCA_INPUT = """! B3LYP def2-SVP Opt Freq
+%geom
+    inhessname "h2o_orca.hess"
+end
+* xyzfile 0 1 h2o_orca.xyz
+"""
+GAUSSIAN_INPUT = """%chk=h2o_gaussian.chk
+#p B3LYP/def2SVP opt
+
+water
+
+0 1
+O 0.0 0.0 0.0
+H 0.0 0.0 0.96
+H 0.93 0.0 -0.24
+
+"""
+MRCHEM_INPUT = """world_prec = 1.0e-4
+WaveFunction {
+  method = "B3LYP"
+}
+Molecule {
+$coords
+O 0.0 0.0 0.0
+H 0.0 0.0 1.81
+H 1.76 0.0 -0.45
+$end
+}
+"""
+
+
+def make_fixtures(directory):
+    """Write the inputs and auxiliary files the cases refer to"""
+    files = {"h2o_orca.inp": ORCA_INPUT, "h2o_orca.hess": "", "h2o_orca.xyz": "3\n\nO 0 0 0\nH 0 0 0.96\nH 0.93 0 -0.24\n",
+             "h2o_gaussian.inp": GAUSSIAN_INPUT, "h2o_gaussian.chk": "", "h2o_mrchem.inp": MRCHEM_INPUT}
+    for name, content in files.items():
+        with open(os.path.join(directory, name), "w") as f:
+            f.write(content)
+
+
+def _render(spec):
+    import api
+
+    return api.render_lines(spec)[1]
+
+
+def _array(program, spec, slots=None):
+    import api
+    from jobarray import array_job, packed_job
+
+    settings = api.settings_for(spec)
+    if slots:
+        return packed_job(program, 8, "h2o_pack", "h2o_pack.index", settings, slots)
+    return array_job(program, 8, "h2o_array", "h2o_array.index", settings, throttle=4)
+
+
+def cases():
+    """
+    :return: dict mapping case name to a function returning the job script as a list of lines
+    """
+    from slurmify import CLUSTERS
+    from utils import vars
+
+    orca = dict(input="h2o_orca", program="orca", memory="10GB", ntasks="8")
+    gaussian = dict(input="h2o_gaussian", program="gaussian", memory="10GB", ntasks="8")
+    mrchem = dict(input="h2o_mrchem", program="mrchem", memory="100GB", ntasks="4", cpus_per_task="16", cmd="srun")
+    variants = {"orca": orca,
+                "orca_aux": dict(orca, chess=True, cxyz=True),
+                "orca_dev_loc": dict(orca, dev=True, loc=True, nodes="1"),
+                "gaussian": gaussian,
+                "gaussian_chk": dict(gaussian, cchk=True),
+                "mrchem": mrchem,
+                "mrchem_initorb": dict(mrchem, initorb="/path/to/orbitals"),
+                "mrchem_initchk": dict(mrchem, initchk="/path/to/checkpoint", memory=None, memory_per_cpu="2GB")}
+
+    # Only the programs that are set up on a cluster
+    installed = dict(orca="path_orca", gaussian="gaussian_version", mrchem="mrchem_path")
+
+    result = {}
+    for cluster in CLUSTERS:
+        for variant, spec in variants.items():
+            if installed[spec["program"]] in vars[cluster]:
+                result[f"{cluster}_{variant}"] = functools.partial(_render, dict(spec, cluster=cluster))
+        for program, spec in [("orca", orca), ("gaussian", gaussian)]:
+            if installed[program] in vars[cluster]:
+                result[f"{cluster}_{program}_array"] = functools.partial(_array, program, dict(spec, cluster=cluster))
+                result[f"{cluster}_{program}_pack"] = functools.partial(_array, program, dict(spec, cluster=cluster), slots=4)
+    return result
+
+
+def check(update=False, verbose=True):
+    """
+    Render every case and compare it with its golden file
+    :param update: write the golden files of cases that differ or are missing
+    :param verbose: print a diff of every mismatch
+    :return: list of names of cases that differ from (or have no) golden file
+    """
+    from cache import without_timestamp
+
+    mismatches = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        make_fixtures(tmp)
+        os.chdir(tmp)
+        try:
+            for name, render in sorted(cases().items()):
+                job = render()
+                path = os.path.join(GOLDEN, name + ".job")
+                golden = []
+                if os.path.isfile(path):
+                    with open(path) as f:
+                        golden = f.read().splitlines()
+                if without_timestamp(job) == without_timestamp(golden):
+                    continue
+                mismatches.append(name)
+                if update:
+                    os.makedirs(GOLDEN, exist_ok=True)
+                    with open(path, "w") as f:
+                        f.write("\n".join(job) + "\n")
+                elif verbose:
+                    sys.stdout.writelines(difflib.unified_diff([line + "\n" for line in without_timestamp(golden)],
+                                                               [line + "\n" for line in without_timestamp(job)],
+                                                               fromfile=f"golden/{name}.job", tofile=name))
+        finally:
+            os.chdir(cwd)
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the generated job scripts with the golden files")
+    parser.add_argument("--update", action="store_true", help="Rewrite the golden files that differ")
+    args = parser.parse_args(argv)
+
+    mismatches = check(update=args.update)
+    if args.update:
+        print(f"Updated {len(mismatches)} golden files")
+        return 0
+    if mismatches:
+        print(f"{len(mismatches)} of {len(cases())} job scripts differ from the golden files: {', '.join(mismatches)}")
+        return 1
+    print(f"All {len(cases())} job scripts match the golden files")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
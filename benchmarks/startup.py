@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Measure the cold-start time of slurmify.py, i.e. the wall time of a complete
+invocation in a fresh interpreter, for a few typical command lines.
+
+$ python benchmarks/startup.py [--repeat 20] [--limit 50]
+
+Exits with a non-zero status if the median time of any scenario exceeds the limit (in ms).
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SLURMIFY = os.path.join(ROOT, "slurmify.py")
+
+SCENARIOS = {
+    "help": ["-h"],
+    "single": ["-S", "-f", "-i", "orca_test", "-m", "1GB"],
+    "single-mrchem": ["-S", "-f", "-i", "mrchem_test", "-m", "1GB"],
+}
+
+
+# Byte-compiled modules are cached in normal use, so allow writing them here as well
+ENV = {key: value for key, value in os.environ.items() if key != "PYTHONDONTWRITEBYTECODE"}
+
+
+def time_invocation(argv, cwd):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, SLURMIFY] + argv, cwd=cwd, stdout=subprocess.DEVNULL, check=True, env=ENV)
+    return (time.perf_counter() - start) * 1000
+
+
+def run(repeat=20):
+    """
+    Time every scenario
+    :param repeat: number of invocations per scenario
+    :return: dict mapping scenario to dict with min/median/max wall time in ms
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        sys.path.insert(0, ROOT)
+        from utils import make_test_inputs
+        make_test_inputs(destination=tmp)
+
+        for name, argv in SCENARIOS.items():
+            # One warm-up run, so that byte-compilation is not counted
+            time_invocation(argv, tmp)
+            timings = [time_invocation(argv, tmp) for _ in range(repeat)]
+            results[name] = dict(min=min(timings), median=statistics.median(timings), max=max(timings))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the cold-start time of slurmify.py")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of invocations per scenario")
+    parser.add_argument("--limit", type=float, default=50.0, help="Maximum allowed median time in ms")
+    args = parser.parse_args(argv)
+
+    # Baseline: the bare interpreter
+    baseline = statistics.median([_python_startup() for _ in range(args.repeat)])
+    print(f"{'python -c pass':<16} median {baseline:7.1f} ms")
+
+    failed = False
+    for name, timing in run(args.repeat).items():
+        flag = ""
+        if timing["median"] > args.limit:
+            flag = f"  > {args.limit:.0f} ms"
+            failed = True
+        print(f"{name:<16} median {timing['median']:7.1f} ms   (min {timing['min']:.1f}, max {timing['max']:.1f}){flag}")
+    return 1 if failed else 0
+
+
+def _python_startup():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True, env=ENV)
+    return (time.perf_counter() - start) * 1000
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Benchmark suite for Slurmify. Measures
+
+    startup.*        wall time of a complete slurmify.py invocation (see startup.py)
+    detect.*         scan_input/input_origin on large synthetic inputs, per file
+    generate.*       job script generation for each program and cluster, per job
+    submit.*         a batch run with -X against a fake sbatch, per job
+    status.*         classifying a campaign with status.py, per job
+
+in milliseconds (lower is better), and first checks the generated scripts against the golden
+files (see golden.py). Results are compared with benchmarks/baseline.json, the reference run
+committed with the suite, which records the machine it was measured on. Timings only compare on
+similar machines, so record a baseline of your own before performance work:
+
+$ python benchmarks/suite.py --save my_baseline.json                  record a baseline
+$ python benchmarks/suite.py --baseline my_baseline.json              compare with it
+$ python benchmarks/suite.py --baseline ""                            do not compare
+
+Exits with a non-zero status if a job script differs from its golden file, or if a benchmark
+is more than --tolerance (default 25%) slower than in the baseline.
+"""
+import gc
+import os
+import sys
+import json
+import time
+import stat
+import argparse
+import platform
+import tempfile
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import golden
+import startup
+
+BASELINE = os.path.join(BENCHMARKS_DIR, "baseline.json")
+
+FAKE_SBATCH = """#!/bin/sh
+echo $$
+"""
+
+
+def best_of(function, repeat, number=1):
+    """Smallest wall time of repeat rounds of number calls, in ms per call. Like timeit, without garbage collection"""
+    timings = []
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                function()
+            timings.append((time.perf_counter() - start) * 1000 / number)
+    finally:
+        if enabled:
+            gc.enable()
+    return min(timings)
+
+
+def synthetic_orca(path, natoms):
+    """ORCA input with natoms coordinates, and the auxiliary file references after them (the worst case for scan_input)"""
+    with open(path, "w") as f:
+        f.write("! B3LYP def2-SVP Opt\n%pal nprocs 8 end\n* xyz 0 1\n")
+        f.writelines(f"C {i * 0.01:.4f} {i * 0.02:.4f} {i * 0.03:.4f}\n" for i in range(natoms))
+        f.write("*\n%geom\n    inhessname \"big.hess\"\nend\n%moinp \"big.gbw\"\n%compound \"big.cmp\" end\n")
+        f.write("* xyzfile 0 1 big.xyz\n")
+
+
+def synthetic_gaussian(path, natoms):
+    """Gaussian input with natoms coordinates, which scan_input reads to the end"""
+    with open(path, "w") as f:
+        f.write("%chk=big.chk\n%nprocshared=8\n#p B3LYP/def2SVP opt\n\nbig\n\n0 1\n")
+        f.writelines(f"C {i * 0.01:.4f} {i * 0.02:.4f} {i * 0.03:.4f}\n" for i in range(natoms))
+        f.write("\n")
+
+
+def bench_startup(quick=False):
+    return {f"startup.{name}": timing["median"] for name, timing in startup.run(repeat=5 if quick else 20).items()}
+
+
+def bench_detect(quick=False):
+    from utils import scan_input, input_origin, get_orca_hessfile
+
+    natoms = 20000 if quick else 200000
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        orca, gaussian = os.path.join(tmp, "big_orca.inp"), os.path.join(tmp, "big_gaussian.inp")
+        synthetic_orca(orca, natoms)
+        synthetic_gaussian(gaussian, natoms)
+        repeat = 3 if quick else 7
+        results["detect.input_origin.orca"] = best_of(lambda: input_origin(orca), repeat)
+        results["detect.input_origin.gaussian"] = best_of(lambda: input_origin(gaussian), repeat)
+        results["detect.scan_input.orca_aux"] = best_of(lambda: scan_input(orca), repeat)
+        results["detect.get_orca_hessfile"] = best_of(lambda: get_orca_hessfile(orca), repeat)
+    return results
+
+
+def bench_generate(quick=False):
+    import api
+    from slurmify import CLUSTERS
+    from utils import vars
+
+    specs = dict(orca=dict(program="orca", memory="10GB", ntasks="8"),
+                 gaussian=dict(program="gaussian", memory="10GB", ntasks="8"),
+                 mrchem=dict(program="mrchem", memory="100GB", ntasks="4", cpus_per_task="16", cmd="srun"))
+    installed = dict(orca="path_orca", gaussian="gaussian_version", mrchem="mrchem_path")
+    njobs = 1000 if quick else 5000
+    results = {}
+    for cluster in CLUSTERS:
+        for program, spec in specs.items():
+            if installed[program] not in vars[cluster]:
+                continue
+            batch = [dict(spec, cluster=cluster, input=f"job{i}") for i in range(njobs)]
+            results[f"generate.{program}.{cluster}"] = best_of(lambda: api.render_many(batch), 5 if quick else 9) / njobs
+    return results
+
+
+def bench_submit(quick=False):
+    njobs = 50 if quick else 200
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        inputs = os.path.join(tmp, "inputs")
+        os.mkdir(inputs)
+        for i in range(njobs):
+            with open(os.path.join(inputs, f"job{i}.inp"), "w") as f:
+                f.write(golden.ORCA_INPUT.replace("h2o_orca", f"job{i}"))
+        sbatch = os.path.join(tmp, "sbatch")
+        with open(sbatch, "w") as f:
+            f.write(FAKE_SBATCH)
+        os.chmod(sbatch, os.stat(sbatch).st_mode | stat.S_IEXEC)
+
+        for name, extra in [("batch", []), ("array", ["--array"]), ("bundle", ["--bundle", os.path.join(tmp, "jobs.tar")])]:
+            argv = [sys.executable, startup.SLURMIFY, "-B", inputs, "-f", "-S", "-X", "--sbatch", sbatch, "-m", "10GB"]
+
+            def run():
+                subprocess.run(argv + extra, cwd=tmp, stdout=subprocess.DEVNULL, check=True, env=startup.ENV)
+
+            results[f"submit.{name}"] = best_of(run, 1 if quick else 3) / njobs
+    return results
+
+
+def bench_status(quick=False):
+    import status
+
+    njobs = 500 if quick else 2000
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        # One in ten outputs is large, like those of frequency or IRC runs
+        bases = [os.path.join(tmp, f"job{i}") for i in range(njobs)]
+        for i, base in enumerate(bases):
+            with open(base + ".inp", "w") as f:
+                f.write("! HF def2-SVP\n")
+            with open(base + ".log", "w") as f:
+                f.write("started\n")
+            if i % 4 == 3:
+                continue
+            with open(base + ".out", "w") as f:
+                f.write(("x" * 99 + "\n") * (100000 if i % 10 == 0 else 100))
+                f.write("****ORCA TERMINATED NORMALLY****\n" if i % 4 else "")
+        for workers in (1, 32):
+            results[f"status.scan.workers{workers}"] = best_of(lambda: status.scan(bases, workers=workers), 3 if quick else 5) / njobs
+    return results
+
+
+BENCHMARKS = {"startup": bench_startup, "detect": bench_detect, "generate": bench_generate, "submit": bench_submit,
+              "status": bench_status}
+
+
+def compare(results, baseline, tolerance):
+    """
+    :param results: dict mapping benchmark name to time in ms
+    :param baseline: results of an earlier run
+    :param tolerance: allowed relative slowdown, e.g. 0.25
+    :return: list of (name, baseline time, time, relative change, regressed)
+    """
+    rows = []
+    for name, value in results.items():
+        if name in baseline:
+            change = value / baseline[name] - 1 if baseline[name] else 0.0
+            rows.append((name, baseline[name], value, change, change > tolerance))
+    return rows
+
+
+def machine():
+    """Description of the machine and Python the benchmarks run on, saved with the results"""
+    return dict(python=platform.python_version(), machine=platform.node(), system=platform.platform(),
+                processor=platform.processor() or platform.machine(), cpus=os.cpu_count())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the Slurmify benchmarks and compare them with a baseline")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument("--quick", action="store_true", help="Fewer repetitions and smaller inputs")
+    parser.add_argument("--save", metavar="<>", type=str, help="[str] Write the results to this JSON file")
+    parser.add_argument("--baseline", metavar="<>", type=str, default=BASELINE if os.path.isfile(BASELINE) else None,
+                        help=f"[str] Compare with the results in this JSON file (default: {os.path.relpath(BASELINE)}, if it exists)")
+    parser.add_argument("--tolerance", metavar="<>", type=float, default=0.25, help="[float] Allowed relative slowdown (default: 0.25)")
+    args = parser.parse_args(argv)
+
+    failed = False
+    mismatches = golden.check()
+    if mismatches:
+        print(f"{len(mismatches)} job scripts differ from the golden files: {', '.join(mismatches)}")
+        failed = True
+    else:
+        print("All job scripts match the golden files")
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        results.update(BENCHMARKS[name](quick=args.quick))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        here = machine()
+        if {key: baseline.get(key) for key in here} != here or baseline.get("quick") != args.quick:
+            print(f"Note: the baseline was measured on {baseline.get('machine')} ({baseline.get('processor')}, "
+                  f"{baseline.get('cpus')} CPUs, Python {baseline.get('python')}"
+                  f"{', --quick' if baseline.get('quick') else ', full run'}); timings may not compare")
+        print(f"{'benchmark':<32} {'baseline':>10} {'now':>10}  change  (ms)")
+        for name, before, now, change, regressed in compare(results, baseline["results"], args.tolerance):
+            print(f"{name:<32} {before:>10.4g} {now:>10.4g}  {change:+6.0%}{'  REGRESSION' if regressed else ''}")
+            failed = failed or regressed
+    else:
+        for name, value in results.items():
+            print(f"{name:<32} {value:>10.4g} ms")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(dict(machine(), quick=args.quick, date=time.strftime("%Y-%m-%d %H:%M:%S"), results=results),
+                      f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
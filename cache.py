@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+
+from utils import scan_input
+
+CACHE_NAME = ".slurmify_cache.sqlite"
+
+
+def cache_path(inputs):
+    """
+    Location of the cache for a batch of inputs: next to the inputs, in their common directory
+    :param inputs: list of absolute paths to input files
+    :return: path to the cache file
+    """
+    return os.path.join(os.path.commonpath([os.path.dirname(path) for path in inputs]), CACHE_NAME)
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS manifests ("
+                 "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, hash TEXT, manifest TEXT, scanned REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS jobs (path TEXT PRIMARY KEY, digest TEXT, generated REAL)")
+    return conn
+
+
+def load(path):
+    """
+    Load all cache entries into memory
+    :param path: path to the cache file
+    :return: dict mapping input path to (mtime_ns, size, hash, manifest)
+    """
+    if not os.path.isfile(path):
+        return {}
+    conn = connect(path)
+    try:
+        rows = conn.execute("SELECT path, mtime_ns, size, hash, manifest FROM manifests").fetchall()
+    finally:
+        conn.close()
+    return {row[0]: (row[1], row[2], row[3], json.loads(row[4])) for row in rows}
+
+
+def store(path, records):
+    """
+    Insert or update cache entries in a single transaction
+    :param path: path to the cache file
+    :param records: list of (path, mtime_ns, size, hash, manifest) tuples
+    :return:
+    """
+    if not records:
+        return
+    conn = connect(path)
+    try:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO manifests VALUES (?, ?, ?, ?, ?, ?)",
+                             [(p, mtime, size, digest, json.dumps(manifest), time.time())
+                              for p, mtime, size, digest, manifest in records])
+    finally:
+        conn.close()
+
+
+def load_jobs(path):
+    """
+    Load the digests of all job files generated with incremental regeneration
+    :param path: path to the cache file
+    :return: dict mapping absolute path of job file to digest
+    """
+    if not os.path.isfile(path):
+        return {}
+    conn = connect(path)
+    try:
+        return dict(conn.execute("SELECT path, digest FROM jobs").fetchall())
+    finally:
+        conn.close()
+
+
+def store_jobs(path, records):
+    """
+    Insert or update job digests in a single transaction
+    :param path: path to the cache file
+    :param records: list of (absolute path of job file, digest) tuples
+    """
+    if not records:
+        return
+    conn = connect(path)
+    try:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)",
+                             [(p, digest, time.time()) for p, digest in records])
+    finally:
+        conn.close()
+
+
+def without_timestamp(job):
+    """The lines of a job file, except for the timestamp header that changes on every run"""
+    return [line for line in job
+            if not (line.startswith("# File generated") or (line.startswith("#-") and not line.strip("#-")))]
+
+
+def job_digest(job, input_hashes=()):
+    """
+    Fingerprint of a job: the job file without its timestamp header, which reflects every setting and
+    every cluster-specific variable that went into it, plus the contents of the inputs it runs
+    :param job: job file as a list of lines
+    :param input_hashes: content hashes of the input files of the job
+    :return: hex digest
+    """
+    h = hashlib.sha1()
+    for line in without_timestamp(job):
+        h.update(line.encode())
+        h.update(b"\n")
+    for digest in input_hashes:
+        h.update(digest.encode())
+    return h.hexdigest()
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cached_scan(inputfile, entry=None, use_hash=False):
+    """
+    Scan an input file, unless a cache entry shows that it is unchanged since the last scan
+    :param inputfile: path to input file, including extension
+    :param entry: cache entry (mtime_ns, size, hash, manifest) for the input file, or None
+    :param use_hash: also compare the SHA-1 of the file contents, for file systems with unreliable mtimes
+    :return: manifest, and a record for cache.store if the cache entry must be updated (else None)
+    """
+    st = os.stat(inputfile)
+    digest = file_hash(inputfile) if use_hash else None
+    if entry is not None:
+        mtime, size, cached_digest, manifest = entry
+        if mtime == st.st_mtime_ns and size == st.st_size and (not use_hash or digest == cached_digest):
+            return manifest, None
+    manifest = scan_input(inputfile)
+    return manifest, (os.path.abspath(inputfile), st.st_mtime_ns, st.st_size, digest, manifest)
+
+
+def main(argv=None):
+    """Command-line interface for inspecting and pruning the classification cache"""
+    parser = argparse.ArgumentParser(prog="slurmify.py cache",
+                                     description="Inspect or prune the input classification cache of a directory")
+    parser.add_argument("action", choices=["show", "prune", "clear"],
+                        help="show: list cached entries, prune: drop entries of changed or deleted inputs, clear: delete the cache")
+    parser.add_argument("directory", nargs="?", default=".", help="Directory containing the cache")
+    args = parser.parse_args(argv)
+
+    path = os.path.join(args.directory, CACHE_NAME)
+    if not os.path.isfile(path):
+        sys.exit(f"No cache found in {args.directory}")
+
+    if args.action == "clear":
+        os.remove(path)
+        print(f"Removed {path}")
+        return
+
+    entries = load(path)
+    if args.action == "show":
+        counts = {}
+        for p, (mtime, size, digest, manifest) in sorted(entries.items()):
+            counts[manifest["program"]] = counts.get(manifest["program"], 0) + 1
+            refs = ", ".join(f"{key}={value}" for key, value in manifest.items() if key != "program" and value)
+            print(f"{manifest['program']:<9} {p}" + (f"  [{refs}]" if refs else ""))
+        print(f"{len(entries)} entries: " + ", ".join(f"{n} {program}" for program, n in sorted(counts.items())))
+        print(f"{len(load_jobs(path))} job digests")
+    elif args.action == "prune":
+        jobs = [p for p in load_jobs(path) if not os.path.isfile(p)]
+        stale = []
+        for p, (mtime, size, digest, manifest) in entries.items():
+            try:
+                st = os.stat(p)
+            except FileNotFoundError:
+                stale.append(p)
+                continue
+            if st.st_mtime_ns != mtime or st.st_size != size:
+                stale.append(p)
+        conn = connect(path)
+        try:
+            with conn:
+                conn.executemany("DELETE FROM manifests WHERE path = ?", [(p,) for p in stale])
+                conn.executemany("DELETE FROM jobs WHERE path = ?", [(p,) for p in jobs])
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+        print(f"Pruned {len(stale)} of {len(entries)} entries and {len(jobs)} digests of deleted job files")
+
+
+if __name__ == "__main__":
+    main()
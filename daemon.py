@@ -0,0 +1,271 @@
+"""
+Long-running Slurmify daemon that keeps the configuration, the detected cluster, and the compiled
+job-script templates in memory, and serves render and submit requests over a Unix domain socket.
+
+$ slurmify.py serve [--socket PATH]
+
+The protocol is one JSON object per line in each direction. A request names an operation in
+"op", and the response is {"ok": true, "result": ...} or {"ok": false, "error": <exception
+class name>, "message": ...}. Warnings issued while rendering are returned in "warnings".
+
+    ping                                   -> {"pid", "cluster", "templates"}
+    render       spec, cwd                 -> job script
+    render_many  specs, cwd                -> list of job scripts, or {"error", "message"} per failed spec
+    write        spec, cwd, path           -> path of the written job file
+    submit       jobfiles, command, extra_args, retries, ledger
+                                           -> {"jobids": {jobfile: jobid}, "errors": {jobfile: message}}
+    shutdown                               -> null
+
+Job specs are those of api.py, and file names in them are relative to "cwd". The sbatch calls of
+all clients share one thread pool, so concurrent clients cannot overload slurmctld.
+"""
+import os
+import sys
+import json
+import socket
+import argparse
+import tempfile
+import warnings
+import threading
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+
+
+def default_socket():
+    """Per-user socket path, overridden by the SLURMIFY_SOCKET environment variable"""
+    directory = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.environ.get("SLURMIFY_SOCKET") or os.path.join(directory, f"slurmify-{os.getuid()}.sock")
+
+
+class DaemonError(Exception):
+    """An error raised by the daemon while handling a request"""
+
+    def __init__(self, error, message):
+        super().__init__(f"{error}: {message}")
+        self.error = error
+        self.message = message
+
+
+#########################################################
+# Server
+#########################################################
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            response = self.server.handle_request_line(line)
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            if self.server.stopping:
+                return
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, submit_workers=8):
+        # Rendering changes the working directory, so only one request renders at a time.
+        # A render takes tens of microseconds, so this is not a bottleneck.
+        self.render_lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, submit_workers))
+        self.stopping = False
+        super().__init__(path, Handler)
+
+    def handle_request_line(self, line):
+        try:
+            request = json.loads(line)
+            op = request.get("op")
+            if op not in OPERATIONS:
+                raise ValueError(f"Unknown operation: {op}")
+            if op == "submit":
+                return dict(ok=True, result=OPERATIONS[op](self, request))
+            with self.render_lock, warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                result = OPERATIONS[op](self, request)
+            return dict(ok=True, result=result, warnings=[str(w.message) for w in caught])
+        except Exception as e:  # every error is reported to the client instead of killing the connection
+            return dict(ok=False, error=type(e).__name__, message=str(e))
+
+
+def in_directory(cwd, function, *args):
+    previous = os.getcwd()
+    os.chdir(cwd or previous)
+    try:
+        return function(*args)
+    finally:
+        os.chdir(previous)
+
+
+def op_ping(server, request):
+    import api
+    import utils
+
+    return dict(pid=os.getpid(), cluster=api.defaults()["cluster"], templates=len(utils._TEMPLATES))
+
+
+def op_render(server, request):
+    import api
+
+    return in_directory(request.get("cwd"), api.render, request["spec"])
+
+
+def op_render_many(server, request):
+    import api
+
+    scripts = in_directory(request.get("cwd"), api.render_many, request["specs"], True)
+    return [dict(error=type(s).__name__, message=str(s)) if isinstance(s, Exception) else s for s in scripts]
+
+
+def op_write(server, request):
+    import api
+
+    return in_directory(request.get("cwd"), lambda: os.path.abspath(api.write(request["spec"], request.get("path"))))
+
+
+def op_submit(server, request):
+    from submit import submit_jobs, SBATCH
+
+    jobfiles = [os.path.join(request.get("cwd") or "", jobfile) for jobfile in request["jobfiles"]]
+    jobids, errors = submit_jobs(jobfiles, command=request.get("command") or SBATCH,
+                                 retries=request.get("retries", 5), ledger=request.get("ledger"),
+                                 extra_args=request.get("extra_args", ()), silent=True, pool=server.pool)
+    return dict(jobids=jobids, errors=errors)
+
+
+def op_shutdown(server, request):
+    server.stopping = True
+    threading.Thread(target=server.shutdown).start()
+
+
+OPERATIONS = dict(ping=op_ping, render=op_render, render_many=op_render_many, write=op_write,
+                  submit=op_submit, shutdown=op_shutdown)
+
+
+def serve(path=None, submit_workers=8, silent=False):
+    """
+    Run the daemon until it receives a shutdown request or is interrupted
+    :param path: path of the Unix socket. Defaults to default_socket()
+    :param submit_workers: maximum number of concurrent sbatch calls, shared by all clients
+    :param silent: do not report start and stop
+    """
+    import api
+    import utils
+
+    path = path or default_socket()
+    if os.path.exists(path):
+        try:
+            Client(path).close()
+            sys.exit(f"A Slurmify daemon is already listening on {path}")
+        except OSError:
+            os.remove(path)  # left behind by a daemon that did not shut down cleanly
+
+    # Warm up: load the configuration and compile the templates of the detected cluster
+    defaults = api.defaults()
+    for program in api.PROGRAMS:
+        try:
+            api.render(dict(input="warmup", program=program, memory="1GB"))
+        except utils.SlurmifyError:
+            pass
+
+    old_umask = os.umask(0o177)
+    try:
+        server = Daemon(path, submit_workers=submit_workers)
+    finally:
+        os.umask(old_umask)
+    if not silent:
+        print(f"Slurmify daemon (pid {os.getpid()}, cluster {defaults['cluster']}) listening on {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.shutdown()
+        if os.path.exists(path):
+            os.remove(path)
+    if not silent:
+        print("Slurmify daemon stopped")
+
+
+#########################################################
+# Client
+#########################################################
+
+class Client:
+    """
+    Connection to a running daemon. The connection is kept open between requests, so that
+    every request only costs a round trip over the socket.
+    """
+
+    def __init__(self, path=None, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(path or default_socket())
+        except OSError:
+            self.sock.close()
+            raise
+        self.stream = self.sock.makefile("rb")
+        self.warnings = []
+
+    def request(self, op, **kwargs):
+        """
+        Send a request and wait for the response
+        :return: result of the request
+        :raises DaemonError: if the daemon reported an error
+        """
+        self.sock.sendall(json.dumps(dict(kwargs, op=op)).encode() + b"\n")
+        line = self.stream.readline()
+        if not line:
+            raise ConnectionError("The Slurmify daemon closed the connection")
+        response = json.loads(line)
+        if not response["ok"]:
+            raise DaemonError(response["error"], response["message"])
+        self.warnings = response.get("warnings", [])
+        return response["result"]
+
+    def render(self, spec, cwd=None):
+        return self.request("render", spec=spec, cwd=cwd or os.getcwd())
+
+    def render_many(self, specs, cwd=None):
+        return self.request("render_many", specs=specs, cwd=cwd or os.getcwd())
+
+    def write(self, spec, path=None, cwd=None):
+        return self.request("write", spec=spec, path=path, cwd=cwd or os.getcwd())
+
+    def submit(self, jobfiles, command=None, extra_args=(), retries=5, ledger=None, cwd=None):
+        return self.request("submit", jobfiles=list(jobfiles), command=command, extra_args=list(extra_args),
+                            retries=retries, ledger=ledger and os.path.abspath(ledger), cwd=cwd or os.getcwd())
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    """Command-line interface for running and stopping the daemon"""
+    parser = argparse.ArgumentParser(prog="slurmify.py serve",
+                                     description="Serve job generation and submission over a Unix socket")
+    parser.add_argument("--socket", metavar="<>", type=str, help=f"[str] Path of the socket (default: {default_socket()})")
+    parser.add_argument("--submit_workers", metavar="<>", type=int, default=8, help="[int] Maximum number of concurrent sbatch calls")
+    parser.add_argument("--stop", action="store_true", help="Stop the daemon listening on the socket")
+    parser.add_argument("-S", "--silent", action="store_true", help="Run in silent mode")
+    args = parser.parse_args(argv)
+
+    if args.stop:
+        try:
+            with Client(args.socket) as client:
+                client.request("shutdown")
+        except OSError:
+            sys.exit(f"No Slurmify daemon is listening on {args.socket or default_socket()}")
+        return
+    serve(args.socket, submit_workers=args.submit_workers, silent=args.silent)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""
+Submission feeder for campaigns larger than the number of jobs the account may have in the queue.
+
+Submitting thousands of jobs at once fails partway with QOSMaxSubmitJobPerUserLimit (jobs held
+back by GrpTRES limits are accepted, and simply wait). The feeder instead keeps the generated job
+files in a persistent queue, and submits only as many as there are free slots:
+
+    1. one 'squeue' call counts the jobs (and array tasks) the user has in the queue,
+    2. up to --max_jobs minus that many queued job files are submitted, oldest first,
+    3. it sleeps for --interval seconds, and repeats until the queue is drained.
+
+Every job is submitted with '--comment=slurmify_feed:<queue>:<id>' and recorded as 'submitting'
+before sbatch runs. If the feeder is killed and restarted, such jobs are looked up by their
+comment in squeue, so that no job is submitted twice. Jobs that cannot be found are set to
+'unknown' instead of being submitted again; requeue them with 'add -f' after checking.
+
+$ slurmify.py -B campaign/ -m 10GB --feed            generate the jobs and add them to the queue
+$ slurmify.py feed add jobs/*.job                    add existing job files
+$ slurmify.py feed run --max_jobs 400 [--once]       submit until the queue is drained
+$ slurmify.py feed status
+
+The commands can be pointed at a fake Slurm for testing with --sbatch and --squeue (or
+SLURMIFY_SBATCH and SLURMIFY_SQUEUE), e.g. benchmarks/fakeslurm.py.
+"""
+import os
+import sys
+import time
+import shlex
+import getpass
+import hashlib
+import sqlite3
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from submit import sbatch, SubmissionError, SBATCH
+
+QUEUE = os.environ.get("SLURMIFY_FEED", ".slurmify_feed.sqlite")
+
+# Command used to list the jobs in the queue. Can be pointed at a fake squeue for testing
+SQUEUE = os.environ.get("SLURMIFY_SQUEUE", "squeue")
+
+# sbatch errors meaning that the queue is full, rather than that the job is broken
+LIMIT_ERRORS = ["QOSMaxSubmitJobPerUserLimit", "AssocMaxSubmitJobLimit", "MaxSubmitJobsPerAccount",
+                "Job violates accounting/QOS policy"]
+
+STATES = ["pending", "submitting", "submitted", "failed", "unknown"]
+
+
+def connect(path=None):
+    conn = sqlite3.connect(path or QUEUE)
+    conn.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, path TEXT UNIQUE, bundle TEXT, "
+                 "offset INTEGER, size INTEGER, tasks INTEGER, state TEXT, jobid TEXT, message TEXT, "
+                 "added REAL, submitted REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+    return conn
+
+
+def queue_tag(path=None):
+    """Prefix of the comments of the jobs submitted from a queue, unique per queue file"""
+    return "slurmify_feed:" + hashlib.sha1(os.path.abspath(path or QUEUE).encode()).hexdigest()[:8]
+
+
+def array_tasks(script):
+    """
+    Number of jobs a job script counts as towards the submit limit
+    :param script: job script as a string
+    :return: number of array tasks, or 1 if it is not an array job
+    """
+    for line in script.splitlines():
+        if line.startswith("#SBATCH --array="):
+            tasks = 0
+            for part in line.split("=", 1)[1].split("%")[0].split(","):
+                bounds, _, step = part.partition(":")
+                first, _, last = bounds.partition("-")
+                tasks += (int(last or first) - int(first)) // int(step or 1) + 1
+            return tasks
+        if line and not line.startswith("#"):
+            break
+    return 1
+
+
+def enqueue(jobfiles, path=None, bundle=None, force=False):
+    """
+    Add job files to the queue
+    :param jobfiles: list of paths to job files
+    :param path: path to the queue file
+    :param bundle: closed sink.Bundle holding the job files, if they are not on disk
+    :param force: queue job files again that were submitted (or failed) before
+    :return: number of job files added, and number that were already in the queue
+    """
+    rows = []
+    for jobfile in jobfiles:
+        jobfile = os.path.abspath(jobfile)
+        if bundle is not None:
+            script = bundle.read(jobfile)
+            offset, size = bundle.members[bundle.member(jobfile)]
+            rows.append((jobfile, bundle.path, offset, size, array_tasks(script)))
+        else:
+            with open(jobfile) as f:
+                rows.append((jobfile, None, None, None, array_tasks(f.read())))
+
+    conn = connect(path)
+    try:
+        with conn:
+            before = conn.total_changes
+            now = time.time()
+            if force:
+                conn.executemany("UPDATE jobs SET bundle = ?, offset = ?, size = ?, tasks = ?, state = 'pending', "
+                                 "jobid = NULL, message = NULL, added = ? WHERE path = ? AND state != 'submitting'",
+                                 [row[1:] + (now, row[0]) for row in rows])
+            conn.executemany("INSERT OR IGNORE INTO jobs (path, bundle, offset, size, tasks, state, added) "
+                             "VALUES (?, ?, ?, ?, ?, 'pending', ?)", [row + (now,) for row in rows])
+            added = conn.total_changes - before
+    finally:
+        conn.close()
+    return added, len(rows) - added
+
+
+def read_script(bundle, offset, size):
+    """Contents of a queued job file in a bundle. None if the job file is on disk"""
+    if bundle is None:
+        return None
+    with open(bundle, "rb") as f:
+        f.seek(offset)
+        return f.read(size).decode()
+
+
+def queued_jobs(command=SQUEUE, user=None):
+    """
+    Jobs of the user in the queue, from a single squeue call. Array tasks are counted separately.
+    :return: number of jobs, and dict mapping the comments of the jobs to their job IDs
+    """
+    args = shlex.split(command) + ["--noheader", "--array", "--user", user or getpass.getuser(), "--format", "%i %k"]
+    result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise OSError(f"squeue failed: {result.stderr.strip()}")
+    count, comments = 0, {}
+    for line in result.stdout.splitlines():
+        jobid, _, comment = line.strip().partition(" ")
+        if jobid:
+            count += 1
+            comments[comment] = jobid.split("_")[0]
+    return count, comments
+
+
+def reconcile(conn, tag, comments):
+    """
+    Resolve the jobs left 'submitting' by a feeder that was stopped while calling sbatch
+    :param tag: queue tag (see queue_tag)
+    :param comments: dict mapping comments to job IDs of the jobs in the queue
+    :return: number of jobs found in the queue, and number of jobs not found
+    """
+    found = lost = 0
+    with conn:
+        for rowid, in conn.execute("SELECT id FROM jobs WHERE state = 'submitting'").fetchall():
+            jobid = comments.get(f"{tag}:{rowid}")
+            if jobid is not None:
+                conn.execute("UPDATE jobs SET state = 'submitted', jobid = ? WHERE id = ?", (jobid, rowid))
+                found += 1
+            else:
+                conn.execute("UPDATE jobs SET state = 'unknown', message = 'not in the queue after a restart' "
+                             "WHERE id = ?", (rowid,))
+                lost += 1
+    return found, lost
+
+
+def submit_free(conn, tag, free, command=SBATCH, workers=8, retries=5, silent=False):
+    """
+    Submit the oldest pending jobs that fit into the free slots
+    :param tag: queue tag (see queue_tag)
+    :param free: number of jobs (array tasks) that can be added to the queue
+    :return: number of jobs submitted, and whether sbatch reported that the queue is full
+    """
+    batch, tasks = [], 0
+    for row in conn.execute("SELECT id, path, bundle, offset, size, tasks FROM jobs WHERE state = 'pending' ORDER BY id"):
+        if tasks + row[5] > free:
+            break
+        batch.append(row)
+        tasks += row[5]
+    if not batch:
+        return 0, False
+    with conn:
+        conn.executemany("UPDATE jobs SET state = 'submitting' WHERE id = ?", [(row[0],) for row in batch])
+
+    def submit(rowid, path, bundle, offset, size, _):
+        return sbatch(path, command=command, extra_args=[f"--comment={tag}:{rowid}"], retries=retries,
+                      script=read_script(bundle, offset, size))
+
+    submitted, full = 0, False
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(submit, *row): row for row in batch}
+        for future in as_completed(futures):
+            rowid, path = futures[future][:2]
+            try:
+                jobid = future.result()
+            except SubmissionError as e:
+                if any(error in str(e) for error in LIMIT_ERRORS):
+                    full = True
+                    state, message = "pending", None
+                else:
+                    state, message = "failed", str(e)
+                    print(f"Failed to submit {e}", file=sys.stderr)
+                with conn:
+                    conn.execute("UPDATE jobs SET state = ?, message = ? WHERE id = ?", (state, message, rowid))
+                continue
+            # Record every job ID right away, so that a restart finds as few 'submitting' jobs as possible
+            with conn:
+                conn.execute("UPDATE jobs SET state = 'submitted', jobid = ?, submitted = ? WHERE id = ?",
+                             (jobid, time.time(), rowid))
+            submitted += 1
+            if not silent:
+                print(f"Submitted batch job {jobid} ({path})")
+    return submitted, full
+
+
+def counts(conn):
+    result = dict.fromkeys(STATES, 0)
+    result.update(conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+    return result
+
+
+def run(path=None, max_jobs=400, interval=60.0, once=False, command=SBATCH, squeue=SQUEUE, workers=8, retries=5,
+        silent=False, squeue_retries=10):
+    """
+    Submit the queued jobs as slots free up, until none are pending
+    :param path: path to the queue file
+    :param max_jobs: number of jobs (array tasks) the user may have in the queue, e.g. MaxSubmitJobs
+    :param interval: seconds between two squeue calls
+    :param once: only fill the free slots once
+    :param command: sbatch command
+    :param squeue: squeue command
+    :param workers: maximum number of concurrent sbatch calls
+    :param retries: number of retries on transient sbatch errors
+    :param silent: do not print every submitted job
+    :param squeue_retries: number of failed squeue calls in a row after which the feeder gives up
+    :return: dict mapping state to number of jobs
+    :raises OSError: if squeue cannot be run, or keeps failing (at once with once)
+    """
+    tag = queue_tag(path)
+    conn = connect(path)
+    try:
+        with conn:
+            # These would never fit
+            conn.execute("UPDATE jobs SET state = 'failed', message = 'more array tasks than --max_jobs' "
+                         "WHERE state = 'pending' AND tasks > ?", (max_jobs,))
+        first, failures = True, 0
+        while True:
+            try:
+                occupied, comments = queued_jobs(squeue)
+            except FileNotFoundError:
+                raise
+            except OSError as e:
+                # slurmctld may be busy; try again at the next interval
+                failures += 1
+                if once or failures > squeue_retries:
+                    raise
+                print(f"{e}. Retrying in {interval:g} s", file=sys.stderr)
+                time.sleep(interval)
+                continue
+            failures = 0
+            if first:
+                found, lost = reconcile(conn, tag, comments)
+                if lost:
+                    print(f"{lost} jobs were being submitted when the feeder stopped, and are not in the queue. "
+                          f"Check them with 'slurmify.py feed status', and requeue them with 'add -f'", file=sys.stderr)
+                first = False
+
+            submitted, full = submit_free(conn, tag, max_jobs - occupied, command=command, workers=workers,
+                                          retries=retries, silent=silent)
+            state = counts(conn)
+            print(f"{time.strftime('%H:%M:%S')} {occupied} jobs in the queue, submitted {submitted}"
+                  f"{' (submit limit reached)' if full else ''}, {state['pending']} pending")
+            if once or not state["pending"]:
+                return state
+            time.sleep(interval)
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    """Command-line interface of the feeder"""
+    parser = argparse.ArgumentParser(prog="slurmify.py feed",
+                                     description="Submit a large number of job files as the queue limits allow")
+    parser.add_argument("action", choices=["add", "run", "status"],
+                        help="add: queue job files, run: submit queued jobs as slots free up, status: count jobs per state")
+    parser.add_argument("files", nargs="*", help="add: job files")
+    parser.add_argument("--queue", metavar="<>", type=str, default=QUEUE, help=f"[str] Queue file (default: {QUEUE})")
+    parser.add_argument("-f", "--force", action="store_true", help="add: queue job files again that were submitted before")
+    parser.add_argument("--max_jobs", metavar="<>", type=int, default=400, help="[int] run: number of jobs (array tasks) the user may have in the queue")
+    parser.add_argument("--interval", metavar="<>", type=float, default=60, help="[float] run: seconds between two squeue calls")
+    parser.add_argument("--once", action="store_true", help="run: fill the free slots once and exit")
+    parser.add_argument("--sbatch", metavar="<>", type=str, default=SBATCH, help="[str] Command used to submit jobs")
+    parser.add_argument("--squeue", metavar="<>", type=str, default=SQUEUE, help="[str] Command used to list the jobs in the queue")
+    parser.add_argument("--submit_workers", metavar="<>", type=int, default=8, help="[int] Maximum number of concurrent sbatch calls")
+    parser.add_argument("--retries", metavar="<>", type=int, default=5, help="[int] Number of retries on transient sbatch errors")
+    parser.add_argument("--squeue_retries", metavar="<>", type=int, default=10, help="[int] run: number of failed squeue calls in a row after which to give up")
+    parser.add_argument("-S", "--silent", action="store_true", help="Do not print every submitted job")
+    args = parser.parse_args(argv)
+
+    if args.action == "add":
+        missing = [jobfile for jobfile in args.files if not os.path.isfile(jobfile)]
+        if missing:
+            sys.exit(f"Job files not found: {', '.join(missing)}")
+        added, existing = enqueue(args.files, path=args.queue, force=args.force)
+        print(f"Added {added} job files to {args.queue}" + (f" ({existing} were queued before)" if existing else ""))
+    elif args.action == "run":
+        try:
+            state = run(args.queue, max_jobs=args.max_jobs, interval=args.interval, once=args.once, command=args.sbatch,
+                        squeue=args.squeue, workers=args.submit_workers, retries=args.retries, silent=args.silent,
+                        squeue_retries=args.squeue_retries)
+        except OSError as e:
+            sys.exit(f"Cannot list the jobs in the queue: {e}")
+        return 1 if state["failed"] or state["unknown"] else 0
+    elif args.action == "status":
+        if not os.path.isfile(args.queue):
+            sys.exit(f"No queue found in {args.queue}")
+        conn = connect(args.queue)
+        try:
+            print(", ".join(f"{n} {state}" for state, n in counts(conn).items()))
+            for path, state, message in conn.execute("SELECT path, state, message FROM jobs "
+                                                     "WHERE state IN ('failed', 'unknown') ORDER BY id"):
+                print(f"{state:<8} {path}: {message}")
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
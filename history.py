@@ -0,0 +1,739 @@
+"""
+History of completed jobs, for reporting where the core hours go and for predicting the
+memory and walltime of new ones.
+
+Runs are ingested from sacct, from a saved 'sacct --parsable2' dump, or from the .log files of
+Slurmify jobs (which end with the usage tables printed by the SLURM epilog). Each run is
+stored with its usage (elapsed and CPU time, memory high-water mark, billing units, queue wait)
+and the features of its input file: the program, the method/basis keywords, and the number of
+atoms. Jobs without a Slurmify input file are recorded without features. Ingesting is
+incremental: recorded jobs and unchanged log files and dumps are skipped, and sacct is only
+queried for the jobs since the previous query. The first query, without --since, asks for all
+jobs since FIRST_QUERY, as sacct on its own only lists the jobs of the current day.
+
+$ slurmify.py history ingest [--since 2021-01-01]    # runs of the user, from sacct
+$ slurmify.py history ingest --sacct_file dump.txt   # saved 'sacct --parsable2' output
+$ slurmify.py history ingest */*.log                 # usage tables in job logs
+$ slurmify.py history show
+$ slurmify.py history suggest molecule.inp [-q 0.9]
+$ slurmify.py history report [--by program cluster account] [--since 2021-01-01]
+
+With --predict, the memory and walltime of a job are filled in with the given quantile of
+completed runs of inputs with the same program and keywords and (about) the same number of
+atoms, plus a safety margin.
+"""
+import os
+import re
+import sys
+import math
+import time
+import shlex
+import datetime
+import sqlite3
+import argparse
+import warnings
+import subprocess
+
+from utils import scan_input, memory_gb, billing_units, SettingsError, SlurmifyWarning
+
+HISTORY = os.environ.get("SLURMIFY_HISTORY", os.path.expanduser("~/.slurmify_history.sqlite"))
+
+# Command used to query the accounting database. Can be pointed at a fake sacct for testing
+SACCT = os.environ.get("SLURMIFY_SACCT", "sacct")
+SACCT_FORMAT = ("JobID,JobName,State,Elapsed,Timelimit,MaxRSS,ReqMem,NTasks,NNodes,AllocCPUS,WorkDir,Submit,Start,End,"
+                "Cluster,Account,Partition,TotalCPU,AllocTRES")
+
+# Start of the first sacct query, when neither --since nor an earlier query gives one
+FIRST_QUERY = "1970-01-01"
+
+# Predictions need at least this many matching runs
+MIN_SAMPLES = 3
+
+# Predicted values are multiplied by this factor
+MARGIN = 1.2
+
+# Fallbacks when there are not enough runs with exactly the same number of atoms
+NATOMS_TOLERANCE = 0.25
+
+
+#########################################################
+# Features of input files
+#########################################################
+
+def input_features(inputfile):
+    """
+    Features of an input file that determine the resources of the job
+    :param inputfile: path to input file, including extension
+    :return: dict with "program", "keywords" (sorted, lower-case method/basis keywords joined by
+             spaces), and "natoms" (0 if the geometry is read from elsewhere)
+    """
+    program = scan_input(inputfile, aux=False)["program"]
+    with open(inputfile) as f:
+        lines = [line.strip() for line in f]
+
+    keywords, natoms = set(), 0
+    if program == "orca":
+        in_coords = False
+        for line in lines:
+            squeezed = "".join(line.split()).lower()
+            if in_coords:
+                if line.startswith("*"):
+                    in_coords = False
+                elif line and not line.startswith("#"):
+                    natoms += 1
+            elif line.startswith("!"):
+                keywords.update(line[1:].lower().split())
+            elif squeezed.startswith("*xyzfile"):
+                natoms = xyzfile_atoms(os.path.join(os.path.dirname(inputfile), line.split()[-1]))
+            elif squeezed.startswith("*xyz"):
+                in_coords = True
+    elif program == "gaussian":
+        # Link 0 commands, route section, title section, charge and multiplicity, atoms
+        section = "link0"
+        for line in lines:
+            if section == "link0" and line.startswith("#"):
+                section = "route"
+            if section == "route":
+                if not line:
+                    section = "title"
+                    continue
+                keywords.update(word for word in line.lower().split() if word not in ("#", "#p", "#n", "#t"))
+                keywords.update(word[2:] for word in line.lower().split() if word[:2] in ("#p", "#n", "#t") and len(word) > 2)
+            elif section == "title" and not line:
+                section = "charge"
+            elif section == "charge":
+                section = "atoms"
+            elif section == "atoms":
+                if not line:
+                    break
+                natoms += 1
+    else:
+        in_coords = False
+        for line in lines:
+            squeezed = "".join(line.split()).lower()
+            if squeezed.startswith("$coords"):
+                in_coords = True
+            elif squeezed.startswith("$end"):
+                in_coords = False
+            elif in_coords and line:
+                natoms += 1
+            elif squeezed.startswith("method="):
+                keywords.add(squeezed.split("=", 1)[1].strip("\"'"))
+            elif squeezed.startswith("world_prec="):
+                keywords.add("prec=" + squeezed.split("=", 1)[1])
+    return dict(program=program, keywords=" ".join(sorted(keywords)), natoms=natoms)
+
+
+def xyzfile_atoms(path):
+    try:
+        with open(path) as f:
+            return int(f.readline())
+    except (OSError, ValueError):
+        return 0
+
+
+#########################################################
+# Parsing accounting data
+#########################################################
+
+def duration_seconds(value):
+    """Seconds of a SLURM duration such as '1-02:03:04', '02:03:04', or '03:04.567'. None if unlimited or empty"""
+    if not value or value in ("UNLIMITED", "Partition_Limit", "INVALID"):
+        return None
+    days, _, clock = value.rpartition("-")
+    seconds = 0.0
+    for part in clock.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds + 86400 * int(days or 0)
+
+
+def sacct_memory_gb(value, cores=1, nodes=1):
+    """
+    GB of a SLURM memory value such as '123456K' or '4000Mc'. Memory per CPU ('c') or per node
+    ('n') is converted to the memory of a node
+    """
+    if not value:
+        return None
+    scale = 1
+    if value[-1] in "cn":
+        scale = cores / max(nodes, 1) if value[-1] == "c" else 1
+        value = value[:-1]
+    units = {"K": 1 / 1024**2, "M": 1 / 1024, "G": 1, "T": 1024}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]] * scale
+    return float(value) / 1024**3 * scale
+
+
+def parse_sacct(text):
+    """
+    Parse the output of 'sacct --parsable2' (with header)
+    :return: list of dicts, one per line, keyed by the column names
+    """
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return []
+    columns = lines[0].split("|")
+    return [dict(zip(columns, line.split("|"))) for line in lines[1:]]
+
+
+def parse_tables(text):
+    """
+    Parse the fixed-width tables printed by sacct without --parsable2, as found at the end of
+    job logs: a header line, a line of dashes marking the columns, and one line per job step
+    :return: list of dicts, one per row, keyed by the column names
+    """
+    rows = []
+    lines = text.splitlines()
+    for i in range(1, len(lines)):
+        if not lines[i].strip() or set(lines[i]) - {"-", " "}:
+            continue
+        spans = [match.span() for match in re.finditer("-+", lines[i])]
+        columns = [lines[i - 1][start:end].strip() for start, end in spans]
+        for line in lines[i + 1:]:
+            if not line.strip():
+                break
+            rows.append({column: line[start:end].strip() for column, (start, end) in zip(columns, spans)})
+    return rows
+
+
+def timestamp_seconds(value):
+    """Epoch seconds of a SLURM timestamp such as '2021-01-31T12:00:00'. None if unknown"""
+    if not value or value in ("Unknown", "None"):
+        return None
+    # Sliced by hand, as time.strptime dominates the time of ingesting large sacct dumps
+    return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]),
+                             int(value[14:16]), int(value[17:19])).timestamp()
+
+
+def tres_billing(value):
+    """Billing units in an AllocTRES value such as 'billing=40,cpu=40,mem=100G,node=1'"""
+    for item in (value or "").split(","):
+        key, _, amount = item.partition("=")
+        if key == "billing":
+            return float(amount)
+    return None
+
+
+def aggregate(rows):
+    """
+    Combine the rows of the job steps of each job into one run
+    :param rows: dicts keyed by sacct column names
+    :return: dict mapping job ID to run dict with name, state, workdir, cluster, account, partition,
+             elapsed, timelimit and cputime (seconds), maxrss and reqmem (GB per node), cores, billing,
+             and submitted, started and finished (epoch seconds)
+    """
+    runs = {}
+    for row in rows:
+        if not row.get("JobID"):
+            continue
+        jobid, _, step = row["JobID"].partition(".")
+        run = runs.get(jobid)
+        if run is None:
+            run = runs[jobid] = dict.fromkeys(("name", "state", "workdir", "cluster", "account", "partition", "elapsed",
+                                               "timelimit", "cputime", "maxrss", "reqmem", "cores", "billing",
+                                               "submitted", "started", "finished"))
+            run["step_cputime"] = 0.0
+        cores = int(row["AllocCPUS"]) if row.get("AllocCPUS", "").isdigit() else None
+        nodes = int(row["NNodes"]) if row.get("NNodes", "").isdigit() else 1
+        ntasks = int(row["NTasks"]) if row.get("NTasks", "").isdigit() else 1
+        if not step:
+            # The columns may be spread over several tables (job logs), so only fill in what is given
+            state = (row.get("State") or "").split()
+            run["name"] = row.get("JobName") or run["name"]
+            run["state"] = state[0] if state else run["state"]
+            for key, column in (("workdir", "WorkDir"), ("cluster", "Cluster"), ("account", "Account"),
+                                ("partition", "Partition")):
+                run[key] = row.get(column) or run[key]
+            run["timelimit"] = duration_seconds(row.get("Timelimit")) or run["timelimit"]
+            run["reqmem"] = sacct_memory_gb(row.get("ReqMem"), cores or 1, nodes) or run["reqmem"]
+            run["cores"] = cores or run["cores"]
+            run["cputime"] = duration_seconds(row.get("TotalCPU")) or run["cputime"]
+            run["billing"] = tres_billing(row.get("AllocTRES")) or run["billing"]
+            run["submitted"] = timestamp_seconds(row.get("Submit")) or run["submitted"]
+            run["started"] = timestamp_seconds(row.get("Start")) or run["started"]
+            run["finished"] = timestamp_seconds(row.get("End")) or run["finished"]
+        elif row.get("AveCPU"):
+            # Job logs only have the average CPU time of the tasks of each step
+            run["step_cputime"] += (duration_seconds(row["AveCPU"]) or 0) * ntasks
+        elapsed = duration_seconds(row.get("Elapsed"))
+        if elapsed is not None:
+            run["elapsed"] = max(run["elapsed"] or 0, elapsed)
+        # MaxRSS is that of the largest task of a step. Count all tasks of the step on a node
+        maxrss = sacct_memory_gb(row.get("MaxRSS"))
+        if maxrss:
+            run["maxrss"] = max(run["maxrss"] or 0, maxrss * math.ceil(ntasks / max(nodes, 1)))
+    for run in runs.values():
+        step_cputime = run.pop("step_cputime")
+        run["cputime"] = run["cputime"] or step_cputime or None
+    return runs
+
+
+def sbatch_requests(jobfile):
+    """Requested memory (GB), time (seconds), account, and partition in the #SBATCH lines of a job file"""
+    requests = dict(reqmem=None, timelimit=None, account=None, partition=None)
+    try:
+        with open(jobfile) as f:
+            for line in f:
+                if line.startswith("#SBATCH --mem="):
+                    requests["reqmem"] = memory_gb(line.split("=", 1)[1].strip())
+                elif line.startswith("#SBATCH --time="):
+                    requests["timelimit"] = duration_seconds(line.split("=", 1)[1].strip())
+                elif line.startswith("#SBATCH --account="):
+                    requests["account"] = line.split("=", 1)[1].strip()
+                elif line.startswith("#SBATCH --partition="):
+                    requests["partition"] = line.split("=", 1)[1].strip()
+    except (OSError, SettingsError):
+        pass
+    return requests
+
+
+def log_state(errfile):
+    """State of a job from the messages of slurmstepd in its .err file"""
+    try:
+        with open(errfile, errors="replace") as f:
+            for line in f:
+                if "DUE TO TIME LIMIT" in line:
+                    return "TIMEOUT"
+                if "oom-kill" in line or "Out Of Memory" in line:
+                    return "OUT_OF_MEMORY"
+                if "CANCELLED" in line:
+                    return "CANCELLED"
+    except OSError:
+        pass
+    return "COMPLETED"
+
+
+#########################################################
+# History database
+#########################################################
+RUN_COLUMNS = {"jobid": "TEXT PRIMARY KEY", "program": "TEXT", "keywords": "TEXT", "natoms": "INTEGER",
+               "state": "TEXT", "cores": "INTEGER", "elapsed": "REAL", "timelimit": "REAL", "maxrss": "REAL",
+               "reqmem": "REAL", "input": "TEXT", "finished": "REAL", "cluster": "TEXT", "account": "TEXT",
+               "partition": "TEXT", "cputime": "REAL", "billing": "REAL", "submitted": "REAL", "started": "REAL"}
+
+# Jobs in these states are not recorded yet, as their usage is not final
+UNFINISHED = {"PENDING", "RUNNING", "REQUEUED", "RESIZING", "SUSPENDED"}
+
+
+def connect(path=None):
+    conn = sqlite3.connect(path or HISTORY)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS runs ({', '.join(f'{name} {kind}' for name, kind in RUN_COLUMNS.items())})")
+    # Add the columns missing in histories written by older versions
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(runs)")}
+    for name, kind in RUN_COLUMNS.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE runs ADD COLUMN {name} {kind}")
+    conn.execute("CREATE INDEX IF NOT EXISTS runs_features ON runs (program, keywords, natoms)")
+    # Sources that were ingested, so that unchanged ones are skipped: log files, sacct dumps, and
+    # sacct itself (with the time of the last query in mtime_ns)
+    conn.execute("CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER)")
+    return conn
+
+
+def store_runs(conn, runs):
+    """
+    :param runs: list of run dicts with the columns of the runs table
+    """
+    conn.executemany(f"INSERT OR REPLACE INTO runs ({', '.join(RUN_COLUMNS)}) VALUES ({', '.join('?' * len(RUN_COLUMNS))})",
+                     [tuple(run.get(column) for column in RUN_COLUMNS) for run in runs])
+
+
+def recorded_jobs(conn):
+    return {jobid for (jobid,) in conn.execute("SELECT jobid FROM runs")}
+
+
+def unchanged_source(conn, path, st):
+    return conn.execute("SELECT 1 FROM sources WHERE path = ? AND mtime_ns = ? AND size = ?",
+                        (path, st.st_mtime_ns, st.st_size)).fetchone() is not None
+
+
+def record_source(conn, path, mtime_ns, size=0):
+    conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (path, mtime_ns, size))
+
+
+def with_features(jobid, run, inputfile, features_cache):
+    """
+    Run dict for the database. The features of the input are left empty if the input file no longer
+    exists, or if the job was not generated by Slurmify
+    :param features_cache: dict of the features of inputs seen before during this ingest
+    """
+    inputfile = os.path.abspath(inputfile)
+    if inputfile not in features_cache:
+        try:
+            features_cache[inputfile] = input_features(inputfile)
+        except OSError:
+            features_cache[inputfile] = None
+    features = features_cache[inputfile]
+    if features is None:
+        return dict(run, jobid=jobid)
+    return dict(run, jobid=jobid, input=inputfile, **features)
+
+
+def billing_estimate(run):
+    """Billing units of a run without AllocTRES, from the billing model in utils.py"""
+    try:
+        return float(billing_units(run["cluster"], run["partition"], run["cores"] or 1, run["reqmem"] or 0))
+    except (SettingsError, KeyError, TypeError):
+        return float(run["cores"] or 1)
+
+
+def runs_from_sacct(text, extension_inputfile=".inp", skip=()):
+    """
+    Runs in sacct output, matched to their input files by job name and working directory
+    :param skip: job IDs that are already recorded
+    :return: list of run dicts, and number of jobs whose input file was not found
+    """
+    runs, missing, features_cache = [], 0, {}
+    rows = [row for row in parse_sacct(text) if row.get("JobID", "").partition(".")[0] not in skip]
+    for jobid, run in aggregate(rows).items():
+        if run["state"] in UNFINISHED:
+            continue
+        record = with_features(jobid, run, os.path.join(run["workdir"] or "", (run["name"] or "") + extension_inputfile),
+                               features_cache)
+        record["billing"] = record["billing"] or billing_estimate(record)
+        missing += record.get("program") is None
+        runs.append(record)
+    return runs, missing
+
+
+def runs_from_logs(logfiles, extension_inputfile=".inp", job_extension=".job", cluster=None):
+    """
+    Runs in the usage tables of job logs (<output>.log), matched to the input, job, and .err
+    files with the same name
+    :param cluster: cluster the jobs ran on
+    :return: list of run dicts, and number of logs without usage tables or input file
+    """
+    runs, missing, features_cache = [], 0, {}
+    for logfile in logfiles:
+        base = os.path.splitext(logfile)[0]
+        with open(logfile, errors="replace") as f:
+            jobs = aggregate(parse_tables(f.read()))
+        if not jobs:
+            missing += 1
+            continue
+        jobid, run = max(jobs.items(), key=lambda item: item[1]["elapsed"] or 0)
+        requested = sbatch_requests(base + job_extension)
+        for key, value in requested.items():
+            run[key] = run[key] or value
+        run.update(state=run["state"] or log_state(base + ".err"), cluster=run["cluster"] or cluster,
+                   finished=run["finished"] or os.stat(logfile).st_mtime)
+        record = with_features(jobid, run, base + extension_inputfile, features_cache)
+        record["billing"] = record["billing"] or billing_estimate(record)
+        missing += record.get("program") is None
+        runs.append(record)
+    return runs, missing
+
+
+def ingest(sacct_text=None, logfiles=(), path=None, source=None, queried=None, extension_inputfile=".inp",
+           job_extension=".job", cluster=None):
+    """
+    Record the runs in sacct output and job logs. Jobs that are already recorded and unchanged
+    log files are skipped, so that repeated ingests only process what is new
+    :param sacct_text: output of 'sacct --parsable2'
+    :param logfiles: paths of job logs
+    :param source: path of the file sacct_text was read from, to skip it next time if unchanged
+    :param queried: time (epoch seconds) sacct_text was queried from sacct, where the next incremental query starts
+    :param cluster: cluster of the jobs in the logs
+    :return: number of recorded runs, and number of those without input file
+    """
+    conn = connect(path)
+    try:
+        runs, missing = [], 0
+        if sacct_text is not None:
+            runs, missing = runs_from_sacct(sacct_text, extension_inputfile, skip=recorded_jobs(conn))
+        changed = []
+        for logfile in logfiles:
+            st = os.stat(logfile)
+            if not unchanged_source(conn, os.path.abspath(logfile), st):
+                changed.append((logfile, st))
+        log_runs, log_missing = runs_from_logs([logfile for logfile, st in changed], extension_inputfile,
+                                               job_extension, cluster)
+        with conn:
+            store_runs(conn, runs + log_runs)
+            for logfile, st in changed:
+                record_source(conn, os.path.abspath(logfile), st.st_mtime_ns, st.st_size)
+            if source is not None:
+                st = os.stat(source)
+                record_source(conn, os.path.abspath(source), st.st_mtime_ns, st.st_size)
+            if queried is not None:
+                record_source(conn, "sacct", int(queried * 1e9))
+    finally:
+        conn.close()
+    return len(runs) + len(log_runs), missing + log_missing
+
+
+def query_sacct(since=None, command=SACCT):
+    """Run sacct for the jobs of the current user started since a date (default: FIRST_QUERY)"""
+    args = shlex.split(command) + ["--parsable2", f"--format={SACCT_FORMAT}"]
+    args += ["--starttime", since or FIRST_QUERY]
+    result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise OSError(f"sacct failed: {result.stderr.strip()}")
+    return result.stdout
+
+
+def source_unchanged(source, path=None):
+    """Whether a sacct dump was ingested before and has not changed since"""
+    if not os.path.isfile(path or HISTORY):
+        return False
+    conn = connect(path)
+    try:
+        return unchanged_source(conn, os.path.abspath(source), os.stat(source))
+    finally:
+        conn.close()
+
+
+def last_query(path=None):
+    """Start date for an incremental sacct query: a day before the previous query, or None"""
+    if not os.path.isfile(path or HISTORY):
+        return None
+    conn = connect(path)
+    try:
+        row = conn.execute("SELECT mtime_ns FROM sources WHERE path = 'sacct'").fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return time.strftime("%Y-%m-%d", time.localtime(row[0] / 1e9 - 86400))
+
+
+#########################################################
+# Prediction
+#########################################################
+
+def quantile(values, q):
+    """Quantile with linear interpolation between the sorted values"""
+    values = sorted(values)
+    position = q * (len(values) - 1)
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def similar_runs(features, path=None):
+    """
+    Completed runs of inputs with the same program and keywords, and the same number of atoms,
+    or if there are too few of those, about the same number of atoms
+    :return: list of (maxrss, elapsed, cores)
+    """
+    if not os.path.isfile(path or HISTORY):
+        return []
+    conn = connect(path)
+    try:
+        query = ("SELECT maxrss, elapsed, cores FROM runs WHERE state = 'COMPLETED' AND maxrss IS NOT NULL "
+                 "AND elapsed IS NOT NULL AND program = ? AND keywords = ? ")
+        key = (features["program"], features["keywords"])
+        rows = conn.execute(query + "AND natoms = ?", key + (features["natoms"],)).fetchall()
+        if len(rows) < MIN_SAMPLES and features["natoms"]:
+            rows = conn.execute(query + "AND natoms BETWEEN ? AND ?",
+                                key + (features["natoms"] * (1 - NATOMS_TOLERANCE),
+                                       features["natoms"] * (1 + NATOMS_TOLERANCE))).fetchall()
+    finally:
+        conn.close()
+    return rows
+
+
+def predict(features, cores=None, q=0.95, path=None):
+    """
+    Predict the memory and walltime of a job from similar completed runs
+    :param features: dict as returned by input_features
+    :param cores: number of CPUs of the new job. Runs on more CPUs are assumed to scale
+                  perfectly to fewer CPUs; runs on fewer CPUs are not assumed to speed up
+    :param q: quantile of the memory and walltime of the runs
+    :param path: path to the history database
+    :return: dict with memory (GB per node), seconds, and samples, or None if there are too few runs
+    """
+    rows = similar_runs(features, path)
+    if len(rows) < MIN_SAMPLES:
+        return None
+    elapsed = [seconds * max(1.0, (ran_on or cores or 1) / (cores or ran_on or 1)) for _, seconds, ran_on in rows]
+    return dict(memory=quantile([maxrss for maxrss, _, _ in rows], q) * MARGIN,
+                seconds=quantile(elapsed, q) * MARGIN, samples=len(rows))
+
+
+def slurm_memory(gb):
+    return f"{max(1, math.ceil(gb))}GB"
+
+
+def slurm_time(seconds):
+    """Walltime rounded up to whole 5 minutes, in the dd-hh:mm:ss format"""
+    minutes = max(5, 5 * math.ceil(seconds / 300))
+    return f"{minutes // 1440:02d}-{minutes // 60 % 24:02d}:{minutes % 60:02d}:00"
+
+
+def apply_prediction(inputfile, settings, program):
+    """
+    Replace the memory and time in job settings by predictions from the history
+    :param inputfile: path to the input file, including extension
+    :param settings: dict of settings as passed to utils.job_for_input, with "predict" set to the quantile
+    :param program: program of the input
+    :return: new dict of settings. Unchanged (with a warning) if there are too few similar runs
+    """
+    try:
+        features = input_features(inputfile)
+    except OSError:
+        warnings.warn(f"Cannot predict resources without the input file ({inputfile}). Using the given memory and time.",
+                      SlurmifyWarning)
+        return settings
+    if program == "mrchem":
+        cores = int(settings["ntasks"]) * int(settings["cpus_per_task"])
+    else:
+        cores = int(settings["nodes"]) * int(settings["ntasks"])
+    prediction = predict(features, cores=cores, q=settings["predict"])
+    if prediction is None:
+        warnings.warn(f"Too few completed runs like {inputfile} ({features['program']}, '{features['keywords']}', "
+                      f"{features['natoms']} atoms) to predict resources. Using the given memory and time.",
+                      SlurmifyWarning)
+        return settings
+    settings = dict(settings, time=slurm_time(prediction["seconds"]))
+    if not settings.get("memory_per_cpu"):
+        settings["memory"] = slurm_memory(prediction["memory"])
+    return settings
+
+
+def apply_array_prediction(inputfiles, settings, program):
+    """
+    Memory and time of an array job, whose tasks share one set of SLURM directives: the largest
+    of the predictions (or of the given memory and time, for inputs that cannot be predicted)
+    :param inputfiles: paths to the input files of the tasks, including extension
+    :param settings: dict of settings as passed to utils.job_for_input, with "predict" set to the quantile
+    :param program: program of the inputs
+    :return: new dict of settings, with "predict" unset
+    """
+    predicted = [apply_prediction(inputfile, settings, program) for inputfile in inputfiles]
+    settings = dict(settings, predict=None,
+                    time=max((task["time"] for task in predicted), key=lambda time: duration_seconds(time) or 0))
+    memories = [task["memory"] for task in predicted if task.get("memory")]
+    if memories:
+        settings["memory"] = max(memories, key=memory_gb)
+    return settings
+
+
+#########################################################
+# Efficiency report
+#########################################################
+REPORT_GROUPS = ("program", "cluster", "account", "partition", "state", "keywords")
+
+
+def report(by=("program", "cluster", "account"), since=None, everything=False, path=None):
+    """
+    Where the core hours go: usage and efficiency of the recorded runs per group
+    :param by: columns to group by, from REPORT_GROUPS
+    :param since: only runs finished since this date (YYYY-MM-DD)
+    :param everything: include jobs not generated by Slurmify (those without input features)
+    :param path: path to the history database
+    :return: list of dicts with the group columns, jobs, core_hours, billing_hours, cpu_efficiency
+             (CPU time over core time), memory_use (high-water mark over request), queue_hours (mean
+             wait), and failed (jobs not COMPLETED). Sorted by billing hours, largest first
+    """
+    unknown = set(by) - set(REPORT_GROUPS)
+    if unknown:
+        raise ValueError(f"Cannot group by {', '.join(sorted(unknown))}. Choose from {', '.join(REPORT_GROUPS)}")
+    conditions, parameters = ["elapsed IS NOT NULL"], []
+    if not everything:
+        conditions.append("program IS NOT NULL")
+    if since:
+        conditions.append("finished >= ?")
+        parameters.append(time.mktime(time.strptime(since, "%Y-%m-%d")))
+    groups = ", ".join(by)
+    conn = connect(path)
+    try:
+        rows = conn.execute(f"SELECT {groups}, COUNT(*), SUM(elapsed * cores) / 3600, SUM(elapsed * billing) / 3600, "
+                            "SUM(cputime) / SUM(CASE WHEN cputime IS NOT NULL THEN elapsed * cores END), "
+                            "AVG(maxrss / reqmem), AVG(started - submitted) / 3600, SUM(state != 'COMPLETED') "
+                            f"FROM runs WHERE {' AND '.join(conditions)} GROUP BY {groups} "
+                            "ORDER BY SUM(elapsed * billing) DESC", parameters).fetchall()
+    finally:
+        conn.close()
+    names = list(by) + ["jobs", "core_hours", "billing_hours", "cpu_efficiency", "memory_use", "queue_hours", "failed"]
+    return [dict(zip(names, row)) for row in rows]
+
+
+def percent(value):
+    return "-" if value is None else f"{100 * value:.0f}%"
+
+
+#########################################################
+# Command-line interface
+#########################################################
+
+def main(argv=None):
+    """Command-line interface for recording and querying the job history"""
+    import slurmify
+
+    parser = argparse.ArgumentParser(prog="slurmify.py history",
+                                     description="Record completed jobs, report their efficiency, and predict the resources of new ones")
+    parser.add_argument("action", choices=["ingest", "show", "suggest", "report"],
+                        help="ingest: record completed jobs, show: summarize the history, suggest: predict memory and "
+                             "time for inputs, report: usage and efficiency per program, cluster, and account")
+    parser.add_argument("files", nargs="*", help="ingest: job .log files (default: query sacct), suggest: input files")
+    parser.add_argument("--db", metavar="<>", type=str, help=f"[str] History database (default: {HISTORY})")
+    parser.add_argument("--sacct_file", metavar="<>", type=str, help="[str] ingest: read saved 'sacct --parsable2' output instead of running sacct")
+    parser.add_argument("--since", metavar="<>", type=str, help="[str] ingest: only jobs started since this date (YYYY-MM-DD; default: since the last ingest, or all jobs), report: only jobs finished since this date")
+    parser.add_argument("-q", "--quantile", metavar="<>", type=float, default=0.95, help="[float] suggest: quantile of the similar runs")
+    parser.add_argument("--cores", metavar="<>", type=int, help="[int] suggest: number of CPUs of the new job")
+    parser.add_argument("--by", metavar="<>", nargs="+", default=["program", "cluster", "account"], choices=REPORT_GROUPS,
+                        help=f"[str] report: group by these columns ({', '.join(REPORT_GROUPS)})")
+    parser.add_argument("--all", action="store_true", help="report: include jobs not generated by Slurmify")
+    args = parser.parse_args(argv)
+
+    if args.action == "ingest":
+        queried = source = text = None
+        if args.sacct_file:
+            if source_unchanged(args.sacct_file, args.db):
+                print(f"{args.sacct_file} is unchanged since the last ingest")
+                return
+            with open(args.sacct_file) as f:
+                text = f.read()
+            source = args.sacct_file
+        elif not args.files:
+            queried = time.time()
+            try:
+                text = query_sacct(args.since or last_query(args.db))
+            except OSError as e:
+                sys.exit(str(e))
+        recorded, missing = ingest(text, args.files, path=args.db, source=source, queried=queried,
+                                   extension_inputfile=slurmify.INPUT_EXTENSION, job_extension=slurmify.JOB_EXTENSION,
+                                   cluster=slurmify.detect_cluster())
+        print(f"Recorded {recorded} new runs" + (f" ({missing} without a Slurmify input file)" if missing else ""))
+    elif args.action == "show":
+        if not os.path.isfile(args.db or HISTORY):
+            sys.exit(f"No history found in {args.db or HISTORY}")
+        conn = connect(args.db)
+        try:
+            rows = conn.execute("SELECT program, keywords, natoms, COUNT(*), MAX(maxrss), AVG(reqmem / maxrss), "
+                                "MAX(elapsed), AVG(timelimit / elapsed) FROM runs WHERE state = 'COMPLETED' "
+                                "GROUP BY program, keywords, natoms ORDER BY program, keywords, natoms").fetchall()
+        finally:
+            conn.close()
+        print(f"{'program':<9} {'atoms':>5} {'runs':>5} {'max mem':>9} {'mem req/used':>12} {'max time':>12} {'time req/used':>13}  keywords")
+        for program, keywords, natoms, n, maxrss, memratio, elapsed, timeratio in rows:
+            print(f"{program:<9} {natoms:>5} {n:>5} {maxrss or 0:>7.1f}GB {memratio or 0:>12.1f} "
+                  f"{slurm_time(elapsed or 0):>12} {timeratio or 0:>13.1f}  {keywords}")
+    elif args.action == "report":
+        if not os.path.isfile(args.db or HISTORY):
+            sys.exit(f"No history found in {args.db or HISTORY}")
+        rows = report(args.by, since=args.since, everything=args.all, path=args.db)
+        widths = [max([len(str(row[key])) for row in rows] + [len(key)]) for key in args.by]
+        print(" ".join(f"{key:<{width}}" for key, width in zip(args.by, widths)) +
+              f" {'jobs':>7} {'core-h':>10} {'billing-h':>10} {'CPU eff':>8} {'mem used':>9} {'wait-h':>7} {'failed':>7}")
+        for row in rows:
+            print(" ".join(f"{str(row[key]):<{width}}" for key, width in zip(args.by, widths)) +
+                  f" {row['jobs']:>7} {row['core_hours'] or 0:>10.1f} {row['billing_hours'] or 0:>10.1f} "
+                  f"{percent(row['cpu_efficiency']):>8} {percent(row['memory_use']):>9} "
+                  f"{row['queue_hours'] or 0:>7.2f} {row['failed']:>7}")
+        print(f"{sum(row['jobs'] for row in rows)} jobs, {sum(row['core_hours'] or 0 for row in rows):.1f} core hours, "
+              f"{sum(row['billing_hours'] or 0 for row in rows):.1f} billing hours")
+    elif args.action == "suggest":
+        for inputfile in args.files:
+            features = input_features(inputfile)
+            prediction = predict(features, cores=args.cores, q=args.quantile, path=args.db)
+            if prediction is None:
+                print(f"{inputfile}: too few similar runs ({features['program']}, '{features['keywords']}', {features['natoms']} atoms)")
+            else:
+                print(f"{inputfile}: -m {slurm_memory(prediction['memory'])} -t {slurm_time(prediction['seconds'])} "
+                      f"(from {prediction['samples']} runs)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+import os
+import sys
+import warnings
+
+from profiling import phase
+from cache import cached_scan, load, store, load_jobs, store_jobs, job_digest, file_hash
+from utils import (job_for_input, write_jobfile, get_orca_hessfile, get_orca_xyzfile, get_orca_compfile,
+                   get_orca_gbwfile, stage_files, parallel_staging, orca_copy_back, MissingFileError, SlurmifyError,
+                   SettingsError, SlurmifyWarning, vars, timestamp, timestamp_header, sbatch_directives, scratch_setup,
+                   staging_functions, staging_report, orca_environment, orca_command, gaussian_command,
+                   gaussian_copy_back, memory_gb, check_memory, telemetry_start, telemetry_functions,
+                   telemetry_phase)
+
+# Shell variables that hold the per-task file names in an array job
+TASK_INPUT = "${INPUT}"
+TASK_OUTPUT = "${OUTPUT}"
+
+
+def task_extras(manifest, inputfile, settings):
+    """
+    Resolve the auxiliary files that must be copied to scratch for one array task.
+    Must be called from the directory containing the input file.
+    :param manifest: manifest of the input file from utils.scan_input
+    :param inputfile: name of input file without extension
+    :param settings: dict of settings as passed to utils.job_for_input
+    :return: list of file names
+    """
+    extras = []
+    inp = inputfile + settings["extension_inputfile"]
+    program = manifest["program"]
+    if program == "orca":
+        for flag, locate in [("chess", get_orca_hessfile), ("cxyz", get_orca_xyzfile),
+                             ("ccomp", get_orca_compfile), ("cgbw", get_orca_gbwfile)]:
+            if settings.get(flag):
+                auxfile = locate(inp, manifest)
+                if not os.path.isfile(auxfile):
+                    raise MissingFileError(f"Error! The file specified ({auxfile}) does not exist.")
+                extras.append(auxfile)
+    elif program == "gaussian" and settings.get("cchk"):
+        if os.path.isfile(inputfile + ".chk"):
+            extras.append(inputfile + ".chk")
+        else:
+            warnings.warn(f"Copy of .chk file requested, but the file does not exist ({inputfile+'.chk'}). Continuing without copying file.",
+                          SlurmifyWarning)
+    return extras
+
+
+def array_job(program, ntasks, name, indexfile, settings, throttle=None, index_command=None):
+    """
+    Generate a single SLURM array job script that runs one input per array task. The input and
+    output names of each task are looked up in an index file at runtime.
+    :param program: "orca", "gaussian", or "mrchem"
+    :param ntasks: number of array tasks
+    :param name: name of the array job, used for the job name and the .log/.err files
+    :param indexfile: name of the index file mapping SLURM_ARRAY_TASK_ID to input/output names
+    :param settings: dict of settings as passed to utils.job_for_input. "predict" and "resubmit" are ignored
+    :param throttle: maximum number of simultaneously running tasks ('%K' in --array)
+    :param index_command: shell command printing the index, if it is not a file (see sink.Bundle.command)
+    :return: job file as a list of lines
+    """
+    if program == "mrchem" and settings.get("autobill"):
+        from sweep import apply_autobill
+
+        settings = apply_autobill(settings)
+    # Predictions are made per array (see write_arrays), since the template has no input to predict from
+    template_settings = dict(settings, output=TASK_OUTPUT, identifier=name, predict=None, autobill=None,
+                             chess=False, cxyz=False, ccomp=False, cgbw=False, cchk=False, resubmit=None)
+    _, template = job_for_input(TASK_INPUT, template_settings, manifest=dict(program=program))
+
+    array = f"0-{ntasks-1}" + (f"%{throttle}" if throttle else "")
+    cluster = settings["cluster"]
+    stage_in = stage_files(cluster, [TASK_INPUT+settings['extension_inputfile']], "$SCRATCH")[-1]
+    if parallel_staging(cluster):
+        stage_extra = "if [ \"$EXTRA\" != \"-\" ]; then stage $SCRATCH ${EXTRA//,/ }; fi"
+    else:
+        stage_extra = "if [ \"$EXTRA\" != \"-\" ]; then for f in ${EXTRA//,/ }; do cp $f $SCRATCH; done; fi"
+    copy_back = orca_copy_back(cluster, TASK_INPUT) if program == "orca" else []
+    copy_back_ccomp = orca_copy_back(cluster, TASK_INPUT, ccomp=True)[len(copy_back):] if settings.get("ccomp") else []
+
+    index = f"<({index_command})" if index_command else f"${{SLURM_SUBMIT_DIR}}/{indexfile}"
+    jobfile = []
+    for line in template:
+        if line.startswith("#SBATCH --output="):
+            jobfile.append(f"#SBATCH --output={name}_%a.log")
+        elif line.startswith("#SBATCH --error="):
+            jobfile.append(f"#SBATCH --error={name}_%a.err")
+        elif line.startswith("#SBATCH --job-name="):
+            jobfile.append(line)
+            jobfile.append(f"#SBATCH --array={array}")
+        elif line == "set -o nounset":
+            jobfile.append(line)
+            jobfile.append("")
+            jobfile.append("# Look up the input handled by this array task")
+            jobfile.append(f"read INPUT OUTPUT EXTRA <<< \"$(awk -v id=${{SLURM_ARRAY_TASK_ID}} '$1 == id {{print $2, $3, $4}}' {index})\"")
+        elif line == stage_in:
+            jobfile.append(line)
+            jobfile.append(stage_extra)
+        elif copy_back and line == copy_back[-1]:
+            jobfile.append(line)
+            jobfile += copy_back_ccomp
+        else:
+            jobfile.append(line)
+    return jobfile
+
+
+def packed_job(program, ntasks, name, indexfile, settings, slots, index_command=None):
+    """
+    Generate a job script that runs all inputs of an index file as a task farm inside a single
+    allocation on one node. Each of the slots workers takes the next input from the index as soon
+    as its previous one is done, runs it in its own scratch directory, and copies the results back,
+    so that all cores stay busy until the index is drained. Each worker is bound to its own --ntasks
+    cores of the allocation with taskset, and MPI binding is turned off, so that the ranks of
+    concurrent ORCA tasks do not pile up on the same cores. Each task writes <output>.log/.err like a single job. The exit status of every task is appended to
+    <name>.status, and tasks that already completed successfully are skipped when the job is rerun,
+    e.g. after hitting the time limit.
+    :param program: "orca" or "gaussian"
+    :param ntasks: number of inputs in the index file
+    :param name: name of the packed job, used for the job name and the .log/.err/.status files
+    :param indexfile: name of the index file mapping task IDs to input/output names
+    :param settings: dict of settings as passed to utils.job_for_input
+    :param slots: number of inputs running at the same time
+    :param index_command: shell command printing the index, if it is not a file (see sink.Bundle.command)
+    :return: job file as a list of lines
+    """
+    if program not in ("orca", "gaussian"):
+        raise SlurmifyError(f"Error! Only ORCA and Gaussian jobs can be packed, not {program}.")
+    cluster = settings["cluster"]
+    ext_in, ext_out = settings["extension_inputfile"], settings["extension_outputfile"]
+    memory = settings.get("memory")
+    if memory is not None and cluster != "fram":
+        memory = f"{memory_gb(memory) * slots:g}GB"
+    elif memory is not None:
+        check_memory(memory)
+        memory = None
+
+    stamp = timestamp()
+    jobfile = timestamp_header(stamp, "-" * len(stamp))
+    jobfile += sbatch_directives(slurm_account=settings["account"], identifier=name, outputfile=name, loc=True,
+                                 slurm_nodes="1", slurm_ntasks_per_node=str(int(settings["ntasks"]) * slots),
+                                 slurm_time=settings["time"], slurm_memory=memory, slurm_mail=settings["mail"],
+                                 is_dev=settings.get("dev"), slurm_partition=settings["partition"])
+    jobfile += telemetry_start(cluster)
+    jobfile.append("module purge")
+    jobfile.append(f"module load {vars[cluster]['mpi_version' if program == 'orca' else 'gaussian_version']}")
+    jobfile.append("")
+    jobfile.append("set -o errexit")
+    jobfile.append("set -o nounset")
+    jobfile.append("")
+    if program == "gaussian" and cluster == "saga":
+        jobfile.append("export GAUSS_LFLAGS2='--LindaOptions -s 20000000'")
+        jobfile.append("")
+    jobfile += scratch_setup(cluster)
+    jobfile += staging_functions(cluster)
+    jobfile += telemetry_functions(cluster, name)
+    if program == "orca":
+        jobfile += orca_environment(cluster)
+        jobfile.append("# The workers bind their tasks to their own cores, which mpirun must not override")
+        jobfile.append("export OMPI_MCA_hwloc_base_binding_policy=none")
+        jobfile.append("")
+
+    # Steps of a single task, run in a subshell with its own scratch directory
+    task = [f"SCRATCH=$SCRATCH/task_$ID",
+            "mkdir -p $SCRATCH"]
+    task += stage_files(cluster, [TASK_INPUT + ext_in], "$SCRATCH")
+    if parallel_staging(cluster):
+        task.append("if [ \"$EXTRA\" != \"-\" ]; then stage $SCRATCH ${EXTRA//,/ }; fi")
+    else:
+        task.append("if [ \"$EXTRA\" != \"-\" ]; then for f in ${EXTRA//,/ }; do cp $f $SCRATCH; done; fi")
+    task.append("cd $SCRATCH")
+    if program == "orca":
+        task.append(orca_command(TASK_INPUT, TASK_OUTPUT, ext_in, ext_out))
+        task += orca_copy_back(cluster, TASK_INPUT, ccomp=settings.get("ccomp"))
+    else:
+        if cluster == "stallo":
+            if ext_in != ".com":
+                task.append(f"mv {TASK_INPUT + ext_in} {TASK_INPUT + '.com'}")
+            task.append(f"G09.prep.slurm {TASK_INPUT}")
+            if ext_in != ".com":
+                task.append(f"mv {TASK_INPUT + '.com'} {TASK_INPUT + ext_in}")
+        task.append(gaussian_command(TASK_INPUT, TASK_OUTPUT, ext_in, ext_out))
+        task += gaussian_copy_back(cluster, TASK_INPUT)
+    task += [line for line in staging_report(cluster) if line]
+    task += ["cd $SLURM_SUBMIT_DIR",
+             "rm -rf $SCRATCH"]
+
+    jobfile.append(f"# Task farm: {slots} workers take the next input from the index until all {ntasks} are done")
+    jobfile.append(f"INDEX={'$SCRATCH/farm/index' if index_command else f'${{SLURM_SUBMIT_DIR}}/{indexfile}'}")
+    jobfile.append(f"STATUS=${{SLURM_SUBMIT_DIR}}/{name}.status")
+    jobfile.append(f"NTASKS={ntasks}")
+    jobfile.append(f"TASK_CORES={settings['ntasks']}")
+    jobfile.append("FARM=$SCRATCH/farm")
+    jobfile.append("mkdir -p $FARM && echo 0 > $FARM/next && touch $STATUS")
+    if index_command:
+        jobfile.append(f"{index_command} > $INDEX")
+    jobfile.append("")
+    jobfile.append("# The cores of the job, one per element (Cpus_allowed_list is e.g. 0-19,40-59)")
+    jobfile.append("CORES=()")
+    jobfile.append("for range in $(awk '/^Cpus_allowed_list:/ {gsub(\",\", \" \", $2); print $2}' /proc/self/status); do")
+    jobfile.append("    CORES+=($(seq ${range%-*} ${range#*-}))")
+    jobfile.append("done")
+    jobfile.append("")
+    jobfile.append("next_task() {")
+    jobfile.append("    flock 9")
+    jobfile.append("    local id=$(< $FARM/next)")
+    jobfile.append("    [ $id -lt $NTASKS ] || return 1")
+    jobfile.append("    echo $((id + 1)) > $FARM/next")
+    jobfile.append("    echo $id")
+    jobfile.append("} 9> $FARM/lock")
+    jobfile.append("")
+    jobfile.append("run_task() {")
+    jobfile += [f"    {line}" for line in task]
+    jobfile.append("}")
+    jobfile.append("")
+    jobfile.append("worker() {")
+    jobfile.append("    local ID INPUT OUTPUT EXTRA start status cores")
+    jobfile.append("    set +o errexit")
+    jobfile.append("    # Worker N runs its tasks on the Nth block of TASK_CORES cores")
+    jobfile.append("    cores=$(IFS=,; echo \"${CORES[*]:$((($1 - 1) * TASK_CORES)):TASK_CORES}\")")
+    jobfile.append("    [ -n \"$cores\" ] && taskset -cp $cores $BASHPID > /dev/null")
+    jobfile.append("    while ID=$(next_task); do")
+    jobfile.append("        awk -v id=$ID '$1 == id && $3 == 0 {done = 1} END {exit !done}' $STATUS && continue")
+    jobfile.append("        read INPUT OUTPUT EXTRA <<< \"$(awk -v id=$ID '$1 == id {print $2, $3, $4}' $INDEX)\"")
+    jobfile.append("        start=$(date +%s)")
+    jobfile.append(f"        (set -o errexit; run_task) > {TASK_OUTPUT}.log 2> {TASK_OUTPUT}.err")
+    jobfile.append("        status=$?")
+    jobfile.append("        printf '%s\\t%s\\t%s\\t%s\\n' $ID $INPUT $status $(($(date +%s) - start)) >> $STATUS")
+    jobfile.append("        echo \"Task $ID ($INPUT) finished with status $status\"")
+    jobfile.append("    done")
+    jobfile.append("}")
+    jobfile.append("")
+    jobfile += telemetry_phase(cluster, "tasks")
+    jobfile.append(f"for slot in $(seq {slots}); do worker $slot & done")
+    jobfile.append("wait")
+    jobfile.append("")
+    jobfile.append("# The last status of every task counts, as tasks are rerun when the job is resubmitted")
+    jobfile.append("FAILED=$(awk '{last[$1] = $3} END {n = 0; for (id in last) n += last[id] != 0; print n}' $STATUS)")
+    jobfile.append("echo \"Task farm done: $NTASKS tasks, $FAILED failed\"")
+    if cluster == "stallo":
+        jobfile += telemetry_phase(cluster, "cleanup")
+        jobfile.append("rm -rf $SCRATCH")
+    jobfile.append("")
+    jobfile.append("exit $((FAILED > 0))")
+    return jobfile
+
+
+def write_arrays(inputs, settings, name, throttle=None, job_extension=".job", force=False, silent=False,
+                 cache=None, use_hash=False, update=None, slots=None, bundle=None):
+    """
+    Generate one array job script plus index file per program for a batch of inputs.
+    All inputs must reside in the same directory, which is where the array job is written.
+    :param inputs: list of absolute paths to input files, without extension
+    :param settings: dict of settings as passed to utils.job_for_input
+    :param name: base name of the array job. The program name is appended if the batch mixes programs
+    :param throttle: maximum number of simultaneously running tasks
+    :param job_extension: extension of the job file
+    :param force: overwrite existing job and index files
+    :param silent: only report failures and the final summary
+    :param cache: path to the classification cache. Every input is scanned if None
+    :param use_hash: compare content hashes when validating cache entries
+    :param update: path to the cache holding the job digests. If given, existing array jobs are regenerated
+                   only if the job, its index, or the contents of any of its inputs changed since the last run
+    :param slots: generate packed jobs (see packed_job) running this many inputs at a time instead of array jobs
+    :param bundle: sink.Bundle to write the job and index files into. The jobs read their index from the bundle
+    :return: dict mapping status to the list of inputs with that status. The generated array jobs are listed under "jobs"
+    """
+    if slots and settings.get("predict"):
+        raise SettingsError("--predict cannot be combined with --pack, since the time of a task farm depends on how "
+                            "its inputs share the slots. Give the time of the whole allocation with -t instead.")
+    if settings.get("resubmit"):
+        raise SettingsError("--resubmit cannot be combined with --array or --pack, since the tasks of an array or a "
+                            "task farm share one job. Give them enough time with -t instead.")
+    results = {"generated": [], "skipped": [], "failed": [], "jobs": []}
+    directories = {os.path.dirname(inputpath) for inputpath in inputs}
+    if len(directories) != 1:
+        raise SlurmifyError("Error! All inputs of an array job must reside in the same directory.")
+    directory = directories.pop()
+
+    # Classify inputs and resolve the files to stage for every task
+    tasks = {}
+    with phase("cache"):
+        entries = load(cache) if cache is not None else {}
+        previous = load_jobs(update) if update is not None else {}
+    records, digests = [], []
+    cwd = os.getcwd()
+    try:
+        os.chdir(directory)
+        for inputpath in inputs:
+            inputfile = os.path.basename(inputpath)
+            try:
+                with phase("scan", inputpath):
+                    manifest, record = cached_scan(inputfile + settings["extension_inputfile"],
+                                                   entries.get(inputpath + settings["extension_inputfile"]), use_hash=use_hash)
+                if record is not None:
+                    records.append(record)
+                program = manifest["program"]
+                with phase("aux", inputpath):
+                    extras = task_extras(manifest, inputfile, settings)
+            except SlurmifyError as e:
+                results["failed"].append(inputpath)
+                print(f"Failed {inputpath}: {e}", file=sys.stderr)
+                continue
+            except (OSError, KeyError, ValueError) as e:
+                results["failed"].append(inputpath)
+                print(f"Failed {inputpath}: {type(e).__name__}: {e}", file=sys.stderr)
+                continue
+            tasks.setdefault(program, []).append((inputpath, inputfile, extras))
+        if cache is not None:
+            with phase("cache"):
+                store(cache, records)
+
+        for program, program_tasks in sorted(tasks.items()):
+            if slots and program not in ("orca", "gaussian"):
+                results["failed"].extend(inputpath for inputpath, _, _ in program_tasks)
+                print(f"Failed {len(program_tasks)} {program} inputs: only ORCA and Gaussian jobs can be packed", file=sys.stderr)
+                continue
+            arrayname = name if len(tasks) == 1 else f"{name}_{program}"
+            jobname = arrayname + job_extension
+            indexfile = arrayname + ".index"
+            if not force and update is None and bundle is None and (os.path.isfile(jobname) or os.path.isfile(indexfile)):
+                print(f"{os.path.join(directory, jobname)} exists. Use -f to overwrite.", file=sys.stderr)
+                results["skipped"].extend(inputpath for inputpath, _, _ in program_tasks)
+                continue
+
+            index = [f"{task_id}\t{inputfile}\t{inputfile}\t{','.join(extras) or '-'}"
+                     for task_id, (_, inputfile, extras) in enumerate(program_tasks)]
+            index_command = None
+            if bundle is not None:
+                # The job needs to know where its index is in the bundle
+                with phase("write", os.path.join(directory, arrayname)):
+                    bundle.write(os.path.join(directory, indexfile), index)
+                index_command = bundle.command(os.path.join(directory, indexfile))
+            array_settings = settings
+            if settings.get("predict"):
+                from history import apply_array_prediction
+
+                with phase("predict", os.path.join(directory, arrayname)):
+                    array_settings = apply_array_prediction([inputfile + settings["extension_inputfile"]
+                                                             for _, inputfile, _ in program_tasks], settings, program)
+            with phase("render", os.path.join(directory, arrayname)):
+                if slots:
+                    job = packed_job(program, len(program_tasks), arrayname, indexfile, settings, slots,
+                                     index_command=index_command)
+                else:
+                    job = array_job(program, len(program_tasks), arrayname, indexfile, array_settings, throttle=throttle,
+                                    index_command=index_command)
+            if update is not None:
+                with phase("hash", os.path.join(directory, arrayname)):
+                    digest = job_digest(job + index, [file_hash(inputfile + settings["extension_inputfile"])
+                                                      for _, inputfile, _ in program_tasks])
+                if digest == previous.get(os.path.join(directory, jobname)) and os.path.isfile(jobname) \
+                        and os.path.isfile(indexfile):
+                    if not silent:
+                        print(f"{os.path.join(directory, jobname)} is up to date")
+                    results["skipped"].extend(inputpath for inputpath, _, _ in program_tasks)
+                    continue
+                digests.append((os.path.join(directory, jobname), digest))
+
+            with phase("write", os.path.join(directory, arrayname)):
+                if bundle is not None:
+                    bundle.write(os.path.join(directory, jobname), job)
+                else:
+                    write_jobfile(indexfile, index)
+                    write_jobfile(jobname, job)
+            results["generated"].extend(inputpath for inputpath, _, _ in program_tasks)
+            results["jobs"].append(os.path.join(directory, jobname))
+            if not silent:
+                print(f"Generated {os.path.join(directory, jobname)} ({program}, {len(program_tasks)} tasks)")
+        if update is not None:
+            with phase("cache"):
+                store_jobs(update, digests)
+    finally:
+        os.chdir(cwd)
+
+    print(f"{'Packed jobs' if slots else 'Array'} done: {len(results['generated'])} tasks, {len(results['skipped'])} skipped, "
+          f"{len(results['failed'])} failed")
+    return results
@@ -0,0 +1,253 @@
+"""
+Content-addressed store for MRChem orbitals and checkpoints.
+
+Instead of copying the orbitals of every job into a fresh directory, MRChem jobs on clusters with
+an "orbstore" entry in vars (utils.py) put each file into the store once, under the SHA-256 of its
+contents, and describe the directory with a manifest:
+
+    <store>/objects/<first two hex digits>/<sha256>     read-only file contents
+    <store>/manifests/<sha256 of the manifest>          one "<sha256>  ./<path>" line per file (sha256sum format)
+
+The <input>.orbitals and <input>.checkpoint files written by the job name the manifest, and
+--initorb/--initchk accept it in place of a directory. The files are then hard-linked into scratch
+(or reflinked/copied where scratch is on another file system), so identical orbitals of many jobs
+occupy the project quota only once.
+
+Manifests are touched whenever a job uses them. 'gc' removes manifests that were not used for a
+given number of days and are not named by any .orbitals/.checkpoint file below the given
+directories, and then every object that no remaining manifest references.
+
+$ slurmify.py orbstore ingest DIR...       add existing orbital directories, print their manifests
+$ slurmify.py orbstore ls                  list manifests, with file counts and sizes
+$ slurmify.py orbstore gc [--days N] [--keep DIR...] [-n]
+$ slurmify.py orbstore verify              re-hash all objects
+"""
+import os
+import sys
+import time
+import shutil
+import hashlib
+import argparse
+
+POINTER_EXTENSIONS = (".orbitals", ".checkpoint")
+
+
+def store_for(cluster):
+    """
+    Path of the orbital store of a cluster, or None if the cluster does not use one. Environment
+    variables in the path are expanded, and ${SLURM_JOB_ACCOUNT} is the account of the cluster
+    (ACCOUNTS in slurmify.py) outside of a job
+    """
+    from utils import vars
+    from slurmify import ACCOUNTS
+
+    store = vars[cluster].get("orbstore")
+    if store is None:
+        return None
+    if "SLURM_JOB_ACCOUNT" not in os.environ:
+        store = store.replace("${SLURM_JOB_ACCOUNT}", ACCOUNTS[cluster]).replace("$SLURM_JOB_ACCOUNT", ACCOUNTS[cluster])
+    return os.path.expandvars(store)
+
+
+def object_path(store, digest):
+    return os.path.join(store, "objects", digest[:2], digest)
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_manifest(path):
+    """
+    :param path: path of a manifest
+    :return: list of (digest, relative path)
+    """
+    entries = []
+    with open(path) as f:
+        for line in f:
+            digest, relpath = line.rstrip("\n").split("  ", 1)
+            entries.append((digest, relpath))
+    return entries
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def ingest(store, directory):
+    """
+    Add the files of a directory to the store. The files are copied, not hard-linked: the directory
+    keeps its permissions, and later writes to it cannot change the read-only objects
+    :param store: path of the store
+    :param directory: directory with orbital or checkpoint files
+    :return: path of the manifest describing the directory
+    """
+    relpaths = []
+    for root, dirs, files in os.walk(directory):
+        relpaths += ["./" + os.path.relpath(os.path.join(root, name), directory).replace(os.sep, "/")
+                     for name in files]
+
+    lines = []
+    for relpath in sorted(relpaths):
+        source = os.path.join(directory, relpath)
+        digest = file_digest(source)
+        target = object_path(store, digest)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            tmp = f"{target}.{os.getpid()}"
+            shutil.copyfile(source, tmp)
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, target)
+        lines.append(f"{digest}  {relpath}\n")
+
+    content = "".join(lines).encode()
+    manifest = os.path.join(store, "manifests", hashlib.sha256(content).hexdigest())
+    os.makedirs(os.path.dirname(manifest), exist_ok=True)
+    if os.path.exists(manifest):
+        os.utime(manifest)
+    else:
+        with open(f"{manifest}.{os.getpid()}", "wb") as f:
+            f.write(content)
+        os.replace(f"{manifest}.{os.getpid()}", manifest)
+    return manifest
+
+
+def restore(manifest, destination, copy=False):
+    """
+    Recreate the directory described by a manifest
+    :param manifest: path of the manifest
+    :param destination: directory to create
+    :param copy: make writable copies instead of hard links to the read-only objects
+    """
+    store = os.path.dirname(os.path.dirname(os.path.abspath(manifest)))
+    for digest, relpath in read_manifest(manifest):
+        target = os.path.join(destination, relpath)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if copy:
+            shutil.copyfile(object_path(store, digest), target)
+        else:
+            link_or_copy(object_path(store, digest), target)
+    os.utime(manifest)
+
+
+def manifests(store):
+    directory = os.path.join(store, "manifests")
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if "." not in name)
+
+
+def objects(store):
+    for root, dirs, files in os.walk(os.path.join(store, "objects")):
+        for name in files:
+            if "." not in name:  # skip files still being added
+                yield os.path.join(root, name)
+
+
+def referenced_manifests(directories):
+    """Manifests named by the .orbitals and .checkpoint files below the given directories"""
+    referenced = set()
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                if name.endswith(POINTER_EXTENSIONS):
+                    with open(os.path.join(root, name)) as f:
+                        referenced.add(os.path.abspath(f.read().strip()))
+    return referenced
+
+
+def gc(store, days=30, keep=(), grace_hours=24, dry_run=False):
+    """
+    Remove unused manifests and the objects only they referenced
+    :param store: path of the store
+    :param days: remove manifests not used for this many days. Keep all manifests if None
+    :param keep: directories to search for .orbitals/.checkpoint files whose manifests are kept
+    :param grace_hours: never remove objects added more recently, as they may belong to a running job
+    :param dry_run: only report what would be removed
+    :return: number of removed manifests, number of removed objects, and bytes freed
+    """
+    now = time.time()
+    keep = referenced_manifests(keep)
+    live = set()
+    removed_manifests = 0
+    for manifest in manifests(store):
+        if days is not None and now - os.stat(manifest).st_mtime > days * 86400 and os.path.abspath(manifest) not in keep:
+            removed_manifests += 1
+            if not dry_run:
+                os.remove(manifest)
+            continue
+        live.update(digest for digest, relpath in read_manifest(manifest))
+
+    removed_objects = freed = 0
+    for path in objects(store):
+        st = os.stat(path)
+        if os.path.basename(path) in live or now - st.st_ctime < grace_hours * 3600:
+            continue
+        removed_objects += 1
+        freed += st.st_size if st.st_nlink == 1 else 0
+        if not dry_run:
+            os.remove(path)
+    return removed_manifests, removed_objects, freed
+
+
+def verify(store):
+    """Objects whose contents no longer match their digest"""
+    return [path for path in objects(store) if file_digest(path) != os.path.basename(path)]
+
+
+def main(argv=None):
+    """Command-line interface for maintaining the orbital store"""
+    import slurmify
+
+    parser = argparse.ArgumentParser(prog="slurmify.py orbstore",
+                                     description="Maintain the content-addressed MRChem orbital store")
+    parser.add_argument("action", choices=["ingest", "ls", "gc", "verify"],
+                        help="ingest: add orbital directories, ls: list manifests, gc: remove unused files, verify: check all objects")
+    parser.add_argument("directories", nargs="*", help="Directories to ingest")
+    parser.add_argument("--store", metavar="<>", type=str, help="[str] Path of the store (default: 'orbstore' in vars of the current cluster)")
+    parser.add_argument("--days", metavar="<>", type=float, default=30, help="[float] gc: remove manifests not used for this many days")
+    parser.add_argument("--keep", metavar="<>", nargs="+", default=[], help="[str] gc: keep manifests named by .orbitals/.checkpoint files below these directories")
+    parser.add_argument("-n", "--dry_run", action="store_true", help="gc: only report what would be removed")
+    args = parser.parse_args(argv)
+
+    store = args.store or store_for(slurmify.detect_cluster())
+    if store is None:
+        sys.exit("No orbital store configured for this cluster. Set 'orbstore' in vars in utils.py, or use --store")
+    if "$" in store:
+        sys.exit(f"Cannot expand the environment variables in the path of the orbital store: {store}. Use --store")
+
+    if args.action == "ingest":
+        for directory in args.directories:
+            print(f"{directory}: {ingest(store, directory)}")
+    elif args.action == "ls":
+        files = total = 0
+        for manifest in manifests(store):
+            entries = read_manifest(manifest)
+            size = sum(os.path.getsize(object_path(store, digest)) for digest, relpath in entries)
+            used = time.strftime("%Y-%m-%d", time.localtime(os.stat(manifest).st_mtime))
+            print(f"{os.path.basename(manifest)}  {len(entries):>6} files  {size/1024**3:8.2f} GB  used {used}")
+            files += len(entries)
+            total += size
+        stored = sum(os.path.getsize(path) for path in objects(store))
+        print(f"{len(manifests(store))} manifests, {files} files, {total/1024**3:.2f} GB referenced, {stored/1024**3:.2f} GB stored")
+    elif args.action == "gc":
+        removed_manifests, removed_objects, freed = gc(store, days=args.days, keep=args.keep, dry_run=args.dry_run)
+        print(f"{'Would remove' if args.dry_run else 'Removed'} {removed_manifests} manifests and {removed_objects} objects ({freed/1024**3:.2f} GB)")
+    elif args.action == "verify":
+        corrupt = verify(store)
+        for path in corrupt:
+            print(f"Corrupt: {path}")
+        if corrupt:
+            sys.exit(f"{len(corrupt)} corrupt objects")
+        print("All objects are intact")
+
+
+if __name__ == "__main__":
+    main()
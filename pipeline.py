@@ -0,0 +1,218 @@
+"""
+Pipelines: the steps of a workflow (see workflow.py) run back to back in a single allocation and
+a single scratch directory, instead of one job per step. The input files are staged once, and
+every step finds the files written by the steps before it in $SCRATCH, e.g. the .hess, .xyz, and
+.gbw files of an ORCA optimization. This saves the queue wait and staging of short follow-up
+steps, such as frequencies after an optimization.
+
+The allocation is the largest of the steps (nodes, tasks, CPUs per task, and memory) for the sum
+of their times. The account, partition, and mail type are those of the first step. Every step
+loads its own environment in a subshell, so ORCA, Gaussian, and MRChem steps can be mixed.
+
+The results of ORCA and Gaussian steps are copied back once at the end ("end"), or after every
+step ("step"), so that the results of completed steps are kept if a later step fails or the
+pipeline runs out of time. MRChem steps always copy back their orbitals right after they ran,
+as a later MRChem step would overwrite them.
+"""
+import os
+import warnings
+
+from utils import (vars, timestamp, timestamp_header, sbatch_directives, scratch_setup, staging_functions,
+                   staging_report, stage_files, orbstore_functions, telemetry_start,
+                   telemetry_functions, telemetry_phase, orca_environment, orca_command, orca_copy_back,
+                   gaussian_command, gaussian_copy_back, mrchem_command, mrchem_copy_back, check_memory, memory_gb,
+                   get_orca_hessfile, get_orca_xyzfile, get_orca_compfile, get_orca_gbwfile, restore_orbitals,
+                   MissingFileError, SettingsError, SlurmifyWarning)
+
+COPY_BACK = ("end", "step")
+
+# Files written by an ORCA step (see utils.orca_copy_back) that later steps find in $SCRATCH
+ORCA_PRODUCTS = (".hess", ".xyz", ".gbw")
+
+
+def resources(steps):
+    """
+    The allocation of a pipeline: the largest of the steps, for the sum of their times
+    :param steps: list of steps, see pipeline_job
+    :return: dict of keyword arguments of utils.sbatch_directives
+    """
+    from history import duration_seconds, slurm_time
+
+    first = steps[0]["settings"]
+    cluster = first["cluster"]
+    mrchem = [step["settings"] for step in steps if step["manifest"]["program"] == "mrchem"]
+    # ORCA and Gaussian jobs do not request memory on Fram
+    memories = [step["settings"]["memory"] for step in steps if step["settings"].get("memory") is not None
+                and (cluster != "fram" or step["manifest"]["program"] == "mrchem")]
+    for memory in memories:
+        check_memory(memory)
+    mem_per_cpu = [settings["memory_per_cpu"] for settings in mrchem if settings.get("memory_per_cpu") is not None]
+    for memory in mem_per_cpu:
+        check_memory(memory)
+
+    seconds = 0
+    for step in steps:
+        duration = duration_seconds(step["settings"]["time"])
+        if duration is None:
+            raise SettingsError(f"Step {step['name']} has no valid time limit: {step['settings']['time']}")
+        seconds += duration
+
+    return dict(slurm_account=first["account"], slurm_mail=first["mail"], slurm_partition=first["partition"],
+                is_dev=first.get("dev"), loc=any(step["settings"].get("loc") for step in steps),
+                slurm_nodes=str(max(int(step["settings"]["nodes"]) for step in steps)),
+                slurm_ntasks_per_node=str(max(int(step["settings"]["ntasks"]) for step in steps)),
+                slurm_cpus_per_task=str(max(int(settings["cpus_per_task"]) for settings in mrchem)) if mrchem else None,
+                slurm_memory=f"{max(memory_gb(memory) for memory in memories):g}GB" if memories else None,
+                slurm_mem_per_cpu=max(mem_per_cpu, key=memory_gb) if mem_per_cpu and not memories else None,
+                slurm_time=slurm_time(seconds))
+
+
+def pipeline_job(name, steps, copy_back="end"):
+    """
+    Generate a job script that runs the steps of a pipeline one after the other in one allocation
+    and one scratch directory. Must be called from the directory containing the input files.
+    :param name: name of the pipeline, used for the job name and the .log/.err files
+    :param steps: list of dicts with "name" (unique), "settings" (as passed to utils.job_for_input), and
+                  "manifest" (of the input file, from utils.scan_input), in the order they are run.
+                  The ORCA auxiliary files written by earlier steps need not exist. "initorb"/"initchk"
+                  of an MRChem step may name an earlier MRChem step, whose orbitals are then used
+    :param copy_back: "end" to copy back the results of all steps at the end, "step" after every step
+    :return: job file as a list of lines
+    """
+    if not steps:
+        raise SettingsError("The pipeline has no steps")
+    if copy_back not in COPY_BACK:
+        raise SettingsError(f"Unknown copy back mode: {copy_back}. Use one of {', '.join(COPY_BACK)}")
+    cluster = steps[0]["settings"]["cluster"]
+    if any(step["settings"]["cluster"] != cluster for step in steps):
+        raise SettingsError("All steps of a pipeline must run on the same cluster")
+    programs = {step["name"]: step["manifest"]["program"] for step in steps}
+    if "mrchem" in programs.values() and cluster not in ["saga", "fram", "betzy"]:
+        raise SettingsError(f"MRChem is not set up on {cluster}. Please update MRChem!")
+
+    # Files staged once at the start, and the orbitals of MRChem steps that later steps start from
+    stage_in, produced, snapshots = [], set(), set()
+    for i, step in enumerate(steps):
+        settings, manifest = step["settings"], step["manifest"]
+        inputfile = settings["input"]
+        stage_in.append(inputfile + settings["extension_inputfile"])
+        if manifest["program"] == "orca":
+            for option, locate in [("chess", get_orca_hessfile), ("cxyz", get_orca_xyzfile),
+                                   ("ccomp", get_orca_compfile), ("cgbw", get_orca_gbwfile)]:
+                if settings.get(option):
+                    auxfile = locate(inputfile + settings["extension_inputfile"], manifest)
+                    if auxfile in produced:
+                        continue
+                    if not os.path.isfile(auxfile):
+                        raise MissingFileError(f"Error! The file specified ({auxfile}) does not exist.")
+                    stage_in.append(auxfile)
+            produced.update(inputfile + suffix for suffix in ORCA_PRODUCTS)
+        elif manifest["program"] == "gaussian" and settings.get("cchk"):
+            if os.path.isfile(inputfile + ".chk"):
+                stage_in.append(inputfile + ".chk")
+            else:
+                warnings.warn(f"Copy of .chk file requested, but the file does not exist ({inputfile+'.chk'}). Continuing without copying file.",
+                              SlurmifyWarning)
+        elif manifest["program"] == "mrchem":
+            reference = settings.get("initorb") if settings.get("initorb") is not None else settings.get("initchk")
+            if reference in programs:
+                earlier = [other["name"] for other in steps[:i]]
+                if reference not in earlier or programs[reference] != "mrchem":
+                    raise SettingsError(f"Step {step['name']}: initorb/initchk must name an earlier MRChem step, not {reference}")
+                snapshots.add(reference)
+
+    stamp = timestamp()
+    jobfile = timestamp_header(stamp, "-" * len(stamp))
+    jobfile += sbatch_directives(identifier=name, outputfile=name, **resources(steps))
+    jobfile += telemetry_start(cluster)
+    jobfile.append("set -o errexit")
+    jobfile.append("set -o nounset")
+    jobfile.append("")
+    jobfile += scratch_setup(cluster)
+    jobfile += staging_functions(cluster)
+    if "mrchem" in programs.values():
+        jobfile += orbstore_functions(cluster)
+    jobfile += telemetry_functions(cluster, name)
+
+    jobfile += telemetry_phase(cluster, "stage_in")
+    jobfile += stage_files(cluster, list(dict.fromkeys(stage_in)), "$SCRATCH")
+    jobfile.append("")
+    jobfile.append("cd $SCRATCH")
+    jobfile.append("")
+
+    deferred = []
+    report = staging_report(cluster)
+    for step in steps:
+        settings, program = step["settings"], step["manifest"]["program"]
+        inputfile = settings["input"]
+        outputfile = settings.get("output") or inputfile
+        ext_in, ext_out = settings["extension_inputfile"], settings["extension_outputfile"]
+
+        # Each step loads its own environment in a subshell
+        if program == "orca":
+            environment = ["module purge", f"module load {vars[cluster]['mpi_version']}"]
+            environment += [line for line in orca_environment(cluster) if line]
+            commands = [orca_command(inputfile, outputfile, ext_in, ext_out)]
+            results = orca_copy_back(cluster, inputfile, ccomp=settings.get("ccomp"))
+        elif program == "gaussian":
+            environment = ["module purge", f"module load {vars[cluster]['gaussian_version']}"]
+            if cluster == "saga":
+                environment.append("export GAUSS_LFLAGS2='--LindaOptions -s 20000000'")
+            commands = []
+            if cluster == "stallo":
+                if ext_in != ".com":
+                    commands.append(f"mv {inputfile+ext_in} {inputfile+'.com'}")
+                commands.append(f"G09.prep.slurm {inputfile}")
+                if ext_in != ".com":
+                    commands.append(f"mv {inputfile+'.com'} {inputfile+ext_in}")
+            commands.append(gaussian_command(inputfile, outputfile, ext_in, ext_out))
+            results = gaussian_copy_back(cluster, inputfile)
+        else:
+            environment = [f"source {vars[cluster]['mrchem_environ']}",
+                           f"export OMP_NUM_THREADS={settings['cpus_per_task']}"]
+            commands = [mrchem_command(cluster, inputfile, settings["ntasks"], settings.get("cmd"))]
+            results = [line for line in mrchem_copy_back(cluster, inputfile, ext_out) if line not in report]
+
+        jobfile.append(f"# Step {step['name']} ({program}: {inputfile + ext_in})")
+        if program == "mrchem":
+            option = "initorb" if settings.get("initorb") is not None else "initchk"
+            reference = settings.get(option)
+            if reference is not None:
+                target = "initial_guess" if option == "initorb" else "checkpoint"
+                jobfile.append(f"rm -rf $SCRATCH/{target}")
+                if reference in snapshots:
+                    jobfile.append(f"cp -r $SCRATCH/steps/{reference}/{'orbitals' if option == 'initorb' else 'checkpoint'} $SCRATCH/{target}")
+                else:
+                    jobfile += restore_orbitals(cluster, reference, target)
+        jobfile += telemetry_phase(cluster, f"compute_{step['name']}")
+        jobfile.append("(")
+        jobfile.append("    set +o nounset")
+        jobfile += [f"    {line}" for line in environment]
+        jobfile.append("    set -o nounset")
+        jobfile += [f"    {line}" for line in commands]
+        jobfile.append(")")
+        if step["name"] in snapshots:
+            jobfile.append(f"mkdir -p $SCRATCH/steps/{step['name']}")
+            jobfile.append(f"cp -r orbitals checkpoint $SCRATCH/steps/{step['name']}/")
+        if copy_back == "step" or program == "mrchem":
+            jobfile += telemetry_phase(cluster, f"copy_back_{step['name']}")
+            jobfile += [line for line in results if line]
+        else:
+            deferred += [line for line in results if line]
+        jobfile.append("")
+
+    if deferred:
+        jobfile += telemetry_phase(cluster, "copy_back")
+        jobfile += deferred
+        jobfile.append("")
+    jobfile += report
+
+    # Clean up (On Fram and Saga clean up is automatic)
+    if cluster == "stallo":
+        jobfile += telemetry_phase(cluster, "cleanup")
+        jobfile.append("cd $SLURM_SUBMIT_DIR")
+        jobfile.append("rm -rf $SCRATCH")
+        jobfile.append("")
+
+    jobfile.append("exit 0")
+    return jobfile
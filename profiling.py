@@ -0,0 +1,180 @@
+"""
+Phase timing for the command line (--profile). Code that does something worth timing is wrapped in
+
+    with phase("scan", inputpath):
+        ...
+
+which only costs a test of a global while profiling is off. The phases are
+
+    scan      reading input files to determine the program and the files they reference
+    aux       checking that the referenced auxiliary files exist
+    hash      content hashes of inputs (--cache_hash, -U)
+    cache     loading and storing the classification cache
+    render    generating job scripts
+    write     writing job and index files
+    submit    sbatch calls
+    daemon    requests to a Slurmify daemon (--socket)
+    run       everything else (argument parsing, printing, ...)
+
+Inputs are identified by their absolute path without extension. Phases may be nested (e.g. aux
+within render), and the summary counts the time of a nested phase only for that phase, and for
+the input of the enclosing phase if it does not name one itself.
+
+The report is a Chrome trace, which can be opened in chrome://tracing or https://ui.perfetto.dev,
+with the totals per phase and per input added under "phases" and "inputs". With --cprofile, a cProfile dump of the main process is written as well (read it with
+'python -m pstats FILE').
+"""
+import os
+import sys
+import time
+from _thread import get_ident  # not threading, which is slow to import
+
+# Recorded (phase, item, start, end, pid, thread) tuples, or None while profiling is off
+_events = None
+
+
+def enable():
+    global _events
+    _events = []
+
+
+def enabled():
+    return _events is not None
+
+
+class phase:
+    """Context manager recording the wall time of a phase, optionally for one input (item)"""
+    __slots__ = ("name", "item", "start")
+
+    def __init__(self, name, item=None):
+        self.name = name
+        self.item = item
+
+    def __enter__(self):
+        if _events is not None:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if _events is not None:
+            _events.append((self.name, self.item, self.start, time.perf_counter(), os.getpid(), get_ident()))
+
+
+def call(record, function, *args):
+    """
+    Run a function in a worker process, and return its result together with the events it recorded,
+    for merge() in the parent process
+    :param record: whether the parent process is profiling
+    """
+    global _events
+    _events = [] if record else None
+    try:
+        return function(*args), _events or []
+    finally:
+        _events = None
+
+
+def merge(outcome):
+    """Add the events of a worker process to those of this process, and return the result of the worker"""
+    result, events = outcome
+    if _events is not None:
+        _events.extend(events)
+    return result
+
+
+def summary(events):
+    """
+    Totals per phase and per input. Time spent in a nested phase is only counted for that phase
+    :param events: list of recorded events
+    :return: dict mapping phase to dict with calls, total, self, and max (seconds), and
+             dict mapping input to dict mapping phase to seconds (self time)
+    """
+    phases, inputs = {}, {}
+    threads = {}
+    for event in events:
+        threads.setdefault(event[4:6], []).append(event)
+    for thread_events in threads.values():
+        # Events are recorded when they end, so sort parents before their children
+        thread_events.sort(key=lambda e: (e[2], -e[3]))
+        stack, own, items = [], {}, {}
+        for event in thread_events:
+            while stack and stack[-1][3] <= event[2]:
+                stack.pop()
+            own[id(event)] = event[3] - event[2]
+            items[id(event)] = event[1]
+            if stack:
+                own[id(stack[-1])] -= event[3] - event[2]
+                if event[1] is None:
+                    items[id(event)] = items[id(stack[-1])]
+            stack.append(event)
+        for event in thread_events:
+            name, start, end = event[0], event[2], event[3]
+            item = items[id(event)]
+            totals = phases.setdefault(name, dict(calls=0, total=0.0, self=0.0, max=0.0))
+            totals["calls"] += 1
+            totals["total"] += end - start
+            totals["self"] += own[id(event)]
+            totals["max"] = max(totals["max"], end - start)
+            if item is not None:
+                per_input = inputs.setdefault(item, {})
+                per_input[name] = per_input.get(name, 0.0) + own[id(event)]
+    return phases, inputs
+
+
+def chrome_trace(events):
+    """Events in the Chrome trace event format (complete events, in microseconds)"""
+    t0 = min((event[2] for event in events), default=0.0)
+    return [dict(name=name, cat="slurmify", ph="X", ts=(start - t0) * 1e6, dur=(end - start) * 1e6, pid=pid, tid=tid,
+                 args={"input": item} if item is not None else {})
+            for name, item, start, end, pid, tid in events]
+
+
+def report(path, argv=None):
+    """
+    Write the trace of the recorded events, and print the summary table to stderr
+    :param path: path of the JSON file
+    :param argv: command line, stored in the file
+    """
+    import json
+
+    events = list(_events or [])
+    phases, inputs = summary(events)
+    with open(path, "w") as f:
+        json.dump(dict(traceEvents=chrome_trace(events), displayTimeUnit="ms", argv=argv, phases=phases,
+                       inputs=inputs), f)
+
+    wall = max((e[3] for e in events), default=0.0) - min((e[2] for e in events), default=0.0)
+    print(f"\nProfile: {wall:.3f} s wall time, written to {path}", file=sys.stderr)
+    print(f"{'phase':<8} {'calls':>7} {'total s':>9} {'self s':>9} {'mean ms':>9} {'max ms':>9} {'% wall':>7}", file=sys.stderr)
+    for name, totals in sorted(phases.items(), key=lambda item: -item[1]["self"]):
+        print(f"{name:<8} {totals['calls']:>7} {totals['total']:>9.3f} {totals['self']:>9.3f} "
+              f"{totals['total'] / totals['calls'] * 1000:>9.2f} {totals['max'] * 1000:>9.2f} "
+              f"{totals['self'] / wall if wall else 0:>7.0%}", file=sys.stderr)
+    slowest = sorted(inputs.items(), key=lambda item: -sum(item[1].values()))[:5]
+    if len(inputs) > 1:
+        print("Slowest inputs: " + ", ".join(f"{os.path.basename(item)} ({sum(times.values()) * 1000:.1f} ms)"
+                                             for item, times in slowest), file=sys.stderr)
+
+
+def profiled(function, *args, path="slurmify_profile.json", cprofile=None, argv=None):
+    """
+    Run a function with phase timing (and cProfile) enabled, and report when it returns or exits
+    :param path: path of the trace file
+    :param cprofile: path of the cProfile dump. No cProfile if None
+    :param argv: command line, stored in the trace file
+    :return: the return value of the function
+    """
+    enable()
+    profiler = None
+    if cprofile is not None:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with phase("run"):
+            return function(*args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile)
+        report(path, argv=argv)
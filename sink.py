@@ -0,0 +1,112 @@
+"""
+Bundles of generated job files (--bundle). Instead of one small file per job, which means as
+many file creates on the metadata server of a parallel file system, all job files (and the index
+files of array and packed jobs) of a run are streamed into a single file:
+
+    <name>.tar            a tar archive. Members are named by their path relative to the bundle
+    <name>                the job files one after the other, and
+    <name>.index          one "<member>\t<offset>\t<size>" line per job file
+
+The bundle is written to a temporary file, in large chunks, and renamed when it is complete.
+Jobs are submitted from the bundle by passing the script to sbatch on stdin, and array and
+packed jobs read their index from the bundle at runtime (see Bundle.command), so that no file
+is created per job. 'tar -xf <name>.tar' recreates the individual files.
+"""
+import os
+import io
+import time
+import tarfile
+
+# Bytes collected in memory before they are written to the bundle
+BUFFER_SIZE = 1 << 20
+
+
+class Bundle:
+    """Write job files into a bundle, and read them back after it is closed"""
+
+    def __init__(self, path):
+        """
+        :param path: path of the bundle. A tar archive if it ends with .tar, else a packed file with an index
+        """
+        self.path = os.path.abspath(path)
+        self.is_tar = self.path.endswith(".tar")
+        self.tmp = f"{self.path}.{os.getpid()}.tmp"
+        self.members = {}  # member -> (offset, size) of its contents in the bundle
+        self.fd = None
+        self.file = open(self.tmp, "wb", buffering=BUFFER_SIZE)
+        self.tar = tarfile.open(fileobj=self.file, mode="w", format=tarfile.GNU_FORMAT) if self.is_tar else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def member(self, path):
+        """Name of a job file in the bundle: its path relative to the directory of the bundle"""
+        return os.path.relpath(os.path.abspath(path), os.path.dirname(self.path))
+
+    def write(self, path, lines):
+        """
+        Add a job file to the bundle
+        :param path: path the job file would have been written to
+        :param lines: job file as a list of lines
+        """
+        data = ("\n".join(lines) + "\n" if lines else "").encode()
+        member = self.member(path)
+        if self.is_tar:
+            info = tarfile.TarInfo(member)
+            info.size, info.mode, info.mtime = len(data), 0o644, int(time.time())
+            self.tar.addfile(info, io.BytesIO(data))
+            # The data ends the member, padded to whole blocks
+            offset = self.tar.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        else:
+            offset = self.file.tell()
+            self.file.write(data)
+        self.members[member] = (offset, len(data))
+
+    def command(self, path):
+        """Shell command printing a job file of the bundle, e.g. to read an index at runtime"""
+        offset, size = self.members[self.member(path)]
+        return f"tail -c +{offset + 1} {self.path} | head -c {size}"
+
+    def close(self):
+        """Finish the bundle, and open it for reading"""
+        if self.file is None:
+            return
+        if self.is_tar:
+            self.tar.close()
+        else:
+            with open(f"{self.path}.index.{os.getpid()}.tmp", "w") as f:
+                f.write("".join(f"{member}\t{offset}\t{size}\n" for member, (offset, size) in self.members.items()))
+            os.replace(f"{self.path}.index.{os.getpid()}.tmp", f"{self.path}.index")
+        self.file.close()
+        self.file = None
+        os.replace(self.tmp, self.path)
+        self.fd = os.open(self.path, os.O_RDONLY)
+
+    def abort(self):
+        """Discard the bundle"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.remove(self.tmp)
+
+    def read(self, path):
+        """
+        Contents of a job file in the closed bundle. Safe to call from several threads
+        :param path: path the job file would have been written to
+        :return: job file as a string
+        """
+        offset, size = self.members[self.member(path)]
+        return os.pread(self.fd, size, offset).decode()
+
+    def __contains__(self, path):
+        return self.member(path) in self.members
+
+    def __del__(self):
+        if self.fd is not None:
+            os.close(self.fd)
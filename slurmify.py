@@ -2,13 +2,9 @@
 # coding=utf-8
 
 import argparse
+import warnings
 import sys
 import os
-import subprocess
-import json
-from socket import gethostname
-
-from utils import orca_job, gaussian_job, mrchem_job, vars, input_origin, make_test_inputs, header, maxbilling_okay, billing
 
 ROOT = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(ROOT)
@@ -33,20 +29,31 @@ ACCOUNTS = dict(fram="nn4654k",
 AFFIRMATIVE = ["yes", "y", ""]
 CLUSTERS = ["saga", "fram", "stallo", "betzy"]
 
-# Determine cluster
-if "stallo" in gethostname():
-    cluster = "stallo"
-elif "fram" in gethostname():
-    cluster = "fram"
-elif "saga" in gethostname():
-    cluster = "saga"
-elif "betzy" in gethostname():
-    cluster = "betzy"
-else:
-    cluster = "saga"
+# Subcommands are handled by the main() function of their module
+SUBCOMMANDS = {"cache": "cache", "serve": "daemon", "orbstore": "orbstore", "sweep": "sweep", "history": "history",
+               "feed": "feed", "workflow": "workflow", "status": "status"}
+
+# Options that control how Slurmify runs, rather than what goes into the job file
+RUN_OPTIONS = {"destination", "silent", "force", "execute", "test", "batch", "nprocs", "array", "throttle", "pack",
+               "no_cache", "cache_hash", "sbatch", "ledger", "submit_workers", "retries", "socket", "update",
+               "profile", "cprofile", "bundle", "feed"}
+
 
+def detect_cluster():
+    """Determine the cluster from the host name. Defaults to Saga"""
+    hostname = os.uname().nodename
+    for name in ["stallo", "fram", "saga", "betzy"]:
+        if name in hostname:
+            return name
+    return "saga"
 
-epilog = f"""
+
+def build_epilog(cluster):
+    """Build the help text. This is only done when the help is actually requested"""
+    import json
+    from utils import header, vars
+
+    return f"""
 {header("usage")}
 Slurmify offers a universal interface for generating SLURM job script files for
 Gaussian16, ORCA, and MRChem jobs. Slurmify detects whether you are logged in to
@@ -112,6 +119,142 @@ Note that the meaning of the ' -T / --ntasks' option varies depending on whether
 the '--loc' flag is activated or deactivated. For loc jobs, -T refers to the
 SLURM variable '$NTASKS', while '$NTASKS-PER-NODE' for deloc jobs.
 
+Job files for many inputs can be generated in one go with the '-B / --batch'
+option, which takes a directory, a glob pattern, or a file listing one input
+file per line. The job files are written next to the input files, and
+existing job files are skipped unless '-f' is given. Use '-j' to spread the
+work over several processes:
+
+$ slurmify.py -B conformers/ -m 10GB -j 8
+
+Adding '--array' generates a single SLURM array job (one per program) plus an
+index file mapping each array task to its input, instead of one job file per
+input. Limit the number of simultaneously running tasks with '--throttle'.
+
+Many small ORCA or Gaussian jobs can instead be packed into one allocation
+with '--pack N': a single job on one node runs N inputs at a time, each with
+'--ntasks' cores and its own scratch directory, and starts the next input as
+soon as one finishes. '--time' and '--memory' are for all N inputs together
+and for one input, respectively. The exit status of every input is written
+to <name>.status, and inputs that succeeded are skipped if the job is rerun:
+
+$ slurmify.py -B singlepoints/ --pack 8 -T 4 -m 8GB -t 0-04:00:00
+
+Accounts with a limit on the number of submitted jobs (MaxSubmitJobs) can
+feed a large campaign into the queue gradually: '--feed' adds the generated
+job files to a persistent submission queue, and 'feed run' submits them as
+slots free up, checking the queue with one squeue call per interval. The
+feeder can be stopped and restarted without submitting a job twice:
+
+$ slurmify.py -B campaign/ -m 10GB --feed
+$ slurmify.py feed run --max_jobs 400 --interval 60
+$ slurmify.py feed status
+
+Jobs that may hit their time limit can be resubmitted automatically: with
+--resubmit N, SLURM signals the job --signal_lead seconds (default: 600) before
+the time limit, and the job stops the calculation, copies back its files (ORCA
+.gbw, Gaussian .chk, MRChem checkpoint), and resubmits itself, at most N times.
+The resubmitted job stages these files again, so the input must be set up to
+restart from them (not with --array or --pack):
+
+$ slurmify.py -i h2o -m 10GB -t 1-00:00:00 --resubmit 3 -X
+
+Multi-step workflows (e.g. ORCA opt -> ORCA freq -> MRChem single point) are
+described in a JSON file (see workflow.py), and submitted at once as chained
+jobs that start when the previous step completed (--dependency=afterok). The
+.hess/.xyz/.gbw files of ORCA steps and the orbitals of MRChem steps are
+staged for the steps after them:
+
+$ slurmify.py workflow pipeline.json -X
+
+With --single, the steps of each molecule run back to back in one job and one
+scratch directory instead, and the results are copied back at the end (or
+after every step with --copy_back step).
+
+To see which jobs of a campaign completed, failed, are running, or never ran,
+use 'slurmify.py status', which only reads the end of every output:
+
+$ slurmify.py status campaign/ [-l] [--only failed] [--json]
+
+To avoid creating thousands of small files on a parallel file system, '--bundle
+FILE' writes all job files (and index files) into one bundle instead: a tar
+archive if FILE ends with .tar, else a packed file plus FILE.index listing the
+offset of every job file. With '-X', the jobs are submitted from the bundle,
+and array and packed jobs read their index from it at runtime:
+
+$ slurmify.py -B conformers/ -m 10GB --bundle conformers.tar -X
+
+In batch mode, the classification of every input file and the files it
+references are cached in '.slurmify_cache.sqlite' next to the inputs, so that
+reruns only read inputs whose modification time or size changed. Inspect or
+prune the cache with
+
+$ slurmify.py cache show|prune|clear [directory]
+
+With '-U / --update', existing job files are only rewritten (and, with '-X',
+resubmitted) if the job itself or the contents of its input changed since
+the last run. The timestamp in the header does not count as a change. This
+works for single inputs, batches, and array jobs alike.
+
+Jobs submitted with '-X' are passed to sbatch concurrently, and sbatch calls
+failing with transient errors (e.g. "Socket timed out") are retried with
+exponential backoff. The job IDs can be recorded in a ledger file with
+'--ledger'. Use '--sbatch' (or the SLURMIFY_SBATCH environment variable) to
+submit through a different command.
+
+Pipelines calling Slurmify many times can start a daemon that keeps the
+configuration and the compiled job templates in memory, and point the
+command line (or the client in daemon.py) to it:
+
+$ slurmify.py serve --socket /tmp/slurmify.sock &
+$ slurmify.py -i molecule -m 10GB --socket /tmp/slurmify.sock
+
+The socket can also be given in the SLURMIFY_SOCKET environment variable.
+Stop the daemon with 'slurmify.py serve --stop'.
+
+To find out where the time of a slow run goes, add '--profile [FILE]'. The
+time spent reading inputs, checking auxiliary files, hashing, rendering,
+writing, and submitting is recorded per input (also in the worker processes
+of '-j'), a summary is printed at the end, and a Chrome trace is written to
+FILE (default: slurmify_profile.json; open it in https://ui.perfetto.dev).
+'--cprofile FILE' also writes a cProfile dump of the main process.
+
+The billing units of a job are computed from the billing model in utils.py.
+To find the cheapest layouts for a number of CPUs and amount of memory, run
+
+$ slurmify.py sweep --cores 64 -m 200GB
+
+which lists the layouts for which no other layout is cheaper while giving at
+least as many CPUs and as much memory. With '--autobill', MRChem jobs get the
+cheapest partition and ntasks x cpus-per-task layout for the requested CPUs
+(ntasks times cpus per task) and memory.
+
+Slurmify can learn the memory and walltime of your jobs from completed ones.
+Record finished jobs (from sacct, or from the .log files of the jobs) with
+
+$ slurmify.py history ingest [--since 2021-01-01]
+$ slurmify.py history ingest */*.log
+
+The jobs are stored by program, method/basis keywords, and number of atoms.
+With '--predict', the memory and time of new jobs are set to the 95% quantile
+(or '--predict 0.8' etc.) of similar completed jobs plus a margin. Show the
+history, or suggestions for inputs, with
+
+$ slurmify.py history show|suggest [inputs]
+
+Repeated ingests only add jobs that are not yet recorded. Summarize the core
+hours, billing, CPU and memory efficiency, and queue wait of your jobs with
+
+$ slurmify.py history report [--by program account] [--since 2021-01-01]
+
+On clusters with 'orbstore' set in utils.py, MRChem jobs put their orbitals
+and checkpoints into a content-addressed store, where identical files are
+kept only once, and the .orbitals/.checkpoint files name a manifest in the
+store. Pass that manifest to '--initorb'/'--initchk' like a directory.
+Maintain the store with
+
+$ slurmify.py orbstore ingest|ls|gc|verify
+
 Instructions for obtaining the MRChem code is here: 
 https://mrchem.readthedocs.io/en/latest/index.html
 
@@ -156,67 +299,91 @@ Current PATH:
 |===========================================|
 """
 
-# Set up argument parser
-description = "Script for generating SLURM job files for MRChem, ORCA, and Gaussian16 on Saga, Stallo, and Fram"
-parser = argparse.ArgumentParser(description=description, epilog=epilog,
-                                 formatter_class=argparse.RawDescriptionHelpFormatter)
-
-parser.add_argument("-d", "--destination", metavar="<>", type=str, default=".", help="[str] Path to job directory")
-parser.add_argument("-i", "--input", metavar="<>", type=str, help="[str] Name of input file")
-parser.add_argument("-o", "--output", metavar="<>", type=str, help="[str] Name of output file")
-parser.add_argument("-D", "--dev", action="store_true", help="Generate job suitable for development queue")
-parser.add_argument("-S", "--silent", action="store_true", help="Run in silent mode")
-parser.add_argument("-f", "--force", action="store_true", help="Overwrite job files without asking for permission")
-parser.add_argument("-X", "--execute", action="store_true", help="Submit job to queue")
-parser.add_argument("-I", "--identifier", type=str, metavar="<>", help="How job name is presented in the queue")
-parser.add_argument("--test", action="store_true", help="Generate ORCA, Gaussian, and MRChem input files and submit to queue")
-parser.add_argument("--loc", action="store_true", help="Specify number of nodes, which 'localizes' the requested tasks over specific nodes")
-parser.add_argument("--checkbill", action="store_true", help="Check whether the job's billing exceeds the maximum allowed for the partition")
-
-# SLURM specific arguments
-parser.add_argument("-m", "--memory", metavar="<>",type=str, help="Total memory for calculation")
-parser.add_argument("-mpc", "--memory_per_cpu", metavar="<>",type=str, help="Memory per CPU")
-parser.add_argument("-a", "--account", metavar="<>",type=str, help="Use this account on cluster")
-parser.add_argument("-n", "--nodes", metavar="<>",type=str, default="1", help="Specify number of nodes")
-parser.add_argument("-T", "--ntasks", metavar="<>",type=str, default="10", help="SLURM variable $NTASKS(-PER-NODE)")
-parser.add_argument("-p", "--cpus_per_task", metavar="<>",type=str, default="10", help="SLURM variable $CPUS_PER_TASK")
-parser.add_argument("-t", "--time", type=str, metavar="<>",default="00-00:30:00", help="Specify time [dd-hh:mm:ss]")
-parser.add_argument("-M", "--mail", type=str, metavar="<>",default="NONE", help="Specify the SLURM mail type")
-parser.add_argument("-c", "--cmd", type=str, metavar="<>",help="Specify 'mpirun' or 'srun' to submit job.")
-parser.add_argument("-P", "--partition", type=str, metavar="<>",default="normal", help="Specify the queueing partition.")
-parser.add_argument("-C", "--cluster", type=str, metavar="<>",choices=CLUSTERS, help="Select custom cluster for the job")
-
-# Arguments for copying files to scratch
-parser.add_argument("--chess", action="store_true", help="Look for and copy .hess file to scratch (for ORCA jobs)")
-parser.add_argument("--cxyz", action="store_true", help="Look for and copy .xyz file to scratch (for ORCA jobs)")
-parser.add_argument("--ccomp", action="store_true", help="Look for and copy .cmp file to scratch (for ORCA jobs)")
-parser.add_argument("--cgbw", action="store_true", help="Look for and copy .gbw file to scratch (for ORCA jobs)")
-parser.add_argument("--cchk", action="store_true", help="Copy .chk file to scratch (for Gaussian jobs)")
-parser.add_argument("--initorb", metavar="<>", type=str, help="Path to directory storing orbitals to be copied (for MRChem jobs)")
-parser.add_argument("--initchk", metavar="<>", type=str, help="Path to directory storing checkpoint orbitals to be copied (for MRChem jobs)")
-
-args = parser.parse_args()
-
-# Now overwrite the automatically determined cluster, if specified
-if args.cluster is not None:
-    cluster = args.cluster
-
-# Sort out some things
-if args.output is None: args.output = args.input
-if args.account is None: args.account = ACCOUNTS[cluster]
-if args.identifier is None: args.identifier = args.input
-
-# Evaluate whether the destination exists, and ask for permission to create if
-if not os.path.isdir(args.destination):
-        answer = input(f"The directory \"{args.destination}\" does not exist. Do you want to create it? (Y/n) ")
-        if answer not in AFFIRMATIVE:
-            sys.exit("Aborting")
-        else:
-            os.mkdir(args.destination)
-            print(f"Created \"{args.destination}\"")
 
-# Run testing module
-if args.test:
+def build_parser():
+    # Set up argument parser
+    description = "Script for generating SLURM job files for MRChem, ORCA, and Gaussian16 on Saga, Stallo, and Fram"
+    parser = argparse.ArgumentParser(description=description,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("-d", "--destination", metavar="<>", type=str, default=".", help="[str] Path to job directory")
+    parser.add_argument("-i", "--input", metavar="<>", type=str, help="[str] Name of input file")
+    parser.add_argument("-o", "--output", metavar="<>", type=str, help="[str] Name of output file")
+    parser.add_argument("-D", "--dev", action="store_true", help="Generate job suitable for development queue")
+    parser.add_argument("-S", "--silent", action="store_true", help="Run in silent mode")
+    parser.add_argument("-f", "--force", action="store_true", help="Overwrite job files without asking for permission")
+    parser.add_argument("-U", "--update", action="store_true", help="Only (re)generate and submit job files whose settings or input changed since the last run")
+    parser.add_argument("-X", "--execute", action="store_true", help="Submit job to queue")
+    parser.add_argument("-I", "--identifier", type=str, metavar="<>", help="How job name is presented in the queue")
+    parser.add_argument("--test", action="store_true", help="Generate ORCA, Gaussian, and MRChem input files and submit to queue")
+    parser.add_argument("--loc", action="store_true", help="Specify number of nodes, which 'localizes' the requested tasks over specific nodes")
+    parser.add_argument("--checkbill", action="store_true", help="Check whether the job's billing exceeds the maximum allowed for the partition")
+    parser.add_argument("--predict", metavar="<>", type=float, nargs="?", const=0.95, help="[float] Set memory and time to this quantile (default: 0.95) of similar completed jobs (see 'slurmify.py history')")
+    parser.add_argument("--autobill", action="store_true", help="Use the cheapest partition and ntasks x cpus-per-task layout for the requested CPUs and memory (for MRChem jobs)")
+    parser.add_argument("-B", "--batch", metavar="<>", type=str, help="[str] Generate job files for all inputs in a directory, glob pattern, or list file")
+    parser.add_argument("-j", "--nprocs", metavar="<>", type=int, default=1, help="[int] Number of processes used in batch mode")
+    parser.add_argument("--array", action="store_true", help="In batch mode, generate one SLURM array job instead of one job file per input")
+    parser.add_argument("--pack", metavar="<>", type=int, help="[int] In batch mode, run all inputs in one allocation as a task farm with this many inputs (of --ntasks cores each) at a time")
+    parser.add_argument("--throttle", metavar="<>", type=int, help="[int] Maximum number of simultaneously running array tasks")
+    parser.add_argument("--bundle", metavar="<>", type=str, help="[str] In batch mode, write all job files into this bundle instead of one file per job: a tar archive if it ends with .tar, else a packed file with an index (FILE.index)")
+    parser.add_argument("--feed", metavar="<>", type=str, nargs="?", const=".slurmify_feed.sqlite",
+                        help="[str] In batch mode, add the job files to this submission queue (default: .slurmify_feed.sqlite) instead of submitting them; see 'slurmify.py feed'")
+    parser.add_argument("--no_cache", action="store_true", help="In batch mode, scan every input instead of using the classification cache")
+    parser.add_argument("--profile", metavar="<>", type=str, nargs="?", const="slurmify_profile.json",
+                        help="[str] Time every phase of the run, write a Chrome trace to this file (default: slurmify_profile.json), and print a summary")
+    parser.add_argument("--cprofile", metavar="<>", type=str, help="[str] Also write a cProfile dump to this file (implies --profile)")
+    parser.add_argument("--cache_hash", action="store_true", help="Also compare content hashes when validating the classification cache")
+
+    # Arguments for submission
+    parser.add_argument("--sbatch", metavar="<>", type=str, help="[str] Command used to submit jobs (default: sbatch)")
+    parser.add_argument("--ledger", metavar="<>", type=str, help="[str] Append the job IDs of submitted jobs to this file")
+    parser.add_argument("--submit_workers", metavar="<>", type=int, default=8, help="[int] Maximum number of concurrent sbatch calls")
+    parser.add_argument("--retries", metavar="<>", type=int, default=5, help="[int] Number of retries on transient sbatch errors")
+    parser.add_argument("--socket", metavar="<>", type=str, default=os.environ.get("SLURMIFY_SOCKET"),
+                        help="[str] Generate and submit through the daemon ('slurmify.py serve') listening on this socket")
+
+    # SLURM specific arguments
+    parser.add_argument("-m", "--memory", metavar="<>",type=str, help="Total memory for calculation")
+    parser.add_argument("-mpc", "--memory_per_cpu", metavar="<>",type=str, help="Memory per CPU")
+    parser.add_argument("-a", "--account", metavar="<>",type=str, help="Use this account on cluster")
+    parser.add_argument("-n", "--nodes", metavar="<>",type=str, default="1", help="Specify number of nodes")
+    parser.add_argument("-T", "--ntasks", metavar="<>",type=str, default="10", help="SLURM variable $NTASKS(-PER-NODE)")
+    parser.add_argument("-p", "--cpus_per_task", metavar="<>",type=str, default="10", help="SLURM variable $CPUS_PER_TASK")
+    parser.add_argument("-t", "--time", type=str, metavar="<>",default="00-00:30:00", help="Specify time [dd-hh:mm:ss]")
+    parser.add_argument("-M", "--mail", type=str, metavar="<>",default="NONE", help="Specify the SLURM mail type")
+    parser.add_argument("-c", "--cmd", type=str, metavar="<>",help="Specify 'mpirun' or 'srun' to submit job.")
+    parser.add_argument("-P", "--partition", type=str, metavar="<>",default="normal", help="Specify the queueing partition.")
+    parser.add_argument("-C", "--cluster", type=str, metavar="<>",choices=CLUSTERS, help="Select custom cluster for the job")
+
+    # Arguments for copying files to scratch
+    parser.add_argument("--chess", action="store_true", help="Look for and copy .hess file to scratch (for ORCA jobs)")
+    parser.add_argument("--cxyz", action="store_true", help="Look for and copy .xyz file to scratch (for ORCA jobs)")
+    parser.add_argument("--ccomp", action="store_true", help="Look for and copy .cmp file to scratch (for ORCA jobs)")
+    parser.add_argument("--cgbw", action="store_true", help="Look for and copy .gbw file to scratch (for ORCA jobs)")
+    parser.add_argument("--cchk", action="store_true", help="Copy .chk file to scratch (for Gaussian jobs)")
+    parser.add_argument("--initorb", metavar="<>", type=str, help="Path to directory (or .tar.zst archive) storing orbitals to be copied (for MRChem jobs)")
+    parser.add_argument("--initchk", metavar="<>", type=str, help="Path to directory (or .tar.zst archive) storing checkpoint orbitals to be copied (for MRChem jobs)")
+    parser.add_argument("--resubmit", metavar="<>", type=int, help="[int] Near the time limit, copy back the .gbw/.chk/checkpoint files and resubmit the job, at most this many times")
+    parser.add_argument("--signal_lead", metavar="<>", type=int, default=600, help="[int] Seconds before the time limit at which the job is stopped and resubmitted (with --resubmit)")
+
+    return parser
+
+
+def submit(args, jobfiles, bundle=None):
+    """Submit job files with the options given on the command line. Exit with an error if any submission failed."""
+    from submit import submit_jobs, SBATCH
+
+    jobids, errors = submit_jobs(jobfiles, command=args.sbatch or SBATCH, max_workers=args.submit_workers,
+                                 retries=args.retries, ledger=args.ledger, silent=args.silent, bundle=bundle)
+    if errors:
+        sys.exit(f"{len(errors)} of {len(jobfiles)} jobs could not be submitted")
+    return jobids
+
+
+def run_test(args, cluster):
+    """Generate single-point jobs on the Hydrogen atom for all programs"""
+    from utils import orca_job, gaussian_job, mrchem_job, make_test_inputs, write_jobfile
+
     job_orca = orca_job(inputfile="orca_test", outputfile="orca_test", is_dev=False,
                         cluster=cluster, extension_inputfile=INPUT_EXTENSION, extension_outputfile=OUTPUT_EXTENSION,
                         loc=args.loc,
@@ -253,141 +420,243 @@ if args.test:
                             slurm_submit_cmd=args.cmd)
 
     # Create job files
-    with open(os.path.join(args.destination, "orca_test"+JOB_EXTENSION), "w") as f:
-        for line in job_orca:
-            f.write(line + "\n")
-
-    with open(os.path.join(args.destination, "gaussian_test"+JOB_EXTENSION), "w") as f:
-        for line in job_gaussian:
-            f.write(line + "\n")
-
-    with open(os.path.join(args.destination, "mrchem_test"+JOB_EXTENSION), "w") as f:
-        for line in job_mrchem:
-            f.write(line + "\n")
+    write_jobfile(os.path.join(args.destination, "orca_test"+JOB_EXTENSION), job_orca)
+    write_jobfile(os.path.join(args.destination, "gaussian_test"+JOB_EXTENSION), job_gaussian)
+    write_jobfile(os.path.join(args.destination, "mrchem_test"+JOB_EXTENSION), job_mrchem)
 
     # Create test input files
     make_test_inputs(destination=args.destination)
 
     # Submit jobs
     if args.execute:
-        os.chdir(args.destination)
-        for job in ["orca_test", "gaussian_test", "mrchem_test"]:
-            subprocess.call(["sbatch", job+JOB_EXTENSION])
+        submit(args, [os.path.join(args.destination, job+JOB_EXTENSION) for job in ["orca_test", "gaussian_test", "mrchem_test"]])
 
     sys.exit("Testing done")
 
-# Define name of job file
-jobname = os.path.join(args.destination, args.input + JOB_EXTENSION)
-
-# Determine origin of input file
-GaussianInput, OrcaInput, Mrcheminput = input_origin(os.path.join(args.destination, args.input+INPUT_EXTENSION))
-if not args.silent:
-    if GaussianInput:
-        print("Gaussian input file detected.")
-    elif OrcaInput:
-        print("ORCA input file detected.")
-    else:
-        print("MRChem input file detected.")
-
-# Make sure not to silently overwrite existing files
-if not args.force:
-    if os.path.isfile(jobname):
-        answer = input("The .job file exists. Do you want to overwrite it? (Y/n) ").lower()
-        if answer not in AFFIRMATIVE:
-            sys.exit("Aborted")
-
-# Generate job files
-if OrcaInput:
-    job = orca_job(inputfile=args.input, outputfile=args.output, is_dev=args.dev,
-                   cluster=cluster, extension_inputfile=INPUT_EXTENSION, extension_outputfile=OUTPUT_EXTENSION,
-                   slurm_account=ACCOUNTS[cluster],
-                   slurm_nodes=args.nodes,
-                   slurm_ntasks_per_node=args.ntasks,
-                   slurm_memory=args.memory,
-                   slurm_time=args.time,
-                   slurm_mail=args.mail,
-                   slurm_partition=args.partition,
-                   chess=args.chess,
-                   cxyz=args.cxyz,
-                   ccomp=args.ccomp,
-                   cgbw=args.cgbw,
-                   loc=args.loc,
-                   identifier=args.identifier)
-
-    with open(jobname, "w") as f:
-        for line in job:
-            f.write(line + "\n")
 
-    if not args.silent:
-        print(f"Generated {jobname}")
+def run_batch_mode(args, cluster):
+    """Generate (and submit) job files for all inputs of a batch"""
+    from batch import collect_inputs, run_batch
+    from cache import cache_path
+    from profiling import phase
+
+    inputs = collect_inputs(args.batch, extension=INPUT_EXTENSION)
+    if not inputs:
+        sys.exit(f"No input files found for \"{args.batch}\"")
+    cache = None if args.no_cache else cache_path(inputs)
+    settings = dict(args.__dict__, output=None, cluster=cluster,
+                    extension_inputfile=INPUT_EXTENSION, extension_outputfile=OUTPUT_EXTENSION)
+    bundle = None
+    if args.bundle is not None:
+        from sink import Bundle
+
+        if args.update:
+            sys.exit("--bundle cannot be combined with --update, since the bundle is rewritten on every run")
+        if os.path.exists(args.bundle) and not args.force:
+            sys.exit(f"{args.bundle} exists. Use -f to overwrite.")
+        bundle = Bundle(args.bundle)
+    try:
+        if args.array or args.pack:
+            from jobarray import write_arrays
+
+            name = args.identifier or os.path.basename(os.path.dirname(inputs[0])) or "slurmify_array"
+            results = write_arrays(inputs, settings, name, throttle=args.throttle, job_extension=JOB_EXTENSION,
+                                   force=args.force, silent=args.silent, cache=cache, use_hash=args.cache_hash,
+                                   update=cache_path(inputs) if args.update else None, slots=args.pack, bundle=bundle)
+        else:
+            results = run_batch(inputs, settings, job_extension=JOB_EXTENSION, force=args.force, nprocs=args.nprocs,
+                                silent=args.silent, cache=cache, use_hash=args.cache_hash,
+                                update=cache_path(inputs) if args.update else None, bundle=bundle)
+    except BaseException:
+        if bundle is not None:
+            bundle.abort()
+        raise
+    if bundle is not None:
+        with phase("write"):
+            bundle.close()
+        print(f"Wrote {len(bundle.members)} files to {bundle.path}")
+    if args.feed is not None and results["jobs"]:
+        from feed import enqueue
+
+        added, existing = enqueue(results["jobs"], path=args.feed, bundle=bundle, force=args.force or args.update)
+        print(f"Added {added} job files to {args.feed}" + (f" ({existing} were queued before)" if existing else "") +
+              ". Submit them with 'slurmify.py feed run'")
+    elif args.execute and results["jobs"]:
+        submit(args, results["jobs"], bundle=bundle)
+    sys.exit(1 if results["failed"] else 0)
+
+
+def run_via_daemon(args, cluster):
+    """
+    Generate (and submit) the job file for a single input file through a running daemon.
+    :return: False if no daemon is listening on the socket, so that the job must be generated locally
+    """
+    from daemon import Client, DaemonError
+    from profiling import phase
+
+    jobname = os.path.abspath(os.path.join(args.destination, args.input + JOB_EXTENSION))
+    try:
+        client = Client(args.socket)
+    except OSError:
+        if not args.silent:
+            print(f"No Slurmify daemon is listening on {args.socket}. Continuing without it.")
+        return False
+
+    with client:
+        if not args.force and os.path.isfile(jobname):
+            answer = input("The .job file exists. Do you want to overwrite it? (Y/n) ").lower()
+            if answer not in AFFIRMATIVE:
+                sys.exit("Aborted")
+
+        spec = {key: value for key, value in args.__dict__.items() if key not in RUN_OPTIONS}
+        spec.update(cluster=cluster, extension_inputfile=INPUT_EXTENSION, extension_outputfile=OUTPUT_EXTENSION)
+        try:
+            with phase("daemon", os.path.splitext(jobname)[0]):
+                client.write(spec, path=jobname, cwd=os.path.abspath(args.destination))
+            for warning in client.warnings:
+                print(f"Warning: {warning}")
+            if not args.silent:
+                print(f"Generated {jobname}")
+
+            if args.execute:
+                with phase("daemon", os.path.splitext(jobname)[0]):
+                    result = client.submit([jobname], command=args.sbatch, retries=args.retries, ledger=args.ledger)
+        except DaemonError as e:
+            sys.exit(e.message)
 
-    # Now submit to queue
     if args.execute:
-        os.chdir(args.destination)
-        subprocess.call(["sbatch", args.input+JOB_EXTENSION])
-
-elif GaussianInput:
-    job = gaussian_job(inputfile=args.input, outputfile=args.output, is_dev=args.dev,
-                       cluster=cluster, extension_inputfile=INPUT_EXTENSION, extension_outputfile=OUTPUT_EXTENSION,
-                       slurm_account=ACCOUNTS[cluster],
-                       slurm_nodes=args.nodes,
-                       slurm_ntasks_per_node=args.ntasks,
-                       slurm_memory=args.memory,
-                       slurm_time=args.time,
-                       slurm_mail=args.mail,
-                       slurm_partition=args.partition,
-                       cchk=args.cchk,
-                       loc=args.loc,
-                       identifier=args.identifier)
-
-    with open(jobname, "w") as f:
-        for line in job:
-            f.write(line + "\n")
+        if result["errors"]:
+            sys.exit(f"Failed to submit {result['errors'][jobname]}")
+        if not args.silent:
+            print(f"Submitted batch job {result['jobids'][jobname]} ({jobname})")
+    return True
+
+
+def run_single(args, cluster):
+    """Generate (and submit) the job file for a single input file"""
+    from utils import scan_input, input_origin, job_for_input, write_jobfile
+    from profiling import phase
+
+    # Define name of job file
+    jobname = os.path.join(args.destination, args.input + JOB_EXTENSION)
+    inputpath = os.path.join(args.destination, args.input+INPUT_EXTENSION)
+    item = os.path.abspath(os.path.join(args.destination, args.input))
+
+    # Determine origin of input file
+    with phase("scan", item):
+        manifest = scan_input(inputpath)
+    GaussianInput, OrcaInput, Mrcheminput = input_origin(None, manifest)
+    if not args.silent:
+        if GaussianInput:
+            print("Gaussian input file detected.")
+        elif OrcaInput:
+            print("ORCA input file detected.")
+        else:
+            print("MRChem input file detected.")
+
+    # Make sure not to silently overwrite existing files
+    if not args.force and not args.update:
+        if os.path.isfile(jobname):
+            answer = input("The .job file exists. Do you want to overwrite it? (Y/n) ").lower()
+            if answer not in AFFIRMATIVE:
+                sys.exit("Aborted")
+
+    # Generate job file
+    settings = dict(args.__dict__, cluster=cluster, extension_inputfile=INPUT_EXTENSION, extension_outputfile=OUTPUT_EXTENSION)
+    with phase("render", item):
+        program, job = job_for_input(args.input, settings, manifest=manifest)
+
+    # Leave the job file alone if neither the job nor the input changed since the last run
+    if args.update:
+        from cache import CACHE_NAME, load_jobs, store_jobs, job_digest, file_hash
+
+        cache = os.path.join(args.destination, CACHE_NAME)
+        with phase("hash", item):
+            digest = job_digest(job, [file_hash(inputpath)])
+        with phase("cache"):
+            unchanged = os.path.isfile(jobname) and load_jobs(cache).get(os.path.abspath(jobname)) == digest
+        if unchanged:
+            if not args.silent:
+                print(f"{jobname} is up to date")
+            return
+
+    with phase("write", item):
+        write_jobfile(jobname, job)
+    if args.update:
+        with phase("cache"):
+            store_jobs(cache, [(os.path.abspath(jobname), digest)])
 
     if not args.silent:
         print(f"Generated {jobname}")
 
     # Now submit to queue
     if args.execute:
-        os.chdir(args.destination)
-        subprocess.call(["sbatch", args.input+JOB_EXTENSION])
-
-elif Mrcheminput:
-    job = mrchem_job(inputfile=args.input, outputfile=args.output, is_dev=args.dev, cluster=cluster,
-                     extension_inputfile=INPUT_EXTENSION, extension_outputfile=OUTPUT_EXTENSION,
-                     slurm_account=ACCOUNTS[cluster],
-                     slurm_nodes=args.nodes,
-                     slurm_ntasks_per_node=args.ntasks,
-                     slurm_cpus_per_task=args.cpus_per_task,
-                     slurm_memory=args.memory,
-                     slurm_mem_per_cpu=args.memory_per_cpu,
-                     slurm_time=args.time,
-                     slurm_mail=args.mail,
-                     slurm_submit_cmd=args.cmd,
-                     slurm_partition=args.partition,
-                     initorb=args.initorb,
-                     initchk=args.initchk,
-                     loc=args.loc,
-                     identifier=args.identifier)
-
-    # Check that the job does not exceed maximum billing
-    if args.checkbill:
-        result, bill = maxbilling_okay(cluster=cluster,
-                               ntasks=args.ntasks,
-                               ncpus_per_task=args.cpus_per_task,
-                               mem=args.memory,
-                               mem_per_cpu=args.memory_per_cpu,
-                               partition=args.partition)
-        assert result, f"Your job ({bill}) exceeds the maximum number of billing units allowed on {cluster} ({billing[cluster]['max']})."
-
-    with open(jobname, "w") as f:
-        for line in job:
-            f.write(line + "\n")
+        submit(args, [jobname])
 
-    if not args.silent:
-        print(f"Generated {jobname}")
 
-    # Now submit to queue
-    if args.execute:
-        os.chdir(args.destination)
-        subprocess.call(["sbatch", args.input+JOB_EXTENSION])
+def format_warning(message, category, filename, lineno, line=None):
+    return f"Warning: {message}\n"
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if argv and argv[0] in SUBCOMMANDS:
+        module = __import__(SUBCOMMANDS[argv[0]])
+        return module.main(argv[1:])
+
+    cluster = detect_cluster()
+    parser = build_parser()
+    if "-h" in argv or "--help" in argv:
+        parser.epilog = build_epilog(cluster)
+    args = parser.parse_args(argv)
+    warnings.formatwarning = format_warning
+
+    # Now overwrite the automatically determined cluster, if specified
+    if args.cluster is not None:
+        cluster = args.cluster
+
+    # Sort out some things
+    if args.output is None: args.output = args.input
+    if args.account is None: args.account = ACCOUNTS[cluster]
+    if args.identifier is None: args.identifier = args.input
+
+    # Evaluate whether the destination exists, and ask for permission to create if
+    if not os.path.isdir(args.destination):
+        answer = input(f"The directory \"{args.destination}\" does not exist. Do you want to create it? (Y/n) ")
+        if answer not in AFFIRMATIVE:
+            sys.exit("Aborting")
+        else:
+            os.mkdir(args.destination)
+            print(f"Created \"{args.destination}\"")
+
+    if args.profile is None and args.cprofile is None:
+        return run(args, cluster)
+
+    from profiling import profiled
+
+    return profiled(run, args, cluster, path=args.profile or "slurmify_profile.json", cprofile=args.cprofile, argv=argv)
+
+
+def run(args, cluster):
+    """Generate (and submit) the job files requested on the command line"""
+    if args.socket and not args.test and args.batch is None and not args.update:
+        if run_via_daemon(args, cluster):
+            return
+
+    from utils import SlurmifyError
+
+    try:
+        if args.test:
+            run_test(args, cluster)
+        elif args.batch is not None:
+            run_batch_mode(args, cluster)
+        else:
+            run_single(args, cluster)
+    except SlurmifyError as e:
+        sys.exit(str(e))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,203 @@
+"""
+Status of a campaign of Slurmify jobs, from the files the jobs write next to their inputs:
+
+    <input>.out       the output of the program, which ends with its termination message
+    <input>.err       the messages of slurmstepd when SLURM kills the job (time limit, memory)
+    <input>.log       the log of the job, which ends with the usage tables of the SLURM epilog
+    <input>.orbitals  written by MRChem jobs after their orbitals were copied back
+
+Only the last TAIL_BYTES of every file are read, so that scanning large ORCA frequency or
+Gaussian IRC outputs costs as much as scanning small ones, and the files are read from a thread
+pool to hide the latency of parallel file systems. Every input is classified as
+
+    completed   the program terminated normally
+    failed      the program terminated with an error, or the job ended without the program terminating
+    running     the job started and has not ended yet (or was resubmitted, see --resubmit)
+    missing     the job has not started, or was never submitted
+
+$ slurmify.py status campaign/                       count the jobs per state
+$ slurmify.py status campaign/ -l --only failed      list the failed jobs and why
+$ slurmify.py status "runs/*/*.inp" --json > status.json
+
+Outputs written under another name (-o) cannot be found.
+"""
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of bytes read from the end of every file
+TAIL_BYTES = 16 * 1024
+
+STATES = ("completed", "failed", "running", "missing")
+
+# Termination messages of the programs, with the state they mean. The last one in the output counts,
+# e.g. in a Gaussian job with several steps
+MARKERS = [("ORCA TERMINATED NORMALLY", "orca", "completed"),
+           ("ORCA finished by error termination", "orca", "failed"),
+           ("aborting the run", "orca", "failed"),
+           ("Normal termination of Gaussian", "gaussian", "completed"),
+           ("Error termination", "gaussian", "failed"),
+           ("Exiting MRChem", "mrchem", "completed")]
+
+# Messages of slurmstepd in the .err file of a job killed by SLURM
+KILLED = [("DUE TO TIME LIMIT", "time limit"),
+          ("oom-kill", "out of memory"),
+          ("Out Of Memory", "out of memory"),
+          ("CANCELLED", "cancelled")]
+
+
+def tail(path, size=TAIL_BYTES):
+    """
+    The end of a file, read with a single seek from the end
+    :param path: path to the file
+    :param size: maximum number of bytes to read
+    :return: the text, or None if the file does not exist
+    """
+    try:
+        with open(path, "rb") as f:
+            end = f.seek(0, os.SEEK_END)
+            f.seek(max(0, end - size))
+            return f.read().decode(errors="replace")
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def termination(text):
+    """
+    The last termination message in the end of an output
+    :return: program, state ("completed" or "failed"), and the line of the message. None if there is none
+    """
+    last = None
+    for marker, program, state in MARKERS:
+        position = text.rfind(marker)
+        if position >= 0 and (last is None or position > last[0]):
+            last = (position, program, state)
+    if last is None:
+        return None
+    position, program, state = last
+    start = text.rfind("\n", 0, position) + 1
+    end = text.find("\n", position)
+    return program, state, text[start:end if end >= 0 else len(text)].strip(" *")
+
+
+def log_ended(text):
+    """The state of the job in the usage tables at the end of its log, if the job ended"""
+    from history import parse_tables, aggregate, UNFINISHED
+
+    if "---" not in text:
+        return None
+    for run in aggregate(parse_tables(text)).values():
+        if run["state"] and run["state"] not in UNFINISHED:
+            return run["state"]
+    return None
+
+
+def job_status(base, extension_outputfile=".out", size=TAIL_BYTES):
+    """
+    Classify the job of an input file from the files it wrote
+    :param base: path to the input file without extension
+    :param extension_outputfile: extension of the output file
+    :param size: number of bytes read from the end of every file
+    :return: dict with "input", "state" (from STATES), "program" (None if not known), and "detail"
+    """
+    status = dict(input=base, state="running", program=None, detail="")
+    output = tail(base + extension_outputfile, size)
+    found = termination(output) if output else None
+    if found is not None:
+        status["program"] = found[0]
+        if found[1] == "completed":
+            status["state"] = "completed"
+            return status
+
+    errors = tail(base + ".err", size) or ""
+    for message, reason in KILLED:
+        if message in errors:
+            status.update(state="failed", detail=reason)
+            return status
+    if found is not None:
+        status.update(state="failed", detail=found[2])
+        return status
+
+    log = tail(base + ".log", size)
+    if log is not None and "Time limit is near" in log:
+        status["detail"] = "resubmitted" if "Submitted batch job" in log else "stopped at the time limit"
+        if "Not resubmitting" in log:
+            status["state"] = "failed"
+        return status
+    ended = log_ended(log) if log is not None else None
+    # The checkpoint of an MRChem job stopped at the time limit also writes the .orbitals file, which is
+    # still there while the resubmitted job runs, so it only counts once the job has ended
+    if os.path.isfile(base + ".orbitals") and (log is None or ended is not None):
+        status.update(state="completed", program="mrchem")
+    elif log is None and output is None:
+        status["state"] = "missing"
+    elif ended is not None:
+        status.update(state="failed", detail=f"job ended ({ended}) without a termination message")
+    return status
+
+
+def scan(inputs, extension_outputfile=".out", workers=32, size=TAIL_BYTES):
+    """
+    Classify the jobs of many inputs, reading their files from a thread pool
+    :param inputs: list of paths to input files without extension
+    :param workers: number of files read at the same time
+    :return: list of dicts from job_status, in the order of inputs
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(lambda base: job_status(base, extension_outputfile, size), inputs))
+
+
+def summary(statuses):
+    """Number of jobs per program and state, as a dict mapping program to a dict mapping state to count"""
+    table = {}
+    for status in statuses:
+        counts = table.setdefault(status["program"] or "-", dict.fromkeys(STATES, 0))
+        counts[status["state"]] += 1
+    return table
+
+
+def main(argv=None):
+    """Command-line interface for the status of a campaign"""
+    import slurmify
+    from batch import collect_inputs
+
+    parser = argparse.ArgumentParser(prog="slurmify.py status",
+                                     description="Classify the jobs of a campaign as completed, failed, running, or missing")
+    parser.add_argument("sources", nargs="*", default=["."], help="Directories, glob patterns, or list files of input files (default: .)")
+    parser.add_argument("-l", "--list", action="store_true", help="List every job with its state")
+    parser.add_argument("--only", metavar="<>", nargs="+", choices=STATES, help=f"[str] Only list jobs in these states ({', '.join(STATES)})")
+    parser.add_argument("--json", action="store_true", help="Print the summary and the jobs as JSON")
+    parser.add_argument("--workers", metavar="<>", type=int, default=32, help="[int] Number of files read at the same time")
+    parser.add_argument("--tail", metavar="<>", type=int, default=TAIL_BYTES, help=f"[int] Bytes read from the end of every file (default: {TAIL_BYTES})")
+    args = parser.parse_args(argv)
+
+    inputs = sorted({base for source in args.sources for base in collect_inputs(source, slurmify.INPUT_EXTENSION)})
+    if not inputs:
+        sys.exit(f"No input files ({slurmify.INPUT_EXTENSION}) found in {', '.join(args.sources)}")
+    statuses = scan(inputs, slurmify.OUTPUT_EXTENSION, workers=args.workers, size=args.tail)
+    table = summary(statuses)
+    listed = [status for status in statuses if args.only is None or status["state"] in args.only]
+    for status in listed:
+        status["input"] = os.path.relpath(status["input"])
+
+    if args.json:
+        json.dump(dict(summary=table, jobs=listed if args.list or args.only else []), sys.stdout, indent=1)
+        print()
+        return 0
+    if args.list or args.only:
+        for status in listed:
+            print(f"{status['state']:<9} {status['program'] or '-':<8} {status['input']}"
+                  + (f": {status['detail']}" if status["detail"] else ""))
+        print()
+    print(f"{'program':<9}" + "".join(f" {state:>9}" for state in STATES) + f" {'total':>9}")
+    for program, counts in sorted(table.items()):
+        print(f"{program:<9}" + "".join(f" {counts[state]:>9}" for state in STATES) + f" {sum(counts.values()):>9}")
+    totals = {state: sum(counts[state] for counts in table.values()) for state in STATES}
+    print(f"{'total':<9}" + "".join(f" {totals[state]:>9}" for state in STATES) + f" {len(statuses):>9}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
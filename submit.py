@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import random
+import shlex
+import datetime
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from profiling import phase
+
+# Error messages from sbatch that are worth retrying, since they are caused by
+# an overloaded or restarting slurmctld rather than by the job script itself
+TRANSIENT_ERRORS = ["Socket timed out",
+                    "Unable to contact slurm controller",
+                    "Slurm temporarily unable to accept job",
+                    "Resource temporarily unavailable",
+                    "Zero Bytes were transmitted or received",
+                    "Connection refused",
+                    "Transport endpoint is not connected"]
+
+# Command used to submit jobs. Can be pointed at a fake sbatch for testing
+SBATCH = os.environ.get("SLURMIFY_SBATCH", "sbatch")
+
+
+class SubmissionError(Exception):
+    pass
+
+
+def is_transient(message):
+    return any(error in message for error in TRANSIENT_ERRORS)
+
+
+def sbatch(jobfile, command=SBATCH, extra_args=(), retries=5, backoff=1.0, script=None):
+    """
+    Submit a single job file and return its job ID. The job is submitted from the directory
+    containing the job file, so that $SLURM_SUBMIT_DIR points there.
+    :param jobfile: path to job file
+    :param command: sbatch command, either a string (split like a shell would) or a list
+    :param extra_args: additional arguments passed to sbatch before the job file
+    :param retries: number of retries on transient slurmctld errors
+    :param backoff: initial delay between retries in seconds. Doubled for every retry
+    :param script: contents of the job file, passed to sbatch on stdin, if the job file does not exist
+                   on disk (e.g. it is in a bundle, see sink.py)
+    :return: job ID as a string
+    """
+    if isinstance(command, str):
+        command = shlex.split(command)
+    directory, filename = os.path.split(os.path.abspath(jobfile))
+    cmd = list(command) + ["--parsable"] + list(extra_args) + ([filename] if script is None else [])
+
+    for attempt in range(retries + 1):
+        try:
+            with phase("submit", os.path.splitext(os.path.abspath(jobfile))[0]):
+                proc = subprocess.run(cmd, cwd=directory, input=script, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                      universal_newlines=True)
+        except OSError as e:
+            raise SubmissionError(f"{jobfile}: could not run {cmd[0]} ({e})")
+
+        if proc.returncode == 0 and proc.stdout.strip():
+            # --parsable prints "jobid" or "jobid;cluster"
+            return proc.stdout.strip().splitlines()[-1].split(";")[0]
+
+        message = (proc.stderr or proc.stdout).strip()
+        if not is_transient(message) or attempt == retries:
+            raise SubmissionError(f"{jobfile}: {message or f'sbatch exited with code {proc.returncode}'}")
+        time.sleep(backoff * 2**attempt * random.uniform(0.5, 1.5))
+
+
+def submit_jobs(jobfiles, command=SBATCH, max_workers=8, retries=5, backoff=1.0, ledger=None, extra_args=(), silent=False,
+                pool=None, bundle=None):
+    """
+    Submit many job files concurrently, retrying transient errors with exponential backoff.
+    :param jobfiles: list of paths to job files
+    :param command: sbatch command, either a string or a list
+    :param max_workers: maximum number of concurrent sbatch calls
+    :param retries: number of retries on transient slurmctld errors
+    :param backoff: initial delay between retries in seconds
+    :param ledger: path to a ledger file. A tab-separated line with timestamp, job file, and job ID is appended per job
+    :param extra_args: additional arguments passed to sbatch
+    :param silent: do not print the job ID of every submitted job
+    :param pool: executor to run the sbatch calls in, e.g. one shared by several callers. max_workers is ignored if given
+    :param bundle: closed sink.Bundle holding the job files
+    :return: dict mapping job file to job ID, and dict mapping job file to error message for failed jobs
+    """
+    jobids, errors = {}, {}
+    lock = threading.Lock()
+
+    def submit(jobfile):
+        jobid = sbatch(jobfile, command=command, extra_args=extra_args, retries=retries, backoff=backoff,
+                       script=bundle.read(jobfile) if bundle is not None else None)
+        with lock:
+            if ledger is not None:
+                with open(ledger, "a") as f:
+                    f.write(f"{datetime.datetime.now().isoformat()}\t{os.path.abspath(jobfile)}\t{jobid}\n")
+            if not silent:
+                print(f"Submitted batch job {jobid} ({jobfile})")
+        return jobid
+
+    own_pool = pool is None
+    if own_pool:
+        pool = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    try:
+        futures = {pool.submit(submit, jobfile): jobfile for jobfile in jobfiles}
+        for future in as_completed(futures):
+            jobfile = futures[future]
+            try:
+                jobids[jobfile] = future.result()
+            except SubmissionError as e:
+                errors[jobfile] = str(e)
+                print(f"Failed to submit {e}", file=sys.stderr)
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+    return jobids, errors
@@ -0,0 +1,182 @@
+"""
+Sweep job layouts (ntasks x cpus-per-task x memory x partition) through the billing model in
+utils.py, and report the Pareto-optimal ones: those for which no other layout is at most as
+expensive while providing at least as many CPUs and as much memory. Uses NumPy if it is
+installed, and plain Python otherwise.
+
+$ slurmify.py sweep --cores 64 --memory 200GB [--partition normal bigmem] [--max_cores 96]
+
+With --autobill, MRChem jobs get the cheapest partition and ntasks x cpus-per-task layout for
+the requested number of CPUs and memory (see cheapest()).
+"""
+import sys
+import math
+import argparse
+import itertools
+
+try:
+    import numpy
+except ImportError:  # the pure-Python sweep gives the same results, only slower
+    numpy = None
+
+from utils import (billing, billing_units, max_billing, memory_gb, partitions as cluster_partitions, SettingsError)
+
+
+def free_memory_gb(cluster, partition, cores):
+    """
+    Largest memory that does not add to the billing of a number of CPUs: on shared partitions
+    the memory billed like the CPUs, on exclusive ones (or without a memory factor) the whole node
+    """
+    model = billing[cluster][partition]
+    if model.get("exclusive") or model["factor_mem"] == 0:
+        if numpy is not None and isinstance(cores, numpy.ndarray):
+            return numpy.full(cores.shape, float(model["mem_per_node"]))
+        return model["mem_per_node"]
+    return cores * model["factor_cpu"] // model["factor_mem"]
+
+
+def layouts(cluster, partition, cores, max_cores, mem_gb, free_memory=True):
+    """
+    All layouts of a partition that provide between cores and max_cores CPUs and stay within the
+    billing limit, with the requested memory and, with free_memory, also with the largest memory
+    that costs nothing extra
+    :return: list of (ntasks, cpus_per_task, memory in GB, billing units)
+    """
+    model = billing[cluster][partition]
+    limit = max_billing(cluster, partition)
+    if mem_gb > model["mem_per_node"]:
+        return []
+    ntasks = range(1, max_cores + 1)
+    cpus = range(1, min(model["cores_per_node"], max_cores) + 1)
+    if numpy is not None:
+        n, c = (a.ravel() for a in numpy.meshgrid(ntasks, cpus, indexing="ij"))
+        keep = (n * c >= cores) & (n * c <= max_cores)
+        n, c = n[keep], c[keep]
+        m = numpy.full(len(n), float(mem_gb))
+        if free_memory:
+            free = numpy.minimum(free_memory_gb(cluster, partition, n * c), model["mem_per_node"])
+            keep = free > mem_gb
+            n, c, m = numpy.concatenate([n, n[keep]]), numpy.concatenate([c, c[keep]]), numpy.concatenate([m, free[keep]])
+        bill = billing_units(cluster, partition, n * c, m)
+        keep = bill <= limit
+        return list(zip(n[keep].tolist(), c[keep].tolist(), m[keep].tolist(), bill[keep].tolist()))
+
+    rows = []
+    for n, c in itertools.product(ntasks, cpus):
+        if cores <= n * c <= max_cores:
+            mems = [mem_gb]
+            if free_memory:
+                free = min(free_memory_gb(cluster, partition, n * c), model["mem_per_node"])
+                mems += [free] if free > mem_gb else []
+            for m in mems:
+                bill = billing_units(cluster, partition, n * c, m)
+                if bill <= limit:
+                    rows.append((n, c, float(m), bill))
+    return rows
+
+
+def options(cluster, cores, mem_gb, partitions=None, max_cores=None, free_memory=True):
+    """
+    Layouts grouped by what they provide
+    :return: list of dicts with partition, billing, cores, memory (GB), and layouts, the list of
+             (ntasks, cpus_per_task) giving this combination
+    """
+    max_cores = max(max_cores or cores, cores)
+    groups = {}
+    for partition in partitions or cluster_partitions(cluster):
+        for n, c, m, bill in layouts(cluster, partition, cores, max_cores, mem_gb, free_memory=free_memory):
+            groups.setdefault((partition, round(bill, 6), n * c, m), []).append((n, c))
+    return [dict(partition=partition, billing=bill, cores=total, memory=m, layouts=sorted(group, reverse=True))
+            for (partition, bill, total, m), group in groups.items()]
+
+
+def pareto(candidates):
+    """Options that no other option dominates (at most as expensive, at least as many CPUs and as much memory)"""
+    front = []
+    for option in sorted(candidates, key=lambda o: (o["billing"], -o["cores"], -o["memory"])):
+        dominated = any(f["billing"] <= option["billing"] and f["cores"] >= option["cores"] and f["memory"] >= option["memory"]
+                        and (f["billing"], f["cores"], f["memory"]) != (option["billing"], option["cores"], option["memory"])
+                        for f in front)
+        if not dominated:
+            front.append(option)
+    return front
+
+
+def sweep(cluster, cores, memory, partitions=None, max_cores=None):
+    """
+    Pareto-optimal job layouts
+    :param cluster: cluster name
+    :param cores: minimum total number of CPUs
+    :param memory: minimum memory, e.g. "100GB"
+    :param partitions: partitions to consider. All partitions with a billing model if None
+    :param max_cores: largest total number of CPUs to consider. Twice the requested CPUs if None
+    :return: list of options as returned by options(), cheapest first
+    """
+    if not cluster_partitions(cluster):
+        raise SettingsError(f"No billing model for {cluster}")
+    return pareto(options(cluster, cores, memory_gb(memory), partitions=partitions, max_cores=max_cores or 2 * cores))
+
+
+def cheapest(cluster, cores, memory, partition=None, cpus_per_task=None):
+    """
+    Cheapest layout that provides exactly the requested CPUs and memory. Ties are broken in favour
+    of the requested partition, and of the layout closest to the requested cpus per task
+    :return: partition, ntasks, cpus_per_task, billing units
+    :raises SettingsError: if no layout stays within the billing limits
+    """
+    if not cluster_partitions(cluster):
+        raise SettingsError(f"No billing model for {cluster}")
+    candidates = options(cluster, cores, memory_gb(memory), max_cores=cores, free_memory=False)
+    if not candidates:
+        raise SettingsError(f"No layout of {cores} CPUs and {memory} stays within the billing limits on {cluster}")
+
+    def distance(layout):
+        return abs(math.log(layout[1] / cpus_per_task)) if cpus_per_task else 0
+
+    best = min(candidates, key=lambda o: (o["billing"], o["partition"] != partition, min(map(distance, o["layouts"]))))
+    ntasks, cpus = min(best["layouts"], key=distance)
+    return best["partition"], ntasks, cpus, best["billing"]
+
+
+def apply_autobill(settings):
+    """
+    Replace partition, ntasks, and cpus_per_task of MRChem job settings by the cheapest layout
+    :param settings: dict of settings as passed to utils.job_for_input
+    :return: new dict of settings
+    """
+    cores = int(settings["ntasks"]) * int(settings["cpus_per_task"])
+    memory = settings.get("memory") or f"{memory_gb(settings['memory_per_cpu']) * cores}GB"
+    partition, ntasks, cpus, bill = cheapest(settings["cluster"], cores, memory, partition=settings["partition"],
+                                             cpus_per_task=int(settings["cpus_per_task"]))
+    return dict(settings, partition=partition, ntasks=str(ntasks), cpus_per_task=str(cpus))
+
+
+def main(argv=None):
+    """Command-line interface for the billing sweep"""
+    import slurmify
+
+    parser = argparse.ArgumentParser(prog="slurmify.py sweep",
+                                     description="Find the cheapest job layouts for the requested CPUs and memory")
+    parser.add_argument("--cores", metavar="<>", type=int, required=True, help="[int] Minimum total number of CPUs")
+    parser.add_argument("-m", "--memory", metavar="<>", type=str, required=True, help="[str] Minimum memory, e.g. 100GB")
+    parser.add_argument("-C", "--cluster", metavar="<>", type=str, help="[str] Cluster (default: the current cluster)")
+    parser.add_argument("-P", "--partition", metavar="<>", nargs="+", help="[str] Partitions to consider (default: all)")
+    parser.add_argument("--max_cores", metavar="<>", type=int, help="[int] Largest total number of CPUs to consider (default: twice --cores)")
+    args = parser.parse_args(argv)
+
+    cluster = args.cluster or slurmify.detect_cluster()
+    try:
+        front = sweep(cluster, args.cores, args.memory, partitions=args.partition, max_cores=args.max_cores)
+    except SettingsError as e:
+        sys.exit(str(e))
+    if not front:
+        sys.exit(f"No layout of {args.cores} CPUs and {args.memory} stays within the billing limits on {cluster}")
+
+    print(f"{'partition':<10} {'billing':>9} {'cores':>6} {'memory':>9}  layouts (ntasks x cpus-per-task)")
+    for option in front:
+        shown = " ".join(f"{n}x{c}" for n, c in option["layouts"][:8]) + (" ..." if len(option["layouts"]) > 8 else "")
+        print(f"{option['partition']:<10} {option['billing']:>9.1f} {option['cores']:>6} {option['memory']:>7g}GB  {shown}")
+
+
+if __name__ == "__main__":
+    main()
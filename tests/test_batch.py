@@ -0,0 +1,44 @@
+import pytest
+
+import api
+from batch import run_batch, collect_inputs
+from jobarray import write_arrays
+from utils import SettingsError
+
+ORCA = "! B3LYP def2-SVP\n* xyz 0 1\nH 0.0 0.0 0.0\nH 0.0 0.0 0.74\n*\n"
+
+
+@pytest.fixture
+def campaign(tmp_path):
+    """Two valid ORCA inputs, and one that is not valid UTF-8 between them"""
+    (tmp_path / "a.inp").write_text(ORCA)
+    (tmp_path / "b.inp").write_bytes(b"! B3LYP def2-SVP\n# caf\xe9\n* xyz 0 1\nH 0 0 0\n*\n")
+    (tmp_path / "c.inp").write_text(ORCA)
+    return tmp_path
+
+
+def settings():
+    return dict(api.settings_for(dict(input="-", cluster="saga", memory="2GB")), input=None)
+
+
+@pytest.mark.parametrize("nprocs", [1, 2])
+def test_bad_input_does_not_stop_the_batch(campaign, nprocs, capsys):
+    inputs = collect_inputs(str(campaign))
+    results = run_batch(inputs, settings(), nprocs=nprocs, silent=True)
+    assert results["failed"] == [str(campaign / "b")]
+    assert sorted(results["generated"]) == [str(campaign / "a"), str(campaign / "c")]
+    assert (campaign / "a.job").is_file() and (campaign / "c.job").is_file() and not (campaign / "b.job").exists()
+    assert "UnicodeDecodeError" in capsys.readouterr().err
+
+
+def test_bad_input_does_not_stop_the_array(campaign):
+    results = write_arrays(collect_inputs(str(campaign)), settings(), "campaign", silent=True)
+    assert results["failed"] == [str(campaign / "b")]
+    assert (campaign / "campaign.index").read_text().count("\n") == 2
+
+
+@pytest.mark.parametrize("slots", [None, 2])
+def test_resubmit_is_refused(campaign, slots):
+    with pytest.raises(SettingsError, match="--resubmit"):
+        write_arrays([str(campaign / "a.inp")], dict(settings(), resubmit=3), "campaign", slots=slots, silent=True)
+    assert not (campaign / "campaign.job").exists()
@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+
+import pytest
+
+import feed
+from feed import enqueue, connect, queue_tag, run
+from submit import sbatch
+
+FAKESLURM = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "fakeslurm.py")
+SBATCH = f"{sys.executable} {FAKESLURM} sbatch"
+SQUEUE = f"{sys.executable} {FAKESLURM} squeue"
+
+
+@pytest.fixture
+def fakeslurm(tmp_path, monkeypatch):
+    """Path of the state of a fake Slurm whose jobs run for a second, with room for 50 jobs"""
+    state = tmp_path / "fakeslurm.json"
+    monkeypatch.setenv("FAKESLURM_STATE", str(state))
+    monkeypatch.setenv("FAKESLURM_MAX_SUBMIT", "50")
+    monkeypatch.setenv("FAKESLURM_RUNTIME", "1")
+    return state
+
+
+def jobfiles(directory, count):
+    paths = []
+    for i in range(count):
+        path = directory / f"job{i}.job"
+        path.write_text(f"#!/bin/bash\n#SBATCH --job-name=job{i}\necho {i}\n")
+        paths.append(str(path))
+    return paths
+
+
+def submitted_comments(state):
+    with open(state) as f:
+        return [job["comment"] for job in json.load(f)["jobs"]]
+
+
+def test_resume_does_not_submit_twice(tmp_path, fakeslurm):
+    queue = str(tmp_path / "queue.sqlite")
+    enqueue(jobfiles(tmp_path, 6), path=queue)
+    tag = queue_tag(queue)
+
+    # A feeder was killed while submitting jobs 1 and 2: sbatch had accepted job 1, but not job 2
+    conn = connect(queue)
+    with conn:
+        conn.execute("UPDATE jobs SET state = 'submitting' WHERE id IN (1, 2)")
+        path, = conn.execute("SELECT path FROM jobs WHERE id = 1").fetchone()
+    conn.close()
+    jobid = sbatch(path, command=SBATCH, extra_args=[f"--comment={tag}:1"])
+
+    state = run(queue, max_jobs=50, interval=0, once=True, command=SBATCH, squeue=SQUEUE, silent=True)
+    assert state == dict(pending=0, submitting=0, submitted=5, failed=0, unknown=1)
+
+    conn = connect(queue)
+    try:
+        jobs = {rowid: (state, found) for rowid, state, found in conn.execute("SELECT id, state, jobid FROM jobs")}
+    finally:
+        conn.close()
+    assert jobs[1] == ("submitted", jobid)
+    assert jobs[2] == ("unknown", None)
+
+    comments = submitted_comments(fakeslurm)
+    assert len(comments) == len(set(comments)) == 5
+    assert f"{tag}:2" not in comments
+
+
+def test_feeds_within_the_submit_limit(tmp_path, fakeslurm, monkeypatch):
+    monkeypatch.setenv("FAKESLURM_MAX_SUBMIT", "3")
+    monkeypatch.setenv("FAKESLURM_RUNTIME", "0.3")
+    queue = str(tmp_path / "queue.sqlite")
+    enqueue(jobfiles(tmp_path, 7), path=queue)
+
+    state = run(queue, max_jobs=3, interval=0.2, command=SBATCH, squeue=SQUEUE, silent=True)
+    assert state["submitted"] == 7 and state["pending"] == 0
+    comments = submitted_comments(fakeslurm)
+    assert len(comments) == len(set(comments)) == 7
+
+
+def test_missing_squeue_is_fatal(tmp_path, fakeslurm):
+    queue = str(tmp_path / "queue.sqlite")
+    enqueue(jobfiles(tmp_path, 1), path=queue)
+    with pytest.raises(FileNotFoundError):
+        run(queue, interval=0, command=SBATCH, squeue=str(tmp_path / "squeue"))
+
+
+def test_failing_squeue_is_retried_a_bounded_number_of_times(tmp_path, fakeslurm, monkeypatch):
+    queue = str(tmp_path / "queue.sqlite")
+    enqueue(jobfiles(tmp_path, 1), path=queue)
+    failing = f"{sys.executable} -c 'import sys; sys.exit(1)'"
+
+    with pytest.raises(OSError, match="squeue failed"):
+        run(queue, interval=0, once=True, command=SBATCH, squeue=failing)
+
+    sleeps = []
+    monkeypatch.setattr(feed.time, "sleep", sleeps.append)
+    with pytest.raises(OSError, match="squeue failed"):
+        run(queue, interval=5, command=SBATCH, squeue=failing, squeue_retries=3)
+    assert sleeps == [5, 5, 5]
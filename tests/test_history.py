@@ -0,0 +1,199 @@
+import os
+import sys
+import sqlite3
+
+import pytest
+
+import history
+from history import (parse_sacct, parse_tables, aggregate, ingest, source_unchanged, predict, apply_prediction,
+                     apply_array_prediction, input_features, query_sacct, MARGIN, FIRST_QUERY)
+from utils import SlurmifyWarning
+
+DUMP = os.path.join(os.path.dirname(__file__), "data", "sacct_dump.txt")
+WORKDIR = "/cluster/work/users/ambr/h2"
+
+H2 = "! B3LYP def2-SVP\n* xyz 0 1\nH 0.0 0.0 0.0\nH 0.0 0.0 0.74\n*\n"
+WATER = "! PBE0 def2-TZVP\n* xyz 0 1\nO 0.0 0.0 0.0\nH 0.0 0.76 0.59\nH 0.0 -0.76 0.59\n*\n"
+
+
+def read_dump():
+    with open(DUMP) as f:
+        return f.read()
+
+
+@pytest.fixture
+def workdir(tmp_path):
+    """The H2 inputs of the jobs in the dump, and the dump pointing to them"""
+    for name in ("h2_a", "h2_b", "h2_c", "h2_d", "h2_e"):
+        (tmp_path / f"{name}.inp").write_text(H2)
+    (tmp_path / "water.inp").write_text(WATER)
+    dump = tmp_path / "sacct.txt"
+    dump.write_text(read_dump().replace(WORKDIR, str(tmp_path)))
+    return tmp_path
+
+
+@pytest.fixture
+def db(workdir):
+    path = str(workdir / "history.sqlite")
+    ingest(str(workdir.joinpath("sacct.txt").read_text()), path=path, source=str(workdir / "sacct.txt"))
+    return path
+
+
+def table(columns, rows):
+    """A usage table as printed by sacct without --parsable2 at the end of a job log"""
+    widths = [max(len(str(value)) for value in [column] + [row[i] for row in rows]) + 2
+              for i, column in enumerate(columns)]
+    lines = [" ".join(f"{column:>{width}}" for column, width in zip(columns, widths)),
+             " ".join("-" * width for width in widths)]
+    lines += [" ".join(f"{value:>{width}}" for value, width in zip(row, widths)) for row in rows]
+    return "\n".join(lines) + "\n"
+
+
+def test_parse_sacct():
+    rows = parse_sacct(read_dump())
+    assert len(rows) == 12
+    assert rows[0]["JobID"] == "1001" and rows[0]["WorkDir"] == WORKDIR
+    assert rows[-1]["State"] == "CANCELLED by 123456" and rows[-1]["AllocTRES"] == ""
+    assert parse_sacct("") == []
+
+
+def test_aggregate():
+    runs = aggregate(parse_sacct(read_dump()))
+    assert sorted(runs) == ["1001", "1002", "1003", "1004", "1005", "1006"]
+
+    a = runs["1001"]
+    assert (a["name"], a["state"], a["cores"], a["billing"]) == ("h2_a", "COMPLETED", 4, 4.0)
+    assert (a["elapsed"], a["timelimit"], a["cputime"]) == (600, 3600, 2160)
+    assert a["maxrss"] == pytest.approx(2.0)
+    assert a["reqmem"] == pytest.approx(4.0)
+    assert a["started"] - a["submitted"] == 300
+
+    # MaxRSS of the largest task of a step, times the tasks of the step on the node
+    b = runs["1002"]
+    assert b["maxrss"] == pytest.approx(3.0)
+    assert b["reqmem"] == pytest.approx(4000 / 1024)
+
+    assert runs["1004"]["state"] == "TIMEOUT" and runs["1004"]["elapsed"] == 3608
+    assert runs["1006"]["state"] == "CANCELLED" and runs["1006"]["started"] is None
+
+
+def test_parse_tables():
+    text = ("Some output of the job\n\n"
+            + table(["JobID", "JobName", "State", "Elapsed", "Timelimit"],
+                    [["2001", "h2_a", "COMPLETED", "00:05:00", "01:00:00"],
+                     ["2001.batch", "batch", "COMPLETED", "00:05:00", ""]])
+            + "\n"
+            + table(["JobID", "MaxRSS", "NTasks", "AveCPU"],
+                    [["2001", "", "", ""],
+                     ["2001.batch", "1048576K", "1", "00:04:00"],
+                     ["2001.0", "512M", "4", "00:04:30"]]))
+    rows = parse_tables(text)
+    assert len(rows) == 5
+    assert rows[0] == dict(JobID="2001", JobName="h2_a", State="COMPLETED", Elapsed="00:05:00", Timelimit="01:00:00")
+    assert rows[4] == dict(JobID="2001.0", MaxRSS="512M", NTasks="4", AveCPU="00:04:30")
+
+    # The tables of a log are merged into one run
+    run = aggregate(rows)["2001"]
+    assert (run["state"], run["elapsed"], run["timelimit"]) == ("COMPLETED", 300, 3600)
+    assert run["maxrss"] == pytest.approx(2.0)
+    assert run["cputime"] == 240 + 4 * 270
+
+
+def test_ingest_skips_unfinished_jobs(workdir, db):
+    conn = sqlite3.connect(db)
+    try:
+        states = dict(conn.execute("SELECT jobid, state FROM runs"))
+        inputs = dict(conn.execute("SELECT jobid, input FROM runs"))
+    finally:
+        conn.close()
+    assert states == {"1001": "COMPLETED", "1002": "COMPLETED", "1003": "COMPLETED", "1004": "TIMEOUT",
+                      "1006": "CANCELLED"}
+    assert inputs["1001"] == str(workdir / "h2_a.inp")
+    assert inputs["1006"] is None
+
+
+def test_ingest_is_incremental(workdir, db):
+    dump = workdir / "sacct.txt"
+    assert source_unchanged(str(dump), db)
+    assert ingest(dump.read_text(), path=db, source=str(dump)) == (0, 0)
+
+    # Only the jobs added to the dump are recorded
+    with open(dump, "a") as f:
+        f.write(f"1007|h2_e|COMPLETED|00:15:00|01:00:00||4Gn||1|4|{workdir}|2021-03-02T10:00:00|2021-03-02T10:00:00|"
+                f"2021-03-02T10:15:00|saga|nn4654k|normal|00:50:00|billing=4,cpu=4,mem=4G,node=1\n")
+    assert not source_unchanged(str(dump), db)
+    assert ingest(dump.read_text(), path=db, source=str(dump)) == (1, 0)
+
+    conn = sqlite3.connect(db)
+    try:
+        jobids = [jobid for (jobid,) in conn.execute("SELECT jobid FROM runs")]
+    finally:
+        conn.close()
+    assert sorted(jobids) == ["1001", "1002", "1003", "1004", "1006", "1007"]
+
+
+def test_ingest_skips_unchanged_logs(workdir, tmp_path):
+    log = workdir / "h2_a.log"
+    log.write_text(table(["JobID", "JobName", "State", "Elapsed", "MaxRSS", "NTasks"],
+                         [["3001", "h2_a", "COMPLETED", "00:05:00", "", ""],
+                          ["3001.batch", "batch", "COMPLETED", "00:05:00", "1048576K", "1"]]))
+    path = str(tmp_path / "logs.sqlite")
+    assert ingest(logfiles=[str(log)], path=path, cluster="saga") == (1, 0)
+    assert ingest(logfiles=[str(log)], path=path, cluster="saga") == (0, 0)
+
+
+def test_predict_quantile_with_margin(workdir, db):
+    features = input_features(str(workdir / "h2_a.inp"))
+    assert features == dict(program="orca", keywords="b3lyp def2-svp", natoms=2)
+
+    # Completed runs: 2, 3, and 4 GB in 10, 20, and 30 minutes on 4 cores
+    median = predict(features, cores=4, q=0.5, path=db)
+    assert median["samples"] == 3
+    assert median["memory"] == pytest.approx(3.0 * MARGIN)
+    assert median["seconds"] == pytest.approx(1200 * MARGIN)
+
+    high = predict(features, cores=4, q=0.95, path=db)
+    assert high["memory"] == pytest.approx(3.9 * MARGIN)
+    assert high["seconds"] == pytest.approx(1740 * MARGIN)
+
+    # Runs on more cores take longer on fewer
+    assert predict(features, cores=2, q=0.5, path=db)["seconds"] == pytest.approx(2400 * MARGIN)
+
+
+def test_too_few_runs(workdir, db, monkeypatch):
+    assert predict(input_features(str(workdir / "water.inp")), path=db) is None
+
+    monkeypatch.setattr(history, "MIN_SAMPLES", 4)
+    assert predict(input_features(str(workdir / "h2_a.inp")), path=db) is None
+
+    monkeypatch.setattr(history, "HISTORY", db)
+    settings = dict(predict=0.95, nodes="1", ntasks="4", memory="1GB", time="0-00:10:00")
+    with pytest.warns(SlurmifyWarning, match="Too few completed runs"):
+        assert apply_prediction(str(workdir / "h2_a.inp"), settings, "orca") == settings
+
+
+def test_array_prediction_takes_the_largest(workdir, db, monkeypatch):
+    monkeypatch.setattr(history, "HISTORY", db)
+    settings = dict(predict=0.95, nodes="1", ntasks="4", memory="1GB", time="0-00:10:00")
+
+    predicted = apply_prediction(str(workdir / "h2_a.inp"), settings, "orca")
+    assert (predicted["memory"], predicted["time"]) == ("5GB", "00-00:35:00")
+
+    with pytest.warns(SlurmifyWarning):
+        array = apply_array_prediction([str(workdir / "water.inp"), str(workdir / "h2_a.inp")], settings, "orca")
+    assert (array["memory"], array["time"], array["predict"]) == ("5GB", "00-00:35:00", None)
+
+    settings = dict(settings, time="0-02:00:00")
+    with pytest.warns(SlurmifyWarning):
+        array = apply_array_prediction([str(workdir / "water.inp"), str(workdir / "h2_a.inp")], settings, "orca")
+    assert (array["memory"], array["time"]) == ("5GB", "0-02:00:00")
+
+
+def test_query_sacct_start(tmp_path):
+    # sacct without --starttime only lists the jobs of the current day
+    args = tmp_path / "args"
+    command = f"{sys.executable} -c 'import sys; open(sys.argv[1], \"w\").write(\" \".join(sys.argv[2:]))' {args}"
+    query_sacct(command=command)
+    assert args.read_text().endswith(f"--starttime {FIRST_QUERY}")
+    query_sacct("2021-03-01", command=command)
+    assert args.read_text().endswith("--starttime 2021-03-01")
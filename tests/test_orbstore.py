@@ -0,0 +1,110 @@
+import os
+import stat
+import time
+
+from orbstore import store_for, ingest, restore, gc, verify, read_manifest, manifests, objects, object_path
+from slurmify import ACCOUNTS
+
+
+def orbitals(directory, **files):
+    """An orbital directory with the given files and contents"""
+    for name, content in files.items():
+        path = directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    return str(directory)
+
+
+def test_store_for_expands_the_account(monkeypatch):
+    import utils
+
+    monkeypatch.setitem(utils.vars["betzy"], "orbstore", "/cluster/projects/${SLURM_JOB_ACCOUNT}/store")
+    monkeypatch.delenv("SLURM_JOB_ACCOUNT", raising=False)
+    assert store_for("betzy") == f"/cluster/projects/{ACCOUNTS['betzy']}/store"
+    monkeypatch.setenv("SLURM_JOB_ACCOUNT", "nn0000k")
+    assert store_for("betzy") == "/cluster/projects/nn0000k/store"
+
+
+def test_store_is_off_by_default():
+    assert all(store_for(cluster) is None for cluster in ACCOUNTS)
+
+
+def test_ingest_deduplicates(tmp_path):
+    store = str(tmp_path / "store")
+    first = orbitals(tmp_path / "a", **{"phi_0.orb": b"0" * 100, "phi_1.orb": b"1" * 100})
+    second = orbitals(tmp_path / "b", **{"phi_0.orb": b"0" * 100, "phi_1.orb": b"2" * 100})
+    manifest = ingest(store, first)
+    assert [relpath for _, relpath in read_manifest(manifest)] == ["./phi_0.orb", "./phi_1.orb"]
+    assert ingest(store, first) == manifest
+    ingest(store, second)
+    assert len(manifests(store)) == 2
+    assert len(list(objects(store))) == 3
+
+
+def test_ingest_leaves_the_source_alone(tmp_path):
+    store = str(tmp_path / "store")
+    source = tmp_path / "orbs" / "phi_0.orb"
+    manifest = ingest(store, orbitals(tmp_path / "orbs", **{"phi_0.orb": b"orbital"}))
+    (digest, _), = read_manifest(manifest)
+
+    assert os.access(source, os.W_OK)
+    assert os.stat(source).st_ino != os.stat(object_path(store, digest)).st_ino
+    assert not os.stat(object_path(store, digest)).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+    # Writing to the source afterwards does not change the store
+    source.write_bytes(b"changed")
+    assert verify(store) == []
+
+
+def test_restore(tmp_path):
+    store = str(tmp_path / "store")
+    manifest = ingest(store, orbitals(tmp_path / "orbs", **{"phi_0.orb": b"0", "sub/phi_1.orb": b"1"}))
+
+    linked = tmp_path / "linked"
+    restore(manifest, str(linked))
+    assert (linked / "sub" / "phi_1.orb").read_bytes() == b"1"
+    assert not os.stat(linked / "phi_0.orb").st_mode & stat.S_IWUSR
+
+    copied = tmp_path / "copied"
+    restore(manifest, str(copied), copy=True)
+    (copied / "phi_0.orb").write_bytes(b"changed")
+    assert verify(store) == []
+    assert (linked / "phi_0.orb").read_bytes() == b"0"
+
+
+def test_gc_keeps_referenced_objects(tmp_path):
+    store = str(tmp_path / "store")
+    kept = ingest(store, orbitals(tmp_path / "a", **{"shared.orb": b"s", "a.orb": b"a"}))
+    old = ingest(store, orbitals(tmp_path / "b", **{"shared.orb": b"s", "b.orb": b"b"}))
+    (tmp_path / "project").mkdir()
+    (tmp_path / "project" / "job.orbitals").write_text(kept + "\n")
+
+    # Both manifests are unused for long; only the one named by a .orbitals file is kept
+    past = time.time() - 60 * 86400
+    for manifest in (kept, old):
+        os.utime(manifest, (past, past))
+    assert gc(store, days=30, keep=[str(tmp_path / "project")], grace_hours=0, dry_run=True)[:2] == (1, 1)
+    assert len(manifests(store)) == 2
+
+    assert gc(store, days=30, keep=[str(tmp_path / "project")], grace_hours=0)[:2] == (1, 1)
+    assert manifests(store) == [kept]
+    assert sorted(os.path.basename(path) for path in objects(store)) == sorted(digest for digest, _ in read_manifest(kept))
+
+
+def test_gc_spares_recent_objects(tmp_path):
+    store = str(tmp_path / "store")
+    manifest = ingest(store, orbitals(tmp_path / "a", **{"a.orb": b"a"}))
+    os.remove(manifest)
+    assert gc(store, grace_hours=24)[:2] == (0, 0)
+    assert gc(store, grace_hours=0)[:2] == (0, 1)
+
+
+def test_verify_finds_corrupt_objects(tmp_path):
+    store = str(tmp_path / "store")
+    manifest = ingest(store, orbitals(tmp_path / "a", **{"a.orb": b"a", "b.orb": b"b"}))
+    (digest, _), _ = read_manifest(manifest)
+    path = object_path(store, digest)
+    os.chmod(path, 0o644)
+    with open(path, "wb") as f:
+        f.write(b"bit rot")
+    assert verify(store) == [path]
@@ -0,0 +1,105 @@
+import pytest
+
+from status import MARKERS, KILLED, tail, termination, log_ended, job_status, scan, summary
+
+ENDED = """
+       JobID   JobName       State    Elapsed
+------------ --------- ----------- ----------
+        4001       h2o   COMPLETED   01:02:03
+  4001.batch     batch   COMPLETED   01:02:03
+"""
+STILL_RUNNING = """
+  JobID   JobName     State    Elapsed
+------- --------- --------- ----------
+   4001       h2o   RUNNING   01:02:03
+"""
+CHECKPOINT = "Time limit is near: stopping the calculation and copying back its files\n"
+
+
+def write(tmp_path, **files):
+    """Write the files of a job h2o, e.g. out="...", err="...", and return the path of the input without extension"""
+    for extension, text in files.items():
+        (tmp_path / f"h2o.{extension}").write_text(text)
+    return str(tmp_path / "h2o")
+
+
+@pytest.mark.parametrize("marker, program, state", MARKERS)
+def test_markers(tmp_path, marker, program, state):
+    base = write(tmp_path, out=f"SCF iterations\n **** {marker} ****\n", log="")
+    status = job_status(base)
+    assert (status["state"], status["program"]) == (state, program)
+    if state == "failed":
+        assert marker in status["detail"]
+
+
+def test_last_marker_counts():
+    assert termination("Error termination via Lnk1e\nNormal termination of Gaussian 16\n")[1] == "completed"
+    assert termination("Normal termination of Gaussian 16\nError termination via Lnk1e\n")[1:] == \
+        ("failed", "Error termination via Lnk1e")
+    assert termination("no marker here\n") is None
+
+
+@pytest.mark.parametrize("message, reason", KILLED)
+def test_killed(tmp_path, message, reason):
+    base = write(tmp_path, out="SCF ITERATIONS\n", err=f"slurmstepd: error: *** JOB 4001 ON c1-1 {message} ***\n",
+                 log=ENDED)
+    assert (job_status(base)["state"], job_status(base)["detail"]) == ("failed", reason)
+
+
+def test_log_ended():
+    assert log_ended("no usage tables\n") is None
+    assert log_ended("Starting the calculation\n" + ENDED) == "COMPLETED"
+    assert log_ended(STILL_RUNNING) is None
+
+
+def test_ended_without_termination_message(tmp_path):
+    base = write(tmp_path, out="SCF ITERATIONS\n", log=ENDED)
+    status = job_status(base)
+    assert status["state"] == "failed" and "COMPLETED" in status["detail"]
+
+
+def test_running_and_missing(tmp_path):
+    assert job_status(write(tmp_path, out="SCF ITERATIONS\n", log="Starting\n"))["state"] == "running"
+    assert job_status(str(tmp_path / "other"))["state"] == "missing"
+
+
+def test_orbitals_of_a_completed_mrchem_job(tmp_path):
+    assert job_status(write(tmp_path, orbitals="/store/manifest\n"))["state"] == "completed"
+    status = job_status(write(tmp_path, out="SCF cycle 42\n", orbitals="/store/manifest\n", log=ENDED))
+    assert (status["state"], status["program"]) == ("completed", "mrchem")
+
+
+def test_orbitals_of_a_checkpoint_are_not_a_completion(tmp_path):
+    # Stopped at the time limit and resubmitted: the checkpoint also wrote the .orbitals file
+    base = write(tmp_path, out="SCF cycle 42\n", orbitals="/store/manifest\n",
+                 log=CHECKPOINT + "Submitted batch job 4002\n" + ENDED)
+    assert (job_status(base)["state"], job_status(base)["detail"]) == ("running", "resubmitted")
+
+    # The resubmitted job has started and truncated the log
+    base = write(tmp_path, out="SCF cycle 1\n", log="Starting\n" + STILL_RUNNING)
+    assert job_status(base)["state"] == "running"
+
+    # Resubmitted too often
+    base = write(tmp_path, log=CHECKPOINT + "Not resubmitting: the job was already resubmitted 3 times\n" + ENDED)
+    assert (job_status(base)["state"], job_status(base)["detail"]) == ("failed", "stopped at the time limit")
+
+
+def test_only_the_end_is_read(tmp_path):
+    path = tmp_path / "big.out"
+    path.write_text("ORCA TERMINATED NORMALLY\n" + "x" * 100000 + "\n")
+    assert "ORCA TERMINATED NORMALLY" not in tail(str(path), size=1024)
+    assert len(tail(str(path), size=1024)) == 1024
+    assert tail(str(tmp_path / "none.out")) is None
+
+
+def test_scan_and_summary(tmp_path):
+    (tmp_path / "a.out").write_text("**** ORCA TERMINATED NORMALLY ****\n")
+    (tmp_path / "b.out").write_text("Error termination via Lnk1e\n")
+    (tmp_path / "c.log").write_text("Starting\n")
+    inputs = [str(tmp_path / name) for name in "abcd"]
+    statuses = scan(inputs, workers=2)
+    assert [status["input"] for status in statuses] == inputs
+    assert [status["state"] for status in statuses] == ["completed", "failed", "running", "missing"]
+    table = summary(statuses)
+    assert table["orca"]["completed"] == 1 and table["gaussian"]["failed"] == 1
+    assert table["-"] == dict(completed=0, failed=0, running=1, missing=1)
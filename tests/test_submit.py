@@ -0,0 +1,120 @@
+import os
+import stat
+
+import pytest
+
+from submit import sbatch, submit_jobs, SubmissionError, TRANSIENT_ERRORS
+
+# Fake sbatch: fails with a transient error the first $FAILS times it is called for a job file,
+# then prints "jobid;cluster" like sbatch --parsable. Every call is logged with its start and end
+FAKE_SBATCH = """#!/bin/bash
+job="${@: -1}"
+echo "start $job" >> "$LOG"
+sleep "${DELAY:-0}"
+count=$(cat "$job.calls" 2> /dev/null || echo 0)
+echo $((count + 1)) > "$job.calls"
+echo "end $job" >> "$LOG"
+if [ "$count" -lt "${FAILS:-0}" ]; then
+    echo "sbatch: error: ${MESSAGE}" >&2
+    exit 1
+fi
+echo "$((1000 + $(cksum < "$job" | cut -d' ' -f1) % 1000));saga"
+"""
+
+
+@pytest.fixture
+def fake_sbatch(tmp_path, monkeypatch):
+    script = tmp_path / "sbatch"
+    script.write_text(FAKE_SBATCH)
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("LOG", str(tmp_path / "calls.log"))
+    monkeypatch.setenv("MESSAGE", TRANSIENT_ERRORS[0])
+    return str(script)
+
+
+def jobfiles(directory, count):
+    paths = []
+    for i in range(count):
+        path = directory / f"job{i}.job"
+        path.write_text(f"#!/bin/bash\necho {i}\n")
+        paths.append(str(path))
+    return paths
+
+
+def calls(path):
+    with open(path + ".calls") as f:
+        return int(f.read())
+
+
+def test_retries_transient_errors(tmp_path, fake_sbatch, monkeypatch):
+    monkeypatch.setenv("FAILS", "3")
+    job, = jobfiles(tmp_path, 1)
+    jobid = sbatch(job, command=fake_sbatch, retries=5, backoff=0)
+    assert jobid.isdigit() and ";" not in jobid
+    assert calls(job) == 4
+
+
+def test_gives_up_after_retries(tmp_path, fake_sbatch, monkeypatch):
+    monkeypatch.setenv("FAILS", "10")
+    job, = jobfiles(tmp_path, 1)
+    with pytest.raises(SubmissionError, match=TRANSIENT_ERRORS[0]):
+        sbatch(job, command=fake_sbatch, retries=2, backoff=0)
+    assert calls(job) == 3
+
+
+def test_does_not_retry_other_errors(tmp_path, fake_sbatch, monkeypatch):
+    monkeypatch.setenv("FAILS", "1")
+    monkeypatch.setenv("MESSAGE", "Batch job submission failed: Invalid account")
+    job, = jobfiles(tmp_path, 1)
+    with pytest.raises(SubmissionError, match="Invalid account"):
+        sbatch(job, command=fake_sbatch, retries=5, backoff=0)
+    assert calls(job) == 1
+
+
+def test_backoff_doubles(tmp_path, fake_sbatch, monkeypatch):
+    import submit
+
+    delays = []
+    monkeypatch.setattr(submit.time, "sleep", delays.append)
+    monkeypatch.setattr(submit.random, "uniform", lambda low, high: 1.0)
+    monkeypatch.setenv("FAILS", "3")
+    job, = jobfiles(tmp_path, 1)
+    sbatch(job, command=fake_sbatch, retries=5, backoff=0.5)
+    assert delays == [0.5, 1.0, 2.0]
+
+
+def test_ledger_records_job_ids(tmp_path, fake_sbatch, monkeypatch):
+    monkeypatch.setenv("FAILS", "1")
+    jobs = jobfiles(tmp_path, 5)
+    ledger = tmp_path / "ledger.tsv"
+    jobids, errors = submit_jobs(jobs, command=fake_sbatch, backoff=0, ledger=str(ledger), silent=True)
+    assert errors == {}
+    assert sorted(jobids) == sorted(jobs)
+
+    lines = [line.split("\t") for line in ledger.read_text().splitlines()]
+    assert len(lines) == len(jobs)
+    assert {path: jobid for _, path, jobid in lines} == {os.path.abspath(job): jobid for job, jobid in jobids.items()}
+
+
+def test_failed_jobs_are_reported(tmp_path, fake_sbatch, monkeypatch):
+    monkeypatch.setenv("FAILS", "10")
+    jobs = jobfiles(tmp_path, 2)
+    ledger = tmp_path / "ledger.tsv"
+    jobids, errors = submit_jobs(jobs, command=fake_sbatch, retries=1, backoff=0, ledger=str(ledger), silent=True)
+    assert jobids == {}
+    assert sorted(errors) == sorted(jobs)
+    assert not ledger.exists()
+
+
+def test_bounded_concurrency(tmp_path, fake_sbatch, monkeypatch):
+    monkeypatch.setenv("DELAY", "0.2")
+    jobs = jobfiles(tmp_path, 8)
+    jobids, errors = submit_jobs(jobs, command=fake_sbatch, max_workers=3, silent=True)
+    assert len(jobids) == 8 and errors == {}
+
+    running = most = 0
+    with open(os.environ["LOG"]) as f:
+        for line in f:
+            running += 1 if line.startswith("start") else -1
+            most = max(most, running)
+    assert 1 < most <= 3
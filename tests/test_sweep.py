@@ -0,0 +1,49 @@
+import pytest
+
+import sweep
+from utils import SettingsError, billing, billing_units, maxbilling_okay
+
+EXCLUSIVE = {"normal": {"factor_mem": 0.0, "factor_cpu": 1.0, "cores_per_node": 32, "mem_per_node": 59, "exclusive": True},
+             "max": 1000}
+
+
+def test_numpy_and_python_sweeps_agree(monkeypatch):
+    pytest.importorskip("numpy")
+    vectorized = sweep.sweep("saga", 24, "100GB")
+    monkeypatch.setattr(sweep, "numpy", None)
+    assert sweep.sweep("saga", 24, "100GB") == vectorized
+
+
+def test_free_memory_of_exclusive_partitions(monkeypatch):
+    monkeypatch.setitem(sweep.billing, "test", EXCLUSIVE)
+    assert sweep.free_memory_gb("test", "normal", 8) == 59
+    numpy = pytest.importorskip("numpy")
+    free = sweep.free_memory_gb("test", "normal", numpy.array([1, 8, 64]))
+    assert free.tolist() == [59.0, 59.0, 59.0]
+
+
+def test_exclusive_partitions_bill_whole_nodes(monkeypatch):
+    monkeypatch.setitem(sweep.billing, "test", EXCLUSIVE)
+    partition, ntasks, cpus, bill = sweep.cheapest("test", 40, "10GB")
+    assert ntasks * cpus == 40 and bill == 64
+
+
+@pytest.mark.parametrize("cluster, cores_per_node, nodes", [("fram", 32, 32), ("betzy", 128, 512)])
+def test_whole_node_clusters(cluster, cores_per_node, nodes):
+    assert billing_units(cluster, "normal", cores_per_node + 1, 1) == 2 * cores_per_node
+    assert maxbilling_okay(cluster=cluster, ntasks=nodes * cores_per_node, ncpus_per_task=1, mem="10GB",
+                           partition="normal") == (True, nodes * cores_per_node)
+    assert not maxbilling_okay(cluster=cluster, ntasks=nodes * cores_per_node + 1, ncpus_per_task=1, mem="10GB",
+                               partition="normal")[0]
+    # A whole node costs the same for any layout, and comes with all of its memory
+    cheapest, = sweep.sweep(cluster, cores_per_node, "10GB", max_cores=cores_per_node)
+    assert (cheapest["billing"], cheapest["memory"]) == (cores_per_node, billing[cluster]["normal"]["mem_per_node"])
+
+
+def test_stallo_is_refused():
+    with pytest.raises(SettingsError, match="No billing model"):
+        sweep.sweep("stallo", 32, "10GB")
+    with pytest.raises(SettingsError, match="No billing model"):
+        sweep.cheapest("stallo", 32, "10GB")
+    with pytest.raises(SettingsError, match="No billing model"):
+        maxbilling_okay(cluster="stallo", ntasks=4, ncpus_per_task=8, mem="10GB", partition="normal")
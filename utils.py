@@ -1,7 +1,10 @@
-import sys
 import os
+import re
+import warnings
 import datetime
 
+from profiling import phase
+
 
 #########################################################
 #   --U S E R    D E F I N E D    V A R I A B L E S--   #
@@ -12,6 +15,10 @@ import datetime
 # The variable 'orbdir' you can set freely, but it is
 # recommended that this is limited to the work area,
 # since orbital files can occupy many GBs worth of data
+# If 'orbstore' is set (uncomment it to enable it), MRChem
+# orbitals and checkpoints are kept in this content-
+# addressed store instead of 'orbdir'/'checkdir', so that
+# identical files are only stored once (see orbstore.py)
 #########################################################
 vars = {
     "stallo": {
@@ -30,7 +37,10 @@ vars = {
         "mrchem_environ": "/cluster/home/ambr/mrchem_v1/tools/fram.env",
         "mrchem_venv": "/cluster/home/ambr/.local/share/virtualenvs/mrchem_v1-qK46GSpE/bin/activate",
         "orbdir": "/cluster/projects/nn4654k/ambr/MWOrbitals/${SLURM_JOBID}",
-        "checkdir": "/cluster/projects/nn4654k/ambr/MWCheckpoints/${SLURM_JOBID}"
+        "checkdir": "/cluster/projects/nn4654k/ambr/MWCheckpoints/${SLURM_JOBID}",
+        # "orbstore": "/cluster/projects/nn4654k/ambr/MWStore",
+        # "staging": {"streams": 4},
+        # "telemetry": {"interval": 60}
     },
     "saga": {
         "mpi_version": "OpenMPI/3.1.4-GCC-8.3.0",
@@ -41,28 +51,127 @@ vars = {
         "mrchem_environ": "/cluster/home/ambr/mrchem_master_20210108/tools/saga.env",
         "mrchem_venv": "/cluster/home/ambr/.local/share/virtualenvs/mrchem_master_20210108-v1b016BV/bin/activate",
         "orbdir": "/cluster/projects/nn4654k/ambr/MWorbitals_${SLURM_JOBID}",
-        "checkdir": "/cluster/projects/nn4654k/ambr/MWcheckpoints_${SLURM_JOBID}"
+        "checkdir": "/cluster/projects/nn4654k/ambr/MWcheckpoints_${SLURM_JOBID}",
+        # "orbstore": "/cluster/projects/nn4654k/ambr/MWstore",
+        # "staging": {"streams": 4},
+        # "telemetry": {"interval": 60}
     },
     "betzy": {
         "mrchem_path": "/cluster/home/ambr/MRChem/install-1.0.1/bin/mrchem",
         "mrchem_environ": "/cluster/home/ambr/MRChem/tools/betzy.env",
         "orbdir": "/cluster/projects/${SLURM_JOB_ACCOUNT}/ambr/orbitals/${SLURM_JOBID}",
-        "checkdir": "/cluster/projects/${SLURM_JOB_ACCOUNT}/ambr/checkpoints/${SLURM_JOBID}"
+        "checkdir": "/cluster/projects/${SLURM_JOB_ACCOUNT}/ambr/checkpoints/${SLURM_JOBID}",
+        # "orbstore": "/cluster/projects/${SLURM_JOB_ACCOUNT}/ambr/store",
+        # "staging": {"streams": 4},
+        # "telemetry": {"interval": 60}
     }
 }
 
+# Billing model per partition. A job is billed the larger of its CPU share (factor_cpu per CPU) and
+# its memory share (factor_mem per GB), or whole nodes on partitions that are allocated exclusively.
+# cores_per_node and mem_per_node (GB) are the limits of a single node. "max" is the largest billing
+# allowed for a job, for the whole cluster or per partition. The normal partitions of Fram and Betzy
+# are allocated in whole nodes, and their maxima are the largest jobs allowed (32 and 512 nodes).
+# Stallo is not modelled, as it was accounted in plain CPU hours: --checkbill, --autobill, and the
+# sweep refuse it.
 billing = {
     "saga": {
-        "bigmem": {"factor_mem": 0.1059915, "factor_cpu": 1.0},
-        "normal": {"factor_mem": 0.2145918, "factor_cpu": 1.0},
+        "bigmem": {"factor_mem": 0.1059915, "factor_cpu": 1.0, "cores_per_node": 40, "mem_per_node": 377},
+        "normal": {"factor_mem": 0.2145918, "factor_cpu": 1.0, "cores_per_node": 40, "mem_per_node": 186},
         "max": 256
     },
-    "fram": {"max": 100000000},
-    "stallo": {"max": 100000000}
+    "fram": {
+        "normal": {"factor_mem": 0.0, "factor_cpu": 1.0, "cores_per_node": 32, "mem_per_node": 59, "exclusive": True},
+        "max": 32 * 32
+    },
+    "betzy": {
+        "normal": {"factor_mem": 0.0, "factor_cpu": 1.0, "cores_per_node": 128, "mem_per_node": 245, "exclusive": True},
+        "max": 512 * 128
+    }
 }
+
+# How files are moved between the submit directory and scratch. Override per cluster
+# with a "staging" entry in vars, e.g. "staging": {"streams": 4, "compress": [".trj"]}
+#   streams:            number of parallel copies. 1 gives plain, serial 'cp' commands
+#   compress:           suffixes of files that are copied back zstd-compressed (as <file>.zst)
+#   compress_min_mb:    only compress files at least this large
+#   compress_orbitals:  store MRChem orbitals and checkpoints as one .tar.zst archive each
+STAGING_DEFAULTS = {"streams": 1, "compress": [], "compress_min_mb": 64, "compress_orbitals": False}
+
+# With a "telemetry" entry in vars, e.g. "telemetry": {"interval": 30}, the job scripts write
+# <output>.telemetry.json next to the .log file, with the wall time of each phase of the job
+# (module_load, stage_in, compute, copy_back, cleanup), the bytes staged, and samples of the
+# memory and CPU usage of the node
+#   interval:  seconds between samples
+TELEMETRY_DEFAULTS = {"interval": 60}
 #########################################################
 
 
+class SlurmifyError(Exception):
+    """Base class of the errors raised while generating job files"""
+
+
+class MissingFileError(SlurmifyError):
+    """An input file, or a file it references, does not exist"""
+
+
+class InvalidInputError(SlurmifyError):
+    """An input file lacks information needed to generate the job file"""
+
+
+class SettingsError(SlurmifyError, ValueError):
+    """The requested settings are invalid or not supported on the cluster"""
+
+
+class SlurmifyWarning(UserWarning):
+    """A problem that does not prevent generating the job file"""
+
+
+def check_memory(memory):
+    if memory is None or not memory.endswith("B"):
+        raise SettingsError(f"You must specify units of memory allocation (number must end with 'B'), got {memory}")
+
+
+_MEMORY_UNITS = {"KB": 1 / 1024**2, "MB": 1 / 1024, "GB": 1, "TB": 1024}
+
+
+def memory_gb(memory):
+    """Convert a SLURM memory specification such as '10GB' to GB"""
+    check_memory(memory)
+    try:
+        return float(memory[:-2]) * _MEMORY_UNITS[memory[-2:].upper()]
+    except (KeyError, ValueError):
+        raise SettingsError(f"Cannot interpret the memory specification {memory}. Use KB, MB, GB or TB")
+
+
+def partitions(cluster):
+    """Partitions of a cluster that have a billing model"""
+    return [name for name, model in billing.get(cluster, {}).items() if isinstance(model, dict)]
+
+
+def max_billing(cluster, partition):
+    return billing[cluster][partition].get("max", billing[cluster]["max"])
+
+
+def billing_units(cluster, partition, cores, mem_gb):
+    """
+    Billing units of a job. Also works element-wise on NumPy arrays of cores and memory.
+    :param cores: total number of CPUs (ntasks times cpus per task)
+    :param mem_gb: memory in GB
+    :return: billing units
+    """
+    if partition not in partitions(cluster):
+        raise SettingsError(f"No billing model for the partition {partition} on {cluster}")
+    model = billing[cluster][partition]
+    if model.get("exclusive"):
+        nodes = -(-cores // model["cores_per_node"])
+        return nodes * model["cores_per_node"] * model["factor_cpu"]
+    cpu = cores * model["factor_cpu"]
+    mem = mem_gb * model["factor_mem"]
+    # max(cpu, mem), spelled out so that it also applies to arrays
+    return (cpu >= mem) * cpu + (cpu < mem) * mem
+
+
 def header(hdr):
     title = "="*20 + " "*5 + " ".join(hdr.upper()) + " "*5 + "="*20
     my_header = f"""
@@ -83,15 +192,15 @@ def maxbilling_okay(cluster=None, ncpus_per_task=None, ntasks=None, mem=None, me
     :param partition:
     :return:
     """
-    assert not all([mem is None for mem in [mem, mem_per_cpu]]), "These arguments are mutually exclusive!"
-    assert not all([mem is not None for mem in [mem, mem_per_cpu]]), "You must specify one of these arguments!"
+    if mem is None and mem_per_cpu is None:
+        raise SettingsError("You must specify either the memory or the memory per CPU to check the billing!")
+    if mem is not None and mem_per_cpu is not None:
+        raise SettingsError("The memory and the memory per CPU are mutually exclusive!")
 
-    if mem:
-        bill = billing[cluster][partition]["factor_mem"] * float(mem[:-2]) + float(ntasks)*float(ncpus_per_task)
-    elif mem_per_cpu:
-        bill = billing[cluster][partition]["factor_mem"] * float(ncpus_per_task) * float(ntasks) * float(mem_per_cpu[:-2]) + float(ntasks) * float(ncpus_per_task)
+    cores = int(ntasks) * int(ncpus_per_task)
+    bill = billing_units(cluster, partition, cores, memory_gb(mem) if mem else memory_gb(mem_per_cpu) * cores)
 
-    if bill > billing[cluster]["max"]:
+    if bill > max_billing(cluster, partition):
         return False, bill
     else:
         return True, bill
@@ -144,233 +253,744 @@ def make_test_inputs(destination=".", extension=".inp"):
         f.write("*\n")
 
 
-def input_origin(inputfile):
-    G, O, M = False, False, False
-    content = open(inputfile).readlines()
-    if any(["".join(line.split()).startswith("*xyz") for line in content]):
-        O = True
-    elif any(["".join(line.split()).startswith("world_prec") for line in content]):
-        M = True
+def scan_input(inputfile, aux=True):
+    """
+    Read an input file once and collect everything Slurmify needs from it: which program the
+    input is for, and the auxiliary files it references. The file is streamed line by line, and
+    reading stops as soon as nothing more can be learned from the rest of the file.
+    :param inputfile: name of input file, including extension
+    :param aux: collect references to auxiliary files. If False, only the program is determined
+    :return: manifest dict with the keys "program" ("orca", "gaussian", or "mrchem"),
+             "hess", "xyz", "cmp", "gbw" (ORCA), "chk", "oldchk" (Gaussian), and
+             "orbitals", "checkpoint" (MRChem). Keys of files not referenced are None
+    """
+    manifest = dict(program=None, hess=None, xyz=None, cmp=None, gbw=None, chk=None, oldchk=None,
+                    orbitals=None, checkpoint=None)
+    orca, mrchem = False, False
+    expect_cmp = False
+
+    with open(inputfile) as f:
+        for line in f:
+            stripped = line.strip()
+            lowered = stripped.lower()
+            squeezed = "".join(line.split())
+            squeezed_lower = squeezed.lower()
+
+            if squeezed.startswith("*xyz"):
+                orca = True
+                if not aux:
+                    break
+            elif squeezed.startswith("world_prec"):
+                mrchem = True
+            if not aux:
+                continue
+
+            # Second line of a multiline %compound block
+            if expect_cmp:
+                manifest["cmp"] = stripped[1:-1]
+                expect_cmp = False
+
+            # ORCA
+            if manifest["hess"] is None and lowered.startswith("inhessname"):
+                manifest["hess"] = line.split()[1][1:-1]
+            elif manifest["xyz"] is None and squeezed.startswith("*xyzfile"):
+                manifest["xyz"] = line.split()[-1].strip()
+            elif manifest["cmp"] is None and squeezed_lower.startswith("%compound") and stripped.endswith("end"):
+                manifest["cmp"] = line.split()[-2][1:-1]
+            elif manifest["cmp"] is None and lowered.startswith("%") and "compound" in line and "end" not in line:
+                expect_cmp = True
+            elif manifest["gbw"] is None and squeezed_lower.startswith("%moinp"):
+                manifest["gbw"] = line.split()[-1][1:-1]
+
+            # Gaussian
+            elif manifest["chk"] is None and squeezed_lower.startswith("%chk="):
+                manifest["chk"] = squeezed.split("=", 1)[1]
+            elif manifest["oldchk"] is None and squeezed_lower.startswith("%oldchk="):
+                manifest["oldchk"] = squeezed.split("=", 1)[1]
+
+            # MRChem
+            elif manifest["orbitals"] is None and squeezed_lower.startswith("path_orbitals="):
+                manifest["orbitals"] = squeezed.split("=", 1)[1].strip("\"'")
+            elif manifest["checkpoint"] is None and squeezed_lower.startswith("path_checkpoint="):
+                manifest["checkpoint"] = squeezed.split("=", 1)[1].strip("\"'")
+
+            # Nothing left to learn from an ORCA input once all its references are found
+            if orca and all(manifest[key] is not None for key in ["hess", "xyz", "cmp", "gbw"]):
+                break
+
+    if orca:
+        manifest["program"] = "orca"
+    elif mrchem:
+        manifest["program"] = "mrchem"
     else:
-        G = True
+        manifest["program"] = "gaussian"
+    return manifest
+
+
+def input_origin(inputfile, manifest=None):
+    """
+    Determine which program an input file is for
+    :param inputfile: name of input file, including extension
+    :param manifest: manifest from scan_input. The input file is not read if given
+    :return: tuple of booleans (Gaussian, ORCA, MRChem)
+    """
+    if manifest is None:
+        manifest = scan_input(inputfile, aux=False)
+    G, O, M = [manifest["program"] == program for program in ["gaussian", "orca", "mrchem"]]
     return G, O, M
 
 
-def get_orca_hessfile(inputfile):
+def _orca_auxfile(inputfile, key, suffix, manifest=None):
     try:
-        content = open(inputfile).readlines()
-        for line in content:
-            if line.lower().strip().startswith("inhessname"):
-                return line.split()[1][1:-1]
-        else:
-            sys.exit("Error! Could not locate .hess file in input file.")
+        if manifest is None:
+            manifest = scan_input(inputfile)
     except FileNotFoundError:
-        sys.exit(f"Error! The input file ({inputfile}) was not found")
+        raise MissingFileError(f"Error! The input file ({inputfile}) was not found")
+    if manifest[key] is None:
+        raise InvalidInputError(f"Error! Could not locate {suffix} file in input file.")
+    return manifest[key]
 
 
-def get_orca_xyzfile(inputfile):
-    try:
-        content = open(inputfile).readlines()
-        for line in content:
-            if "".join(line.split()).strip().startswith("*xyzfile"):
-                return line.split()[-1].strip()
-        else:
-            sys.exit("Error! Could not locate .xyz file in input file.")
-    except FileNotFoundError:
-        sys.exit(f"Error! The input file ({inputfile}) was not found")
+def get_orca_hessfile(inputfile, manifest=None):
+    return _orca_auxfile(inputfile, "hess", ".hess", manifest)
 
 
-def get_orca_compfile(inputfile):
-    try:
-        content = open(inputfile).readlines()
-        for i, line in enumerate(content):
-            # Catch the oneliner
-            if "".join(line.lower().split()).strip().startswith("%compound") and line.strip().endswith("end"):
-                return line.split()[-2][1:-1]
-            # Catch the multiliner
-            elif line.lower().strip().startswith("%") and "compound" in line and "end" not in line:
-                return content[i+1].strip()[1:-1]
-        else:
-            sys.exit("Error! Could not locate .cmp file in input file.")
-    except FileNotFoundError:
-        sys.exit(f"Error! The input file ({inputfile}) was not found")
+def get_orca_xyzfile(inputfile, manifest=None):
+    return _orca_auxfile(inputfile, "xyz", ".xyz", manifest)
 
 
-def get_orca_gbwfile(inputfile):
-    try:
-        with open(inputfile) as f:
-            content = f.readlines()
-        for line in content:
-            if "".join(line.lower().split()).startswith("%moinp"):
-                return line.split()[-1][1:-1]
-        else:
-            sys.exit("Error! Could not locate .bgw file in input file.")
-    except FileNotFoundError:
-        sys.exit(f"Error! The input file ({inputfile}) was not found")
+def get_orca_compfile(inputfile, manifest=None):
+    return _orca_auxfile(inputfile, "cmp", ".cmp", manifest)
 
 
-def orca_job(inputfile=None, outputfile=None, is_dev=None, slurm_account=None, slurm_nodes=None,
-             cluster=None, slurm_ntasks_per_node=None, slurm_memory=None, slurm_time=None, slurm_partition=None,
-             slurm_mail=None, extension_outputfile=None, extension_inputfile=None, chess=False, cxyz=False, ccomp=False,
-             cgbw=None, loc=None, identifier=None):
-    """
+def get_orca_gbwfile(inputfile, manifest=None):
+    return _orca_auxfile(inputfile, "gbw", ".bgw", manifest)
 
-    :param inputfile: name of input file without extension
-    :param outputfile: name of output file without extension
-    :param is_dev: prepare for development queue
-    :param slurm_account: slurm account number to be charged
-    :param slurm_nodes: number of nodes
-    :param cluster: for which cluster will the job be made
-    :param slurm_ntasks_per_node: number of tasks per node
-    :param slurm_memory: total memory per node
-    :param slurm_time: time limit for job
-    :param slurm_mail: mail notification type
-    :param extension_outputfile: extension used for output file
-    :param extension_inputfile: extension used for input file
-    :param chess: copy .hess file to scratch
-    :param cxyz: copy .xyz file to scratch
-    :param ccomp: copy .cmp file to scratch
-    :param cgbw: copy .bgw file to scratch
-    :param loc: non-exclusive, use --ntasks instead of --ntasks-per-node
-    :param identifier: how job name is presented in the queue. Does not affect name of input file
-    :return:
-    """
 
-    assert slurm_memory.endswith("B"), "You must specify units of memory allocation (number must end with 'B')"
+def timestamp_header(timestamp, rule):
+    return ["#! /bin/bash",
+            "",
+            f"#{rule}",
+            timestamp,
+            f"#{rule}",
+            ""]
 
-    timestamp = f"# File generated {datetime.datetime.now()}"
 
-    jobfile = []
-    jobfile.append("#! /bin/bash")
-    jobfile.append("")
-    jobfile.append(f"#{'-'*len(timestamp)}")
-    jobfile.append(timestamp)
-    jobfile.append(f"#{'-'*len(timestamp)}")
-    jobfile.append("")
-    jobfile.append(f"#SBATCH --account={slurm_account}")
-    jobfile.append(f"#SBATCH --job-name={identifier}")
-    jobfile.append(f"#SBATCH --output={outputfile+'.log'}")
-    jobfile.append(f"#SBATCH --error={outputfile+'.err'}")
+def sbatch_directives(slurm_account=None, identifier=None, outputfile=None, loc=None, slurm_nodes=None,
+                      slurm_ntasks_per_node=None, slurm_cpus_per_task=None, slurm_time=None, slurm_mem_per_cpu=None,
+                      slurm_memory=None, slurm_mail=None, is_dev=None, slurm_partition=None, slurm_signal=None):
+    """
+    The #SBATCH lines shared by all job types. Options that are None are left out.
+    slurm_signal is the number of seconds before the time limit at which the job script is sent USR1.
+    :return: list of lines
+    """
+    lines = [f"#SBATCH --account={slurm_account}",
+             f"#SBATCH --job-name={identifier}",
+             f"#SBATCH --output={outputfile+'.log'}",
+             f"#SBATCH --error={outputfile+'.err'}"]
     if loc:
-        jobfile.append(f"#SBATCH --nodes={slurm_nodes}")
-        jobfile.append(f"#SBATCH --ntasks-per-node={slurm_ntasks_per_node}")
+        lines.append(f"#SBATCH --nodes={slurm_nodes}")
+        lines.append(f"#SBATCH --ntasks-per-node={slurm_ntasks_per_node}")
     else:
-        jobfile.append(f"#SBATCH --ntasks={slurm_ntasks_per_node}")
-    jobfile.append(f"#SBATCH --time={slurm_time}")
-    if cluster != "fram": jobfile.append(f"#SBATCH --mem={slurm_memory}")
-    jobfile.append(f"#SBATCH --mail-type={slurm_mail}")
-    if is_dev: 
-        jobfile.append("#SBATCH --qos=devel")
+        lines.append(f"#SBATCH --ntasks={slurm_ntasks_per_node}")
+    if slurm_cpus_per_task is not None:
+        lines.append(f"#SBATCH --cpus-per-task={slurm_cpus_per_task}")
+    lines.append(f"#SBATCH --time={slurm_time}")
+    if slurm_signal is not None:
+        lines.append(f"#SBATCH --signal=B:USR1@{slurm_signal}")
+    if slurm_mem_per_cpu is not None:
+        lines.append(f"#SBATCH --mem-per-cpu={slurm_mem_per_cpu}")
+    if slurm_memory is not None:
+        lines.append(f"#SBATCH --mem={slurm_memory}")
+    lines.append(f"#SBATCH --mail-type={slurm_mail}")
+    if is_dev:
+        lines.append("#SBATCH --qos=devel")
     else:
-        jobfile.append(f"#SBATCH --partition={slurm_partition}")
-    jobfile.append("")
+        lines.append(f"#SBATCH --partition={slurm_partition}")
+    lines.append("")
+    return lines
+
+
+def scratch_setup(cluster, mkdir="mkdir -p"):
+    """Create the scratch directory on clusters where SLURM does not provide one"""
+    if cluster != "stallo":
+        return []
+    return [f"SCRATCH={vars[cluster]['scratch']}",
+            f"{mkdir} $SCRATCH",
+            ""]
+
+
+def scratch_cleanup(cluster):
+    """Remove the scratch directory (On Fram and Saga clean up is automatic)"""
+    if cluster != "stallo":
+        return []
+    return ["rm $SCRATCH/*",
+            "rmdir $SCRATCH"]
+
+
+def staging_config(cluster):
+    return dict(STAGING_DEFAULTS, **vars[cluster].get("staging", {}))
+
+
+def parallel_staging(cluster):
+    config = staging_config(cluster)
+    return config["streams"] > 1 or bool(config["compress"]) or config["compress_orbitals"]
+
+
+def staging_functions(cluster):
+    """
+    Shell functions for parallel, optionally compressed staging, which also keep count of the
+    bytes and seconds spent staging. Empty if the cluster uses plain serial copies.
+      stage [-o] [-z] DEST FILE...   copy files to DEST. -o: skip missing files, -z: compress large files
+      stage_dir [-z] SRC DEST        copy the contents of directory SRC (or SRC.tar.zst archive) to DEST
+    """
+    if not parallel_staging(cluster):
+        return []
+    config = staging_config(cluster)
+    pattern = "|".join(re.escape(suffix) for suffix in config["compress"])
+    return [f"STAGE_STREAMS={config['streams']}",
+            f"export STAGE_COMPRESS='{f'({pattern})$' if pattern else ''}'",
+            f"export STAGE_MIN_BYTES={int(config['compress_min_mb'] * 1024**2)}",
+            "STAGE_BYTES=0",
+            "STAGE_NS=0",
+            "stage_one() {",
+            "    if [ \"$3\" = 1 ] && [ -n \"$STAGE_COMPRESS\" ] && [[ \"$1\" =~ $STAGE_COMPRESS ]] \\",
+            "            && [ $(stat -c %s \"$1\") -ge $STAGE_MIN_BYTES ] && command -v zstd > /dev/null; then",
+            "        zstd -q -f -T0 \"$1\" -o \"$2/$(basename \"$1\").zst\"",
+            "    else",
+            "        cp -r \"$1\" \"$2\"",
+            "    fi",
+            "}",
+            "export -f stage_one",
+            "stage() {",
+            "    local optional=0 compress=0 start=$(date +%s%N) files=() f",
+            "    while [[ \"$1\" == -* ]]; do [ \"$1\" = -o ] && optional=1; [ \"$1\" = -z ] && compress=1; shift; done",
+            "    local dest=$1; shift",
+            "    for f in \"$@\"; do",
+            "        if [ -e \"$f\" ]; then files+=(\"$f\"); elif [ $optional = 0 ]; then echo \"stage: $f does not exist\" >&2; return 1; fi",
+            "    done",
+            "    [ ${#files[@]} -gt 0 ] || return 0",
+            "    STAGE_BYTES=$((STAGE_BYTES + $(du -cbs \"${files[@]}\" | tail -n 1 | cut -f 1)))",
+            "    printf '%s\\0' \"${files[@]}\" | xargs -0 -P $STAGE_STREAMS -I{} bash -c 'stage_one \"$@\"' _ {} \"$dest\" $compress",
+            "    STAGE_NS=$((STAGE_NS + $(date +%s%N) - start))",
+            "}",
+            "stage_dir() {",
+            "    local compress=0 start=$(date +%s%N)",
+            "    [ \"$1\" = -z ] && { compress=1; shift; }",
+            "    local src=$1 dest=$(realpath -m \"$2\")",
+            "    STAGE_BYTES=$((STAGE_BYTES + $(du -cbs \"$src\" | tail -n 1 | cut -f 1)))",
+            "    if [[ \"$src\" == *.tar.zst ]]; then",
+            "        mkdir -p \"$dest\" && zstd -q -dc \"$src\" | tar -C \"$dest\" -xf -",
+            "        STAGED=$dest",
+            "    elif [ $compress = 1 ] && command -v zstd > /dev/null; then",
+            "        mkdir -p \"$(dirname \"$dest\")\" && tar -C \"$src\" -cf - . | zstd -q -T0 > \"$dest.tar.zst\"",
+            "        STAGED=$dest.tar.zst",
+            "    else",
+            "        mkdir -p \"$dest\" && (cd \"$src\" && find . -type f -print0 | xargs -0 -P $STAGE_STREAMS -I{} cp --parents {} \"$dest\")",
+            "        STAGED=$dest",
+            "    fi",
+            "    STAGE_NS=$((STAGE_NS + $(date +%s%N) - start))",
+            "}",
+            ""]
+
+
+def staging_report(cluster):
+    """Report the bytes and seconds spent staging at the end of the job"""
+    if not parallel_staging(cluster):
+        return []
+    return ["echo \"Staging: $STAGE_BYTES bytes in $((STAGE_NS / 1000000)) ms\"",
+            ""]
+
+
+def stage_files(cluster, files, destination, optional=False, compress=False):
+    """
+    Copy files to a directory
+    :param files: list of file names (or shell globs)
+    :param destination: directory
+    :param optional: ignore files that do not exist
+    :param compress: compress large files as configured for the cluster
+    :return: list of lines
+    """
+    if not parallel_staging(cluster):
+        return [f"cp {f} {destination}" + (" || true" if optional else "") for f in files]
+    flags = ("-o " if optional else "") + ("-z " if compress else "")
+    return [f"stage {flags}{destination} {' '.join(files)}"]
+
+
+def orbstore_functions(cluster):
+    """
+    Shell functions for the content-addressed orbital store (see orbstore.py). Empty if the
+    cluster does not use one.
+      store_dir SRC              add the files of directory SRC to the store. STORED is set to the manifest
+      restore_dir [-c] SRC DEST  recreate a stored directory from its manifest SRC by hard-linking the
+                                 read-only objects, or with -c as writable copies. Plain directories are copied
+    """
+    store = vars[cluster].get("orbstore")
+    if not store:
+        return []
+    fallback = "stage_dir \"$1\" \"$2\"" if parallel_staging(cluster) else "cp -r \"$1\" \"$2\""
+    return [f"ORBSTORE={store}",
+            "store_dir() {",
+            "    local hash f obj",
+            "    local manifest=$ORBSTORE/manifests/.new.$$",
+            "    mkdir -p $ORBSTORE/manifests",
+            "    (cd \"$1\" && find . -type f -print0 | LC_ALL=C sort -z | xargs -0 -r sha256sum) > \"$manifest\"",
+            "    while read -r hash f; do",
+            "        obj=$ORBSTORE/objects/${hash:0:2}/$hash",
+            "        if [ ! -e \"$obj\" ]; then",
+            "            mkdir -p \"${obj%/*}\"",
+            "            ln \"$1/$f\" \"$obj.$$\" 2> /dev/null || cp \"$1/$f\" \"$obj.$$\"",
+            "            chmod a-w \"$obj.$$\" && mv -f \"$obj.$$\" \"$obj\"",
+            "        fi",
+            "    done < \"$manifest\"",
+            "    hash=$(sha256sum < \"$manifest\" | cut -c 1-64)",
+            "    chmod a+r \"$manifest\" && mv -f \"$manifest\" $ORBSTORE/manifests/$hash",
+            "    STORED=$ORBSTORE/manifests/$hash",
+            "}",
+            "restore_dir() {",
+            "    local copy=0 hash f obj",
+            "    [ \"$1\" = -c ] && { copy=1; shift; }",
+            f"    [[ \"$1\" == */manifests/* ]] || {{ {fallback}; return; }}",
+            "    touch \"$1\" 2> /dev/null || true",
+            "    while read -r hash f; do",
+            "        obj=${1%/manifests/*}/objects/${hash:0:2}/$hash",
+            "        mkdir -p \"$(dirname \"$2/$f\")\"",
+            "        if [ $copy = 1 ] || ! ln \"$obj\" \"$2/$f\" 2> /dev/null; then",
+            "            cp --reflink=auto \"$obj\" \"$2/$f\" && chmod u+w \"$2/$f\"",
+            "        fi",
+            "    done < \"$1\"",
+            "}",
+            ""]
+
+
+def telemetry_config(cluster):
+    if "telemetry" not in vars[cluster]:
+        return None
+    return dict(TELEMETRY_DEFAULTS, **vars[cluster]["telemetry"])
+
+
+def telemetry_start(cluster):
+    """Start the clock of the job, before the modules are loaded"""
+    if telemetry_config(cluster) is None:
+        return []
+    return ["TELEMETRY_T0=$(date +%s%N)",
+            ""]
+
+
+def telemetry_functions(cluster, outputfile):
+    """
+    Shell functions recording the telemetry of the job. Empty if the cluster does not collect any.
+      telemetry_phase NAME   end the current phase and start NAME
+    A background process samples the memory and CPU usage of the node, and the JSON sidecar is
+    written when the script exits, also if it fails.
+    """
+    config = telemetry_config(cluster)
+    if config is None:
+        return []
+    return [f"TELEMETRY_FILE=${{SLURM_SUBMIT_DIR}}/{outputfile}.telemetry.json",
+            f"TELEMETRY_INTERVAL={config['interval']}",
+            "TELEMETRY_SAMPLES=$(mktemp)",
+            "TELEMETRY_PHASE=module_load",
+            "TELEMETRY_START=$TELEMETRY_T0",
+            "TELEMETRY_PHASES=",
+            "telemetry_phase() {",
+            "    local now=$(date +%s%N)",
+            "    TELEMETRY_PHASES+=\"${TELEMETRY_PHASES:+, }\\\"$TELEMETRY_PHASE\\\": $(((now - TELEMETRY_START) / 1000000))\"",
+            "    TELEMETRY_PHASE=$1",
+            "    TELEMETRY_START=$now",
+            "}",
+            "telemetry_sample() {",
+            "    local busy total last_busy=0 last_total=0 mem",
+            "    while :; do",
+            "        read -r busy total <<< \"$(awk '/^cpu / {print $2+$3+$4+$7+$8+$9, $2+$3+$4+$5+$6+$7+$8+$9; exit}' /proc/stat)\"",
+            "        mem=$(awk '/^MemTotal:/ {t = $2} /^MemAvailable:/ {a = $2} END {print int((t - a) / 1024)}' /proc/meminfo)",
+            "        if [ $last_total -gt 0 ] && [ $total -gt $last_total ]; then",
+            "            echo \"$((($(date +%s%N) - TELEMETRY_T0) / 1000000)) $mem $((100 * (busy - last_busy) / (total - last_total)))\" >> $TELEMETRY_SAMPLES",
+            "        fi",
+            "        last_busy=$busy last_total=$total",
+            "        sleep $TELEMETRY_INTERVAL",
+            "    done",
+            "}",
+            "telemetry_finish() {",
+            "    local status=$?",
+            "    pkill -P $TELEMETRY_SAMPLER 2> /dev/null || true",
+            "    kill $TELEMETRY_SAMPLER 2> /dev/null || true",
+            "    telemetry_phase end",
+            "    awk -v job=\"${SLURM_JOB_ID:-}\" -v host=\"$(hostname)\" -v status=$status \\",
+            "        -v wall=$((($(date +%s%N) - TELEMETRY_T0) / 1000000)) -v cpus=${SLURM_CPUS_ON_NODE:-0} \\",
+            "        -v mem=${SLURM_MEM_PER_NODE:-$((${SLURM_MEM_PER_CPU:-0} * ${SLURM_CPUS_ON_NODE:-0}))} \\",
+            "        -v staged=${STAGE_BYTES:-0} -v staging=$((${STAGE_NS:-0} / 1000000)) -v interval=$TELEMETRY_INTERVAL \\",
+            "        -v phases=\"$TELEMETRY_PHASES\" '",
+            "        {samples = samples (NR > 1 ? \", \" : \"\") \"[\" $1 / 1000 \", \" $2 \", \" $3 \"]\"; if ($2 > peak) peak = $2; cpu += $3}",
+            "        END {printf \"{\\\"job\\\": \\\"%s\\\", \\\"host\\\": \\\"%s\\\", \\\"exit_status\\\": %d, \\\"wall_ms\\\": %.0f, \", job, host, status, wall",
+            "             printf \"\\\"allocated\\\": {\\\"cpus\\\": %d, \\\"mem_mb\\\": %.0f}, \\\"phases_ms\\\": {%s}, \", cpus, mem, phases",
+            "             printf \"\\\"staged_bytes\\\": %.0f, \\\"staging_ms\\\": %.0f, \\\"interval\\\": %d, \", staged, staging, interval",
+            "             printf \"\\\"peak_memory_mb\\\": %d, \\\"mean_cpu_percent\\\": %.1f, \\\"samples\\\": [%s]}\\n\", peak, NR ? cpu / NR : 0, samples}' \\",
+            "        $TELEMETRY_SAMPLES > $TELEMETRY_FILE",
+            "    rm -f $TELEMETRY_SAMPLES",
+            "}",
+            "telemetry_sample 2> /dev/null &",
+            "TELEMETRY_SAMPLER=$!",
+            "disown",
+            "trap telemetry_finish EXIT",
+            ""]
+
+
+def telemetry_phase(cluster, name):
+    return [f"telemetry_phase {name}"] if telemetry_config(cluster) is not None else []
+
+
+def resubmit_functions(cluster, copy_back, resubmit):
+    """
+    Shell function run when SLURM signals that the time limit is near (--signal=B:USR1). It stops the
+    calculation, copies back its files, and resubmits the job, at most resubmit times in a row. The
+    resubmitted job is the script SLURM runs ($0), and SLURMIFY_RESUBMIT counts the resubmissions.
+    Empty if the job is not resubmitted.
+    :param copy_back: lines copying back the results of the job, run from $SCRATCH
+    :param resubmit: maximum number of resubmissions
+    :return: list of lines
+    """
+    if not resubmit:
+        return []
+    return ["RESUBMIT=${SLURMIFY_RESUBMIT:-0}",
+            "COMPUTE=",
+            "checkpoint() {",
+            "    echo \"Time limit is near: stopping the calculation and copying back its files\"",
+            "    if [ -n \"$COMPUTE\" ]; then",
+            "        pkill -P $COMPUTE 2> /dev/null || true",
+            "        kill $COMPUTE 2> /dev/null || true",
+            "        wait $COMPUTE 2> /dev/null || true",
+            "    fi"] + \
+           [f"    {line}" for line in telemetry_phase(cluster, "checkpoint") + copy_back if line] + \
+           [f"    if [ $RESUBMIT -lt {resubmit} ]; then",
+            "        cd $SLURM_SUBMIT_DIR",
+            "        sbatch --export=ALL,SLURMIFY_RESUBMIT=$((RESUBMIT + 1)) $0",
+            "    else",
+            f"        echo \"Not resubmitting: the job was already resubmitted {resubmit} times\"",
+            "    fi",
+            "    exit 1",
+            "}",
+            "trap checkpoint USR1",
+            ""]
+
+
+def restart_staging(resubmit, lines):
+    """Stage the files copied back by the previous run (see resubmit_functions) if the job was resubmitted"""
+    if not resubmit:
+        return []
+    return ["if [ $RESUBMIT -gt 0 ]; then"] + [f"    {line}" for line in lines] + ["fi"]
+
+
+def compute_command(command, resubmit):
+    """Run the program in the background if the job traps the time limit signal, as bash only handles signals between commands"""
+    if not resubmit:
+        return [command]
+    return [f"{command} &",
+            "COMPUTE=$!",
+            "wait $COMPUTE"]
+
+
+def restore_orbitals(cluster, path, target):
+    """
+    Copy stored MRChem orbitals to $SCRATCH/target, from a directory, archive, or orbital store manifest
+    :param target: "initial_guess" or "checkpoint"
+    :return: list of lines
+    """
+    if vars[cluster].get("orbstore"):
+        # MRChem overwrites the checkpoint files, so these must not be linked to the store
+        return [f"restore_dir {'-c ' if target == 'checkpoint' else ''}{path} $SCRATCH/{target}"]
+    if parallel_staging(cluster):
+        return [f"stage_dir {path} $SCRATCH/{target}"]
+    return [f"cp -r {path} $SCRATCH/{target}"]
+
+
+def orca_environment(cluster):
+    return ["",
+            f"ORCA={vars[cluster]['path_orca']}",
+            f"MPI={vars[cluster]['path_mpi']}",
+            "",
+            "export PATH=$PATH:$ORCA",
+            f"export PATH=$PATH:{'$MPI'}",
+            "export LD_LIBRARY_PATH=$LD_LIBRARY_PATH:$ORCA",
+            f"export LD_LIBRARY_PATH=$LD_LIBRARY_PATH:{'$MPI'}",
+            "export RSH_COMMAND=\"/usr/bin/ssh -x\""]
+
+
+def orca_command(inputfile, outputfile, extension_inputfile, extension_outputfile):
+    return f"time $ORCA/orca {inputfile+extension_inputfile} > {outputfile+extension_outputfile}"
+
+
+def orca_copy_back(cluster, inputfile, ccomp=False):
+    lines = stage_files(cluster, [inputfile + ext for ext in [".hess", ".xyz", ".gbw", ".trj", ".out"]],
+                        "$SLURM_SUBMIT_DIR", optional=True, compress=True)
+    if ccomp:
+        lines += stage_files(cluster, ["*.hess"], "$SLURM_SUBMIT_DIR", optional=True, compress=True)
+    return lines
+
+
+def gaussian_command(inputfile, outputfile, extension_inputfile, extension_outputfile):
+    return f"time g16.ib {inputfile+extension_inputfile} > {outputfile+extension_outputfile}"
+
+
+def gaussian_copy_back(cluster, inputfile):
+    if not parallel_staging(cluster):
+        return [f"cp {inputfile + ext} $SLURM_SUBMIT_DIR" for ext in [".out", ".chk"]]
+    return stage_files(cluster, [inputfile + ext for ext in [".out", ".chk"]], "$SLURM_SUBMIT_DIR", compress=True)
+
+
+def mrchem_command(cluster, inputfile, slurm_ntasks_per_node, slurm_submit_cmd):
+    if cluster == 'betzy':
+        return f"{vars[cluster]['mrchem_path']} --launcher='{slurm_submit_cmd if slurm_submit_cmd is not None else 'mpirun -map-by ppr:1:numa -bind-to numa'}' {inputfile}"
+    return f"{vars[cluster]['mrchem_path']} --launcher='{slurm_submit_cmd} -{'n' if slurm_submit_cmd == 'srun' else 'np'} {slurm_ntasks_per_node}' {inputfile}"
+
+
+def mrchem_copy_back(cluster, inputfile, extension_outputfile):
+    if cluster == "stallo":
+        lines = [f"cp {inputfile+extension_outputfile} ${{SLURM_SUBMIT_DIR}}/",
+                 f"cp {inputfile}.json ${{SLURM_SUBMIT_DIR}}/"]
+    else:
+        lines = [f"savefile {inputfile+extension_outputfile}",
+                 f"savefile {inputfile}.json"]
+    lines.append("")
+    if vars[cluster].get("orbstore"):
+        lines.append("store_dir orbitals")
+        lines.append(f"echo $STORED > ${{SLURM_SUBMIT_DIR}}/{inputfile}.orbitals")
+        lines.append("")
+        lines.append("store_dir checkpoint")
+        lines.append(f"echo $STORED > ${{SLURM_SUBMIT_DIR}}/{inputfile}.checkpoint")
+        lines.append("")
+        lines += staging_report(cluster)
+        return lines[:-1]
+    if not parallel_staging(cluster):
+        lines.append(f"mkdir -p {vars[cluster]['orbdir']}")
+        lines.append(f"cp orbitals/* {vars[cluster]['orbdir']}/")
+        lines.append(f"echo {vars[cluster]['orbdir']} > ${{SLURM_SUBMIT_DIR}}/{inputfile}.orbitals")
+        lines.append("")
+        lines.append(f"mkdir -p {vars[cluster]['checkdir']}")
+        lines.append(f"cp checkpoint/* {vars[cluster]['checkdir']}/")
+        lines.append(f"echo {vars[cluster]['checkdir']} > ${{SLURM_SUBMIT_DIR}}/{inputfile}.checkpoint")
+        return lines
+
+    # STAGED is the archive instead of the directory if the orbitals are compressed
+    flag = "-z " if staging_config(cluster)["compress_orbitals"] else ""
+    lines.append(f"stage_dir {flag}orbitals {vars[cluster]['orbdir']}")
+    lines.append(f"echo $STAGED > ${{SLURM_SUBMIT_DIR}}/{inputfile}.orbitals")
+    lines.append("")
+    lines.append(f"stage_dir {flag}checkpoint {vars[cluster]['checkdir']}")
+    lines.append(f"echo $STAGED > ${{SLURM_SUBMIT_DIR}}/{inputfile}.checkpoint")
+    lines.append("")
+    lines += staging_report(cluster)
+    return lines[:-1]
+
+
+#########################################################
+# Job script templates
+#########################################################
+# Most of a job script only depends on the program, the
+# cluster, and a handful of switches. For each combination
+# the script is assembled once with placeholders for the
+# per-job values, and later jobs only fill these in.
+#########################################################
+_TEMPLATES = {}
+_PLACEHOLDER = re.compile("\x00(\\w+)\x00")
+
+
+def placeholders(names):
+    return {name: f"\x00{name}\x00" for name in names}
+
+
+def clear_templates():
+    """Forget all compiled templates, e.g. after changing 'vars'"""
+    _TEMPLATES.clear()
+
+
+def _compile_template(lines, names):
+    """
+    Compile a job script with placeholders into a function that takes the per-job fields as
+    keyword arguments and returns the list of lines. Each line becomes an f-string (or a
+    constant), so rendering a job costs about as much as the original f-string appends.
+    """
+    items = []
+    for line in lines:
+        # Split into literal text (even indices) and field names (odd indices)
+        parts = _PLACEHOLDER.split(line)
+        if len(parts) == 1:
+            items.append(repr(line))
+            continue
+        text = "".join(part.replace("{", "{{").replace("}", "}}") if i % 2 == 0 else f"{{{part}}}"
+                       for i, part in enumerate(parts))
+        items.append("f" + repr(text))
+    namespace = {}
+    exec(f"def render({', '.join(names)}):\n    return [{', '.join(items)}]", namespace)
+    return namespace["render"]
+
+
+def render_template(assemble, structure, names, values):
+    """
+    Render a job script from the template cache, compiling the template first if needed.
+    :param assemble: function returning the job script as a list of lines, given the structure and the fields
+    :param structure: dict of arguments to assemble that decide the layout of the script
+    :param names: names of the per-job fields that are filled into the template
+    :param values: values of the per-job fields, in the order of names
+    :return: job file as a list of lines
+    """
+    key = (assemble,) + tuple(structure.values())
+    template = _TEMPLATES.get(key)
+    if template is None:
+        template = _compile_template(assemble(**structure, **placeholders(names)), names)
+        _TEMPLATES[key] = template
+    return template(*values)
+
+
+def timestamp():
+    return f"# File generated {datetime.datetime.now()}"
+
+
+# Per-job fields of the templates, in the order in which the job functions pass them
+_COMMON_FIELDS = ("timestamp", "rule", "inputfile", "outputfile", "identifier", "slurm_account", "slurm_nodes",
+                  "slurm_ntasks_per_node", "slurm_time", "slurm_memory", "slurm_mail", "slurm_partition")
+_MRCHEM_FIELDS = _COMMON_FIELDS + ("slurm_cpus_per_task", "slurm_mem_per_cpu", "orbitals")
+
+
+def _orca_lines(cluster=None, loc=None, is_dev=None, ccomp=None, extension_inputfile=None, extension_outputfile=None,
+                naux=0, resubmit=None, signal_lead=None, timestamp=None, rule=None, inputfile=None, outputfile=None, identifier=None, slurm_account=None,
+                slurm_nodes=None, slurm_ntasks_per_node=None, slurm_time=None, slurm_memory=None, slurm_mail=None,
+                slurm_partition=None, **auxfiles):
+    jobfile = timestamp_header(timestamp, rule)
+    jobfile += sbatch_directives(slurm_account=slurm_account, identifier=identifier, outputfile=outputfile, loc=loc,
+                                 slurm_nodes=slurm_nodes, slurm_ntasks_per_node=slurm_ntasks_per_node,
+                                 slurm_time=slurm_time, slurm_memory=slurm_memory if cluster != "fram" else None,
+                                 slurm_mail=slurm_mail, is_dev=is_dev, slurm_partition=slurm_partition,
+                                 slurm_signal=signal_lead if resubmit else None)
+    jobfile += telemetry_start(cluster)
     jobfile.append("module purge")
     jobfile.append(f"module load {vars[cluster]['mpi_version']}")
     jobfile.append("")
     jobfile.append("set -o errexit")
     jobfile.append("set -o nounset")
     jobfile.append("")
+    jobfile += scratch_setup(cluster, mkdir="mkdir")
+    jobfile += staging_functions(cluster)
+    jobfile += telemetry_functions(cluster, outputfile)
+    jobfile += resubmit_functions(cluster, orca_copy_back(cluster, inputfile, ccomp=ccomp), resubmit)
 
-    if cluster == "stallo":
-        jobfile.append(f"SCRATCH={vars[cluster]['scratch']}")
-        jobfile.append("mkdir $SCRATCH")
-        jobfile.append("")
-
-    # Copy files to SCRATCH
-    jobfile.append(f"cp {inputfile+extension_inputfile} $SCRATCH")
-
-    if chess:
-        hessfile = get_orca_hessfile(inputfile+extension_inputfile)
-        if not os.path.isfile(hessfile):
-            sys.exit("Error! The .hess file specified does not exist.")
-        jobfile.append(f"cp {hessfile} $SCRATCH")
-    if cxyz:
-        xyzfile = get_orca_xyzfile(inputfile+extension_inputfile)
-        if not os.path.isfile(xyzfile):
-            sys.exit("Error! The .xyz file specified does not exist.")
-        jobfile.append(f"cp {xyzfile} $SCRATCH")
-    if ccomp:
-        compfile = get_orca_compfile(inputfile+extension_inputfile)
-        if not os.path.isfile(compfile):
-            sys.exit("Error! The .cmp file specified does not exist.")
-        jobfile.append(f"cp {compfile} $SCRATCH")
-    if cgbw:
-        gbwfile = get_orca_gbwfile(cgbw)
-        if not os.path.isfile(gbwfile):
-            sys.exit("Error! The .bgw file specified does not exist.")
-        jobfile.append(f"cp {gbwfile} $SCRATCH")
+    # Copy files to SCRATCH. ORCA starts from the .gbw file of a previous run of the job
+    jobfile += telemetry_phase(cluster, "stage_in")
+    jobfile += stage_files(cluster, [inputfile+extension_inputfile] + [auxfiles[f'aux{i}'] for i in range(naux)],
+                           "$SCRATCH")
+    jobfile += restart_staging(resubmit, stage_files(cluster, [inputfile+".gbw"], "$SCRATCH", optional=True))
 
     # Export variables
-    jobfile.append("")
-    jobfile.append(f"ORCA={vars[cluster]['path_orca']}")
-    jobfile.append(f"MPI={vars[cluster]['path_mpi']}")
-    jobfile.append("")
-
-    jobfile.append("export PATH=$PATH:$ORCA")
-    jobfile.append(f"export PATH=$PATH:{'$MPI'}")
-    jobfile.append("export LD_LIBRARY_PATH=$LD_LIBRARY_PATH:$ORCA")
-    jobfile.append(f"export LD_LIBRARY_PATH=$LD_LIBRARY_PATH:{'$MPI'}")
-    jobfile.append("export RSH_COMMAND=\"/usr/bin/ssh -x\"")
+    jobfile += orca_environment(cluster)
 
     # Execute ORCA
     jobfile.append("")
     jobfile.append("cd $SCRATCH")
-    jobfile.append(f"time $ORCA/orca {inputfile+extension_inputfile} > {outputfile+extension_outputfile}")
+    jobfile += telemetry_phase(cluster, "compute")
+    jobfile += compute_command(orca_command(inputfile, outputfile, extension_inputfile, extension_outputfile), resubmit)
     jobfile.append("")
 
     # Copy back files
-    for ext in [".hess", ".xyz", ".gbw", ".trj", ".out"]:
-        jobfile.append(f"cp {inputfile + ext} $SLURM_SUBMIT_DIR || true")
-    if ccomp:
-        jobfile.append("cp *.hess $SLURM_SUBMIT_DIR || true")
-
+    jobfile += telemetry_phase(cluster, "copy_back")
+    jobfile += orca_copy_back(cluster, inputfile, ccomp=ccomp)
     jobfile.append("")
+    jobfile += staging_report(cluster)
 
     # Clean up (On Fram and Saga clean up is automatic)
-    if cluster == "stallo":
-        jobfile.append("rm $SCRATCH/*")
-        jobfile.append("rmdir $SCRATCH")
+    jobfile += telemetry_phase(cluster, "cleanup")
+    jobfile += scratch_cleanup(cluster)
 
     jobfile.append("")
     jobfile.append("exit 0")
-
     return jobfile
 
 
-def gaussian_job(inputfile=None, outputfile=None, is_dev=None, slurm_account=None, slurm_nodes=None,
-                 cluster=None, slurm_ntasks_per_node=None, slurm_memory=None, slurm_time=None, slurm_partition=None,
-                 slurm_mail=None, extension_outputfile=None, extension_inputfile=None, cchk=False, loc=None,
-                 identifier=None):
-
-    assert slurm_memory.endswith("B"), "You must specify units of memory allocation (number must end with 'B')"
+def orca_job(inputfile=None, outputfile=None, is_dev=None, slurm_account=None, slurm_nodes=None,
+             cluster=None, slurm_ntasks_per_node=None, slurm_memory=None, slurm_time=None, slurm_partition=None,
+             slurm_mail=None, extension_outputfile=None, extension_inputfile=None, chess=False, cxyz=False, ccomp=False,
+             cgbw=None, loc=None, identifier=None, manifest=None, produced=(), resubmit=None, signal_lead=600):
+    """
 
-    timestamp = f"# File generated {datetime.datetime.now()}"
+    :param inputfile: name of input file without extension
+    :param outputfile: name of output file without extension
+    :param is_dev: prepare for development queue
+    :param slurm_account: slurm account number to be charged
+    :param slurm_nodes: number of nodes
+    :param cluster: for which cluster will the job be made
+    :param slurm_ntasks_per_node: number of tasks per node
+    :param slurm_memory: total memory per node
+    :param slurm_time: time limit for job
+    :param slurm_mail: mail notification type
+    :param extension_outputfile: extension used for output file
+    :param extension_inputfile: extension used for input file
+    :param chess: copy .hess file to scratch
+    :param cxyz: copy .xyz file to scratch
+    :param ccomp: copy .cmp file to scratch
+    :param cgbw: copy .bgw file to scratch
+    :param loc: non-exclusive, use --ntasks instead of --ntasks-per-node
+    :param identifier: how job name is presented in the queue. Does not affect name of input file
+    :param manifest: manifest of the input file from scan_input. The input file is scanned if needed and not given
+    :param produced: auxiliary files that are written by jobs running before this one (see workflow.py),
+                     and therefore need not exist yet
+    :param resubmit: copy back the results and resubmit the job near the time limit, at most this many times
+    :param signal_lead: seconds before the time limit at which the job is resubmitted
+    :return:
+    """
 
-    jobfile = []
-    jobfile.append("#! /bin/bash")
-    jobfile.append("")
-    jobfile.append(f"#{'-'*len(timestamp)}")
-    jobfile.append(timestamp)
-    jobfile.append(f"#{'-'*len(timestamp)}")
-    jobfile.append("")
-    jobfile.append(f"#SBATCH --account={slurm_account}")
-    jobfile.append(f"#SBATCH --job-name={identifier}")
-    jobfile.append(f"#SBATCH --output={outputfile+'.log'}")
-    jobfile.append(f"#SBATCH --error={outputfile+'.err'}")
-    if loc:
-        jobfile.append(f"#SBATCH --nodes={slurm_nodes}")
-        jobfile.append(f"#SBATCH --ntasks-per-node={slurm_ntasks_per_node}")
-    else:
-        jobfile.append(f'#SBATCH --ntasks={slurm_ntasks_per_node}')
-    jobfile.append(f"#SBATCH --time={slurm_time}")
-    if cluster != "fram":
-        jobfile.append(f"#SBATCH --mem={slurm_memory}")
-    jobfile.append(f"#SBATCH --mail-type={slurm_mail}")
-    if is_dev: 
-        jobfile.append("#SBATCH --qos=devel")
-    else:
-        jobfile.append(f"#SBATCH --partition={slurm_partition}")
-    jobfile.append("")
+    check_memory(slurm_memory)
+
+    if manifest is None and any([chess, cxyz, ccomp, cgbw]):
+        try:
+            with phase("scan"):
+                manifest = scan_input(inputfile+extension_inputfile)
+        except FileNotFoundError:
+            raise MissingFileError(f"Error! The input file ({inputfile+extension_inputfile}) was not found")
+
+    # Files to copy to SCRATCH
+    auxfiles = []
+    with phase("aux"):
+        if chess:
+            hessfile = get_orca_hessfile(inputfile+extension_inputfile, manifest)
+            if not os.path.isfile(hessfile) and hessfile not in produced:
+                raise MissingFileError("Error! The .hess file specified does not exist.")
+            auxfiles.append(hessfile)
+        if cxyz:
+            xyzfile = get_orca_xyzfile(inputfile+extension_inputfile, manifest)
+            if not os.path.isfile(xyzfile) and xyzfile not in produced:
+                raise MissingFileError("Error! The .xyz file specified does not exist.")
+            auxfiles.append(xyzfile)
+        if ccomp:
+            compfile = get_orca_compfile(inputfile+extension_inputfile, manifest)
+            if not os.path.isfile(compfile) and compfile not in produced:
+                raise MissingFileError("Error! The .cmp file specified does not exist.")
+            auxfiles.append(compfile)
+        if cgbw:
+            gbwfile = get_orca_gbwfile(inputfile+extension_inputfile, manifest)
+            if not os.path.isfile(gbwfile) and gbwfile not in produced:
+                raise MissingFileError("Error! The .bgw file specified does not exist.")
+            auxfiles.append(gbwfile)
+
+    structure = dict(cluster=cluster, loc=bool(loc), is_dev=bool(is_dev), ccomp=bool(ccomp), naux=len(auxfiles),
+                     resubmit=resubmit or None, signal_lead=signal_lead if resubmit else None,
+                     extension_inputfile=extension_inputfile, extension_outputfile=extension_outputfile)
+    names = _COMMON_FIELDS + tuple(f"aux{i}" for i in range(len(auxfiles))) if auxfiles else _COMMON_FIELDS
+    stamp = timestamp()
+    return render_template(_orca_lines, structure, names,
+                           (stamp, '-'*len(stamp), inputfile, outputfile, identifier, slurm_account, slurm_nodes,
+                            slurm_ntasks_per_node, slurm_time, slurm_memory, slurm_mail, slurm_partition, *auxfiles))
+
+
+def _gaussian_lines(cluster=None, loc=None, is_dev=None, cchk=None, extension_inputfile=None, extension_outputfile=None,
+                    resubmit=None, signal_lead=None, timestamp=None, rule=None, inputfile=None, outputfile=None, identifier=None, slurm_account=None,
+                    slurm_nodes=None, slurm_ntasks_per_node=None, slurm_time=None, slurm_memory=None, slurm_mail=None,
+                    slurm_partition=None):
+    jobfile = timestamp_header(timestamp, rule)
+    jobfile += sbatch_directives(slurm_account=slurm_account, identifier=identifier, outputfile=outputfile, loc=loc,
+                                 slurm_nodes=slurm_nodes, slurm_ntasks_per_node=slurm_ntasks_per_node,
+                                 slurm_time=slurm_time, slurm_memory=slurm_memory if cluster != "fram" else None,
+                                 slurm_mail=slurm_mail, is_dev=is_dev, slurm_partition=slurm_partition,
+                                 slurm_signal=signal_lead if resubmit else None)
+    jobfile += telemetry_start(cluster)
     jobfile.append("module purge")
     jobfile.append(f"module load {vars[cluster]['gaussian_version']}")
     jobfile.append("")
@@ -382,19 +1002,16 @@ def gaussian_job(inputfile=None, outputfile=None, is_dev=None, slurm_account=Non
         jobfile.append("export GAUSS_LFLAGS2='--LindaOptions -s 20000000'")
         jobfile.append("")
 
-    if cluster == "stallo":
-        jobfile.append(f"SCRATCH={vars[cluster]['scratch']}")
-        jobfile.append(f"mkdir -p $SCRATCH")
-        jobfile.append("")
-
-    # Copy files to SCRATCH
-    jobfile.append(f"cp {inputfile+extension_inputfile} $SCRATCH")
+    jobfile += scratch_setup(cluster)
+    jobfile += staging_functions(cluster)
+    jobfile += telemetry_functions(cluster, outputfile)
+    jobfile += resubmit_functions(cluster, gaussian_copy_back(cluster, inputfile), resubmit)
 
-    if cchk:
-        if os.path.isfile(inputfile+'.chk'):
-            jobfile.append(f"cp {inputfile+'.chk'} $SCRATCH")
-        else:
-            print(f"Warning: Copy of .chk file requested, but the file does not exist ({inputfile+'.chk'}). Continuing without copying file.")
+    # Copy files to SCRATCH, and the .chk file of a previous run of the job
+    jobfile += telemetry_phase(cluster, "stage_in")
+    jobfile += stage_files(cluster, [inputfile+extension_inputfile] + ([inputfile+'.chk'] if cchk else []), "$SCRATCH")
+    if not cchk:
+        jobfile += restart_staging(resubmit, stage_files(cluster, [inputfile+'.chk'], "$SCRATCH", optional=True))
 
     # Execute Gaussian
     jobfile.append("")
@@ -408,122 +1025,217 @@ def gaussian_job(inputfile=None, outputfile=None, is_dev=None, slurm_account=Non
             jobfile.append(f"mv {inputfile+'.com'} {inputfile+extension_inputfile}")
         jobfile.append("")
 
-    jobfile.append(f"time g16.ib {inputfile+extension_inputfile} > {outputfile+extension_outputfile}")
+    jobfile += telemetry_phase(cluster, "compute")
+    jobfile += compute_command(gaussian_command(inputfile, outputfile, extension_inputfile, extension_outputfile), resubmit)
     jobfile.append("")
 
     # Copy back files
-    for ext in [".out", ".chk"]:
-        jobfile.append(f"cp {inputfile + ext} $SLURM_SUBMIT_DIR")
-
+    jobfile += telemetry_phase(cluster, "copy_back")
+    jobfile += gaussian_copy_back(cluster, inputfile)
     jobfile.append("")
+    jobfile += staging_report(cluster)
 
     # Clean up (On Fram and Saga clean up is automatic)
     if cluster == "stallo":
-        jobfile.append(f"rm $SCRATCH/*")
-        jobfile.append(f"rmdir $SCRATCH")
+        jobfile += telemetry_phase(cluster, "cleanup")
+        jobfile += scratch_cleanup(cluster)
         jobfile.append("")
 
     jobfile.append("exit 0")
-
     return jobfile
 
 
-def mrchem_job(inputfile=None, outputfile=None, is_dev=None, slurm_account=None, slurm_nodes=None, slurm_partition=None,
-               cluster=None, slurm_ntasks_per_node=None, slurm_cpus_per_task=None, slurm_memory=None,
-               slurm_mem_per_cpu=None, slurm_time=None,
-               slurm_mail=None, extension_outputfile=None, extension_inputfile=None, initorb=None, initchk=None, loc=None,
-               identifier=None, slurm_submit_cmd="srun"):
-
-    if slurm_mem_per_cpu is not None:
-        assert slurm_mem_per_cpu.endswith("B"), "You must specify units of memory allocation (number must end with 'B')"
-    if slurm_memory is not None:
-        assert slurm_memory.endswith("B"), "You must specify units of memory allocation (number must end with 'B')"
-    assert cluster in ["saga", "fram", "betzy"], "!! Please update MRChem!!"
-
-    timestamp = f"# File generated {datetime.datetime.now()}"
-
-    jobfile = []
-    jobfile.append("#! /bin/bash")
-    jobfile.append("")
-    jobfile.append(f"#{'-' * len(timestamp)}")
-    jobfile.append(timestamp)
-    jobfile.append(f"#{'-' * len(timestamp)}")
-    jobfile.append("")
-    jobfile.append(f"#SBATCH --account={slurm_account}")
-    jobfile.append(f"#SBATCH --job-name={identifier}")
-    jobfile.append(f"#SBATCH --output={outputfile + '.log'}")
-    jobfile.append(f"#SBATCH --error={outputfile + '.err'}")
-    if loc:
-        jobfile.append(f"#SBATCH --nodes={slurm_nodes}")
-        jobfile.append(f"#SBATCH --ntasks-per-node={slurm_ntasks_per_node}")
-    else:
-        jobfile.append(f"#SBATCH --ntasks={slurm_ntasks_per_node}")
-    jobfile.append(f"#SBATCH --cpus-per-task={slurm_cpus_per_task}")
-    jobfile.append(f"#SBATCH --time={slurm_time}")
-
-    if slurm_mem_per_cpu is not None:
-        jobfile.append(f"#SBATCH --mem-per-cpu={slurm_mem_per_cpu}")
-    if slurm_memory is not None:
-        jobfile.append(f"#SBATCH --mem={slurm_memory}")
-
-    jobfile.append(f"#SBATCH --mail-type={slurm_mail}")
-    if is_dev: 
-        jobfile.append("#SBATCH --qos=devel")
-    else:
-        jobfile.append(f"#SBATCH --partition={slurm_partition}")
-    jobfile.append("")
+def gaussian_job(inputfile=None, outputfile=None, is_dev=None, slurm_account=None, slurm_nodes=None,
+                 cluster=None, slurm_ntasks_per_node=None, slurm_memory=None, slurm_time=None, slurm_partition=None,
+                 slurm_mail=None, extension_outputfile=None, extension_inputfile=None, cchk=False, loc=None,
+                 identifier=None, resubmit=None, signal_lead=600):
+
+    check_memory(slurm_memory)
+
+    with phase("aux"):
+        missing_chk = cchk and not os.path.isfile(inputfile+'.chk')
+    if missing_chk:
+        warnings.warn(f"Copy of .chk file requested, but the file does not exist ({inputfile+'.chk'}). Continuing without copying file.",
+                      SlurmifyWarning)
+        cchk = False
+
+    structure = dict(cluster=cluster, loc=bool(loc), is_dev=bool(is_dev), cchk=bool(cchk),
+                     resubmit=resubmit or None, signal_lead=signal_lead if resubmit else None,
+                     extension_inputfile=extension_inputfile, extension_outputfile=extension_outputfile)
+    stamp = timestamp()
+    return render_template(_gaussian_lines, structure, _COMMON_FIELDS,
+                           (stamp, '-'*len(stamp), inputfile, outputfile, identifier, slurm_account, slurm_nodes,
+                            slurm_ntasks_per_node, slurm_time, slurm_memory, slurm_mail, slurm_partition))
+
+
+def _mrchem_lines(cluster=None, loc=None, is_dev=None, has_memory=None, has_mem_per_cpu=None, initorb=None,
+                  initchk=None, slurm_submit_cmd=None, extension_inputfile=None, extension_outputfile=None,
+                  resubmit=None, signal_lead=None, timestamp=None, rule=None, inputfile=None, outputfile=None, identifier=None, slurm_account=None,
+                  slurm_nodes=None, slurm_ntasks_per_node=None, slurm_cpus_per_task=None, slurm_time=None,
+                  slurm_memory=None, slurm_mem_per_cpu=None, slurm_mail=None, slurm_partition=None, orbitals=None):
+    jobfile = timestamp_header(timestamp, rule)
+    jobfile += sbatch_directives(slurm_account=slurm_account, identifier=identifier, outputfile=outputfile, loc=loc,
+                                 slurm_nodes=slurm_nodes, slurm_ntasks_per_node=slurm_ntasks_per_node,
+                                 slurm_cpus_per_task=slurm_cpus_per_task, slurm_time=slurm_time,
+                                 slurm_mem_per_cpu=slurm_mem_per_cpu if has_mem_per_cpu else None,
+                                 slurm_memory=slurm_memory if has_memory else None,
+                                 slurm_mail=slurm_mail, is_dev=is_dev, slurm_partition=slurm_partition,
+                                 slurm_signal=signal_lead if resubmit else None)
+    jobfile += telemetry_start(cluster)
     jobfile.append(f"source {vars[cluster]['mrchem_environ']}")
     jobfile.append(f"export OMP_NUM_THREADS={slurm_cpus_per_task}")
     jobfile.append("")
     jobfile.append("set -o errexit")
     jobfile.append("set -o nounset")
     jobfile.append("")
-
-    if cluster == "stallo":
-        jobfile.append(f"SCRATCH={vars[cluster]['scratch']}")
-        jobfile.append(f"mkdir -p $SCRATCH")
-        jobfile.append("")
-
-    jobfile.append(f"cp {os.path.join(inputfile+extension_inputfile)} $SCRATCH")
-
-    if initorb is not None:
-        jobfile.append(f"cp -r {initorb} $SCRATCH/initial_guess")
-    elif initchk is not None:
-        jobfile.append(f"cp -r {initchk} $SCRATCH/checkpoint")
-
+    jobfile += scratch_setup(cluster)
+    jobfile += staging_functions(cluster)
+    jobfile += orbstore_functions(cluster)
+    jobfile += telemetry_functions(cluster, outputfile)
+    jobfile += resubmit_functions(cluster, mrchem_copy_back(cluster, inputfile, extension_outputfile), resubmit)
+
+    jobfile += telemetry_phase(cluster, "stage_in")
+    jobfile += stage_files(cluster, [inputfile+extension_inputfile], "$SCRATCH")
+
+    # MRChem overwrites the checkpoint files, so these must not be linked to the store
+    if vars[cluster].get("orbstore") and initorb:
+        jobfile.append(f"restore_dir {orbitals} $SCRATCH/initial_guess")
+    elif vars[cluster].get("orbstore") and initchk:
+        jobfile.append(f"restore_dir -c {orbitals} $SCRATCH/checkpoint")
+    elif parallel_staging(cluster) and (initorb or initchk):
+        jobfile.append(f"stage_dir {orbitals} $SCRATCH/{'initial_guess' if initorb else 'checkpoint'}")
+    elif initorb:
+        jobfile.append(f"cp -r {orbitals} $SCRATCH/initial_guess")
+    elif initchk:
+        jobfile.append(f"cp -r {orbitals} $SCRATCH/checkpoint")
+
+    # Continue from the checkpoint of a previous run of the job
+    jobfile += restart_staging(resubmit, ["rm -rf $SCRATCH/checkpoint"] +
+                               restore_orbitals(cluster, f"$(< ${{SLURM_SUBMIT_DIR}}/{inputfile}.checkpoint)", "checkpoint"))
     jobfile.append("")
 
     jobfile.append("cd $SCRATCH")
-    if cluster == 'betzy':
-        jobfile.append(
-            f"{vars[cluster]['mrchem_path']} --launcher='{slurm_submit_cmd if slurm_submit_cmd is not None else 'mpirun -map-by ppr:1:numa -bind-to numa'}' {inputfile}")
-    else:
-        jobfile.append(f"{vars[cluster]['mrchem_path']} --launcher='{slurm_submit_cmd} -{'n' if slurm_submit_cmd == 'srun' else 'np'} {slurm_ntasks_per_node}' {inputfile}")
+    jobfile += telemetry_phase(cluster, "compute")
+    jobfile += compute_command(mrchem_command(cluster, inputfile, slurm_ntasks_per_node, slurm_submit_cmd), resubmit)
     jobfile.append("")
 
-    if cluster == "stallo":
-        jobfile.append(f"cp {inputfile+extension_outputfile} ${{SLURM_SUBMIT_DIR}}/")
-        jobfile.append(f"cp {inputfile}.json ${{SLURM_SUBMIT_DIR}}/")
-    else:
-        jobfile.append(f"savefile {inputfile+extension_outputfile}")
-        jobfile.append(f"savefile {inputfile}.json")
-
-    jobfile.append("")
+    jobfile += telemetry_phase(cluster, "copy_back")
+    jobfile += mrchem_copy_back(cluster, inputfile, extension_outputfile)
 
-    jobfile.append(f"mkdir -p {vars[cluster]['orbdir']}")
-    jobfile.append(f"cp orbitals/* {vars[cluster]['orbdir']}/")
-    jobfile.append(f"echo {vars[cluster]['orbdir']} > ${{SLURM_SUBMIT_DIR}}/{inputfile}.orbitals")
-    
     jobfile.append("")
+    jobfile.append("exit 0")
+    return jobfile
 
-    jobfile.append(f"mkdir -p {vars[cluster]['checkdir']}")
-    jobfile.append(f"cp checkpoint/* {vars[cluster]['checkdir']}/")
-    jobfile.append(f"echo {vars[cluster]['checkdir']} > ${{SLURM_SUBMIT_DIR}}/{inputfile}.checkpoint")
 
-    jobfile.append("")
-    jobfile.append("exit 0")
+def mrchem_job(inputfile=None, outputfile=None, is_dev=None, slurm_account=None, slurm_nodes=None, slurm_partition=None,
+               cluster=None, slurm_ntasks_per_node=None, slurm_cpus_per_task=None, slurm_memory=None,
+               slurm_mem_per_cpu=None, slurm_time=None,
+               slurm_mail=None, extension_outputfile=None, extension_inputfile=None, initorb=None, initchk=None, loc=None,
+               identifier=None, slurm_submit_cmd="srun", resubmit=None, signal_lead=600):
 
-    return jobfile
+    if slurm_mem_per_cpu is not None:
+        check_memory(slurm_mem_per_cpu)
+    if slurm_memory is not None:
+        check_memory(slurm_memory)
+    if cluster not in ["saga", "fram", "betzy"]:
+        raise SettingsError(f"MRChem is not set up on {cluster}. Please update MRChem!")
+
+    structure = dict(cluster=cluster, loc=bool(loc), is_dev=bool(is_dev), has_memory=slurm_memory is not None,
+                     has_mem_per_cpu=slurm_mem_per_cpu is not None, initorb=initorb is not None,
+                     initchk=initorb is None and initchk is not None, slurm_submit_cmd=slurm_submit_cmd,
+                     resubmit=resubmit or None, signal_lead=signal_lead if resubmit else None,
+                     extension_inputfile=extension_inputfile, extension_outputfile=extension_outputfile)
+    stamp = timestamp()
+    return render_template(_mrchem_lines, structure, _MRCHEM_FIELDS,
+                           (stamp, '-'*len(stamp), inputfile, outputfile, identifier, slurm_account, slurm_nodes,
+                            slurm_ntasks_per_node, slurm_time, slurm_memory, slurm_mail, slurm_partition,
+                            slurm_cpus_per_task, slurm_mem_per_cpu, initorb if initorb is not None else initchk))
+
+
+def job_for_input(inputfile, settings, manifest=None):
+    """
+    Generate the job file for an input file by dispatching on the program that wrote it.
+    :param inputfile: name of input file without extension
+    :param settings: dict of command-line settings (the argparse names in slurmify.py), plus
+                     'cluster', 'extension_inputfile', and 'extension_outputfile'
+    :param manifest: manifest of the input file from scan_input. The input file is scanned if None
+    :return: name of the program ("orca", "gaussian", or "mrchem") and the job file as a list of lines
+    """
+    cluster = settings["cluster"]
+    if manifest is None:
+        manifest = scan_input(inputfile + settings["extension_inputfile"])
+    GaussianInput, OrcaInput, MrchemInput = input_origin(None, manifest)
+    if settings.get("predict"):
+        from history import apply_prediction
+
+        settings = apply_prediction(inputfile + settings["extension_inputfile"], settings, manifest["program"])
+    if MrchemInput and settings.get("autobill"):
+        from sweep import apply_autobill
+
+        settings = apply_autobill(settings)
+
+    outputfile = settings.get("output") or inputfile
+    identifier = settings.get("identifier") or inputfile
+    common = dict(inputfile=inputfile, outputfile=outputfile, is_dev=settings.get("dev"), cluster=cluster,
+                  extension_inputfile=settings["extension_inputfile"],
+                  extension_outputfile=settings["extension_outputfile"],
+                  slurm_account=settings["account"],
+                  slurm_nodes=settings["nodes"],
+                  slurm_ntasks_per_node=settings["ntasks"],
+                  slurm_memory=settings.get("memory"),
+                  slurm_time=settings["time"],
+                  slurm_mail=settings["mail"],
+                  slurm_partition=settings["partition"],
+                  loc=settings.get("loc"),
+                  identifier=identifier,
+                  resubmit=settings.get("resubmit"),
+                  signal_lead=settings.get("signal_lead") or 600)
+
+    if OrcaInput:
+        return "orca", orca_job(chess=settings.get("chess"), cxyz=settings.get("cxyz"), ccomp=settings.get("ccomp"),
+                                cgbw=settings.get("cgbw"), manifest=manifest, produced=settings.get("produced", ()),
+                                **common)
+    elif GaussianInput:
+        return "gaussian", gaussian_job(cchk=settings.get("cchk"), **common)
+
+    job = mrchem_job(slurm_cpus_per_task=settings["cpus_per_task"],
+                     slurm_mem_per_cpu=settings.get("memory_per_cpu"),
+                     slurm_submit_cmd=settings.get("cmd"),
+                     initorb=settings.get("initorb"),
+                     initchk=settings.get("initchk"),
+                     **common)
+
+    # Check that the job does not exceed maximum billing
+    if settings.get("checkbill"):
+        result, bill = maxbilling_okay(cluster=cluster,
+                                       ntasks=settings["ntasks"],
+                                       ncpus_per_task=settings["cpus_per_task"],
+                                       mem=settings.get("memory"),
+                                       mem_per_cpu=settings.get("memory_per_cpu"),
+                                       partition=settings["partition"])
+        if not result:
+            raise SettingsError(f"Your job ({bill}) exceeds the maximum number of billing units allowed on {cluster} ({max_billing(cluster, settings['partition'])}).")
+
+    return "mrchem", job
+
+
+def write_jobfile(jobname, job):
+    """
+    Write the lines of a job file to disk. The file is written in one go to a temporary file that
+    is renamed to jobname, so that a job file is never seen (or submitted) half-written.
+    :param jobname: path of the job file
+    :param job: job file as a list of lines
+    :return:
+    """
+    tmp = f"{jobname}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            f.write("\n".join(job) + "\n" if job else "")
+        os.replace(tmp, jobname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
 
 
 if __name__ == "__main__":
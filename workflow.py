@@ -0,0 +1,299 @@
+"""
+Multi-step workflows, e.g. ORCA optimization -> ORCA frequencies -> MRChem single point, submitted
+at once as a DAG of jobs that each start when the jobs they depend on completed successfully
+(--dependency=afterok). A workflow is described in a JSON file next to the input files:
+
+    {
+      "molecules": ["h2o", "nh3"],
+      "defaults": {"memory": "10GB", "ntasks": "16", "time": "0-04:00:00"},
+      "steps": [
+        {"name": "opt", "input": "{molecule}_opt"},
+        {"name": "freq", "input": "{molecule}_freq", "after": ["opt"]},
+        {"name": "sp", "input": "{molecule}_sp", "after": ["freq"], "memory": "100GB", "cpus_per_task": "16"},
+        {"name": "response", "input": "{molecule}_rsp", "after": ["sp"], "initorb": "sp"}
+      ]
+    }
+
+Each step is a job spec (see api.py) plus "name" and "after", the names of the steps it depends
+on. With "molecules", the steps are repeated for every molecule, with {molecule} replaced in
+all values. Without it, the steps are run once.
+
+The outputs of a step are wired into the staging of the steps after it:
+
+    ORCA     the .hess, .xyz, and .gbw files an ORCA job copies back are staged for every later
+             step whose input references them (inhessname, * xyzfile, %moinp), as with
+             --chess/--cxyz/--cgbw, although they do not exist yet when the jobs are generated
+    MRChem   "initorb"/"initchk" may name an earlier MRChem step, whose .orbitals/.checkpoint
+             pointer is then read when the job starts
+
+$ slurmify.py workflow pipeline.json          generate the job files
+$ slurmify.py workflow pipeline.json -X       and submit the whole DAG
+
+With --single, the steps of every molecule instead run back to back in one job, in one
+allocation and one scratch directory (see pipeline.py), which saves the queue wait and staging of
+short follow-up steps. The job is named after the workflow file and the molecule.
+
+Steps whose jobs fail are not retried, and the jobs depending on them are removed from the queue
+(--kill-on-invalid-dep=yes). Files copied back compressed (see "compress" in STAGING_DEFAULTS)
+cannot be handed on to the next step.
+"""
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import scan_input, write_jobfile, job_for_input, SettingsError, SlurmifyError
+
+# Files copied back by an ORCA job (see utils.orca_copy_back) that later steps may read
+ORCA_PRODUCTS = (".hess", ".xyz", ".gbw")
+
+# Staging options of ORCA jobs, and the key of the referenced file in the manifest of the input
+ORCA_STAGING = {"chess": "hess", "cxyz": "xyz", "cgbw": "gbw"}
+
+
+def load(path):
+    with open(path) as f:
+        try:
+            return json.load(f)
+        except ValueError as e:
+            raise SettingsError(f"{path} is not a valid workflow: {e}")
+
+
+def expand(spec):
+    """
+    The jobs of a workflow, one per step and molecule
+    :param spec: workflow dict (see above)
+    :return: list of job dicts with "key", "step", "molecule", "after" (keys of the jobs it depends on), and
+             "spec" (job spec), in an order where every job comes after the jobs it depends on
+    """
+    steps = spec.get("steps") or []
+    if not steps:
+        raise SettingsError("The workflow has no steps")
+    names = [step.get("name") for step in steps]
+    if None in names or len(set(names)) != len(names):
+        raise SettingsError("Every step of the workflow needs a unique 'name'")
+    for step in steps:
+        unknown = set(step.get("after", [])) - set(names)
+        if unknown:
+            raise SettingsError(f"Step {step['name']} depends on unknown steps: {', '.join(sorted(unknown))}")
+
+    # Order the steps such that each comes after the steps it depends on
+    ordered, done = [], set()
+    while len(ordered) < len(steps):
+        ready = [step for step in steps if step["name"] not in done and set(step.get("after", [])) <= done]
+        if not ready:
+            raise SettingsError(f"The steps {', '.join(sorted(set(names) - done))} depend on each other")
+        ordered += ready
+        done.update(step["name"] for step in ready)
+
+    jobs = []
+    for molecule in spec.get("molecules") or [None]:
+        def key(name):
+            return name if molecule is None else f"{molecule}:{name}"
+
+        for step in ordered:
+            job = dict(spec.get("defaults", {}), **{k: v for k, v in step.items() if k not in ("name", "after")})
+            if molecule is not None:
+                job = {k: v.replace("{molecule}", molecule) if isinstance(v, str) else v for k, v in job.items()}
+            jobs.append(dict(key=key(step["name"]), step=step["name"], molecule=molecule,
+                             after=[key(name) for name in step.get("after", [])], spec=job))
+    return jobs
+
+
+def wire(jobs, settings_for):
+    """
+    Resolve the settings of every job, and hand on the outputs of earlier steps (see above)
+    :param jobs: list of jobs from expand()
+    :param settings_for: function completing a job spec with the defaults (api.settings_for)
+    :return: dict mapping job key to settings, as passed to utils.job_for_input
+    """
+    by_key = {job["key"]: job for job in jobs}
+    steps = {job["step"] for job in jobs}
+    resolved, programs, ancestors = {}, {}, {}
+    for job in jobs:
+        settings = settings_for(job["spec"])
+        inputfile = settings["input"]
+        manifest = scan_input(inputfile + settings["extension_inputfile"])
+        programs[job["key"]] = manifest["program"]
+        ancestors[job["key"]] = set(job["after"]).union(*(ancestors[parent] for parent in job["after"]))
+        names = {by_key[other]["step"]: other for other in ancestors[job["key"]]}
+
+        if manifest["program"] == "orca":
+            produced = {resolved[other]["input"] + suffix for other in ancestors[job["key"]]
+                        if programs[other] == "orca" for suffix in ORCA_PRODUCTS}
+            for option, reference in ORCA_STAGING.items():
+                if manifest[reference] in produced:
+                    settings[option] = True
+            settings["produced"] = produced
+        elif manifest["program"] == "mrchem":
+            for option, pointer in [("initorb", ".orbitals"), ("initchk", ".checkpoint")]:
+                step = settings.get(option)
+                if step in names:
+                    if programs[names[step]] != "mrchem":
+                        raise SettingsError(f"{job['key']}: {option} must name an MRChem step, not {step}")
+                    settings[option] = f"$(< ${{SLURM_SUBMIT_DIR}}/{resolved[names[step]]['input']}{pointer})"
+                elif step in steps:
+                    raise SettingsError(f"{job['key']}: {option} names the step {step}, which does not run before it")
+        settings["manifest"] = manifest
+        resolved[job["key"]] = settings
+    return resolved
+
+
+def pipelines(jobs, stem, settings_for, copy_back="end"):
+    """
+    Combine the steps of every molecule into one pipeline job (see pipeline.py)
+    :param jobs: list of jobs from expand()
+    :param stem: name of the workflow, used for the names of the pipelines
+    :param settings_for: function completing a job spec with the defaults (api.settings_for)
+    :param copy_back: "end" or "step", see pipeline.pipeline_job
+    :return: list of pipeline dicts with "key", "step", "molecule", "after" (empty), and "lines" (the job file)
+    """
+    from pipeline import pipeline_job
+
+    molecules = {}
+    for job in jobs:
+        molecules.setdefault(job["molecule"], []).append(job)
+    result = []
+    for molecule, steps in molecules.items():
+        name = stem if molecule is None else f"{stem}_{molecule}"
+        resolved = []
+        for job in steps:
+            settings = settings_for(job["spec"])
+            manifest = scan_input(settings["input"] + settings["extension_inputfile"])
+            resolved.append(dict(name=job["step"], settings=settings, manifest=manifest))
+        result.append(dict(key=name, step=" -> ".join(job["step"] for job in steps), molecule=molecule, after=[],
+                           lines=pipeline_job(name, resolved, copy_back=copy_back)))
+    return result
+
+
+def generate(path, cluster=None, force=False, job_extension=".job", single=False, copy_back="end"):
+    """
+    Generate the job files of a workflow, in the directory of the workflow file
+    :param path: path to the workflow file
+    :param cluster: cluster of all jobs. Defaults to the cluster in the workflow file, or the current one
+    :param force: overwrite existing job files
+    :param single: run the steps of every molecule in one job (see pipelines)
+    :param copy_back: with single, copy back the results at the "end" or after every "step"
+    :return: list of jobs from expand() (or pipelines() with single), with the path of the job file under "jobfile"
+    """
+    import api
+
+    spec = load(path)
+    if cluster is not None:
+        spec["defaults"] = dict(spec.get("defaults", {}), cluster=cluster)
+    jobs = expand(spec)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    cwd = os.getcwd()
+    try:
+        os.chdir(directory)
+        if single:
+            jobs = pipelines(jobs, os.path.splitext(os.path.basename(path))[0], api.settings_for, copy_back=copy_back)
+            existing = [job["key"] + job_extension for job in jobs if os.path.isfile(job["key"] + job_extension)]
+            if existing and not force:
+                raise SettingsError(f"Job files exist: {', '.join(existing)}. Use -f to overwrite.")
+            for job in jobs:
+                job["jobfile"] = os.path.join(directory, job["key"] + job_extension)
+                job["program"] = "pipeline"
+                write_jobfile(job["jobfile"], job.pop("lines"))
+            return jobs
+        resolved = wire(jobs, api.settings_for)
+        existing = [settings["input"] + job_extension for settings in resolved.values()
+                    if os.path.isfile(settings["input"] + job_extension)]
+        if existing and not force:
+            raise SettingsError(f"Job files exist: {', '.join(existing)}. Use -f to overwrite.")
+        for job in jobs:
+            settings = resolved[job["key"]]
+            program, lines = job_for_input(settings["input"], settings, manifest=settings.pop("manifest"))
+            job["jobfile"] = os.path.join(directory, settings["input"] + job_extension)
+            job["program"] = program
+            write_jobfile(job["jobfile"], lines)
+    finally:
+        os.chdir(cwd)
+    return jobs
+
+
+def submit(jobs, command=None, retries=5, workers=8, silent=False):
+    """
+    Submit the jobs of a workflow, each depending on the jobs of the steps it comes after. Jobs
+    whose dependencies were submitted are submitted concurrently.
+    :param jobs: list of jobs from generate()
+    :param command: sbatch command
+    :param retries: number of retries on transient sbatch errors
+    :param workers: maximum number of concurrent sbatch calls
+    :return: dict mapping job key to job ID, and dict mapping job key to the reason it was not submitted
+    """
+    from submit import sbatch, SubmissionError, SBATCH
+
+    jobids, errors = {}, {}
+    remaining = list(jobs)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        while remaining:
+            ready = [job for job in remaining if all(parent in jobids or parent in errors for parent in job["after"])]
+            remaining = [job for job in remaining if job not in ready]
+            futures = {}
+            for job in ready:
+                failed = [parent for parent in job["after"] if parent in errors]
+                if failed:
+                    errors[job["key"]] = f"depends on {', '.join(failed)}, which was not submitted"
+                    continue
+                extra_args = []
+                if job["after"]:
+                    extra_args = [f"--dependency=afterok:{':'.join(jobids[parent] for parent in job['after'])}",
+                                  "--kill-on-invalid-dep=yes"]
+                futures[job["key"]] = pool.submit(sbatch, job["jobfile"], command=command or SBATCH,
+                                                  extra_args=extra_args, retries=retries)
+            for key, future in futures.items():
+                try:
+                    jobids[key] = future.result()
+                except SubmissionError as e:
+                    errors[key] = str(e)
+                    print(f"Failed to submit {e}", file=sys.stderr)
+                    continue
+                if not silent:
+                    print(f"Submitted batch job {jobids[key]} ({key})")
+    return jobids, errors
+
+
+def main(argv=None):
+    """Command-line interface for workflows"""
+    import slurmify
+
+    parser = argparse.ArgumentParser(prog="slurmify.py workflow",
+                                     description="Generate (and submit) the chained jobs of a multi-step workflow")
+    parser.add_argument("workflow", help="JSON workflow file, next to the input files")
+    parser.add_argument("-X", "--execute", action="store_true", help="Submit the jobs, each depending on the steps before it")
+    parser.add_argument("-f", "--force", action="store_true", help="Overwrite existing job files")
+    parser.add_argument("-C", "--cluster", metavar="<>", type=str, choices=slurmify.CLUSTERS, help="Generate the jobs for this cluster")
+    parser.add_argument("-S", "--silent", action="store_true", help="Only report failures")
+    parser.add_argument("--single", action="store_true", help="Run the steps of every molecule back to back in one job and one scratch directory")
+    parser.add_argument("--copy_back", metavar="<>", type=str, choices=("end", "step"), default="end",
+                        help="[str] With --single, copy back the results at the 'end' (default) or after every 'step'")
+    parser.add_argument("--sbatch", metavar="<>", type=str, help="[str] Command used to submit jobs (default: sbatch)")
+    parser.add_argument("--submit_workers", metavar="<>", type=int, default=8, help="[int] Maximum number of concurrent sbatch calls")
+    parser.add_argument("--retries", metavar="<>", type=int, default=5, help="[int] Number of retries on transient sbatch errors")
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = generate(args.workflow, cluster=args.cluster, force=args.force, job_extension=slurmify.JOB_EXTENSION,
+                        single=args.single, copy_back=args.copy_back)
+    except (SlurmifyError, OSError) as e:
+        sys.exit(str(e))
+    if not args.silent:
+        for job in jobs:
+            after = f" after {', '.join(job['after'])}" if job["after"] else ""
+            print(f"Generated {job['jobfile']} ({job['program']}, {job['key']}{after})")
+    if args.execute:
+        jobids, errors = submit(jobs, command=args.sbatch, retries=args.retries, workers=args.submit_workers,
+                                silent=args.silent)
+        for key, reason in errors.items():
+            if reason.startswith("depends on"):
+                print(f"Not submitted {key}: {reason}", file=sys.stderr)
+        if errors:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())